@@ -12,9 +12,9 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import environ
+import json
 import os
 
-import boto3
 
 # Initialise environment variables
 env = environ.Env(
@@ -25,9 +25,58 @@ env = environ.Env(
     SERVER_CAPACITY=(int, 1000),
     AWS_REGION=(str, "ap-south-1"),
     ECS_INSTANCE_LAUNCH_TEMPLATE=(str, "defaultECS"),
+    ECS_CLUSTER=(str, ''),
     SERVER_TASK_DEFINITION=(str, 'LaunchGameserver'),
     BACKUP_GAMESERVER=(str, "127.0.0.1:8888"),
-    THREAD_SLEEP_TIME=(int, 60)
+    THREAD_SLEEP_TIME=(int, 60),
+    HEALTH_CHECK_TIMEOUT=(float, 2.0),
+    HEALTH_CHECK_TICK_DEADLINE=(float, 5.0),
+    HEALTH_CHECK_MIN_INTERVAL=(float, 5.0),
+    HEALTH_CHECK_MAX_INTERVAL=(float, 60.0),
+    HEALTH_CHECK_DEAD_AFTER=(int, 3),
+    SELECTION_POLICY=(str, 'max_available'),
+    AFFINITY_LOAD_FACTOR=(float, 1.25),
+    AFFINITY_TTL=(float, 3600.0),
+    ADMISSION_CONTROL=(bool, False),
+    ADMISSION_QUEUE_SIZE=(int, 1000),
+    ADMISSION_DEFAULT_WAIT=(float, 10.0),
+    ADMISSION_MAX_WAIT=(float, 30.0),
+    ADMISSION_POLL_INTERVAL=(float, 0.25),
+    ADMISSION_RETRY_AFTER=(float, 120.0),
+    PROVISIONING_WORKERS=(int, 4),
+    SCALE_OUT_MAX_BURST=(int, 4),
+    SCALE_IN_MAX_STEP=(int, 2),
+    SCALE_OUT_COOLDOWN=(float, 0),
+    SCALE_IN_COOLDOWN=(float, 300),
+    SCALE_IN_STABLE_TICKS=(int, 2),
+    PREDICTIVE_SCALING=(bool, False),
+    FORECAST_BUCKET=(int, 300),
+    FORECAST_PATH=(str, 'demand_history.bin'),
+    FORECAST_LEAD_TIME=(float, 0.0),
+    RESERVATION_TTL=(float, 30),
+    SNAPSHOT_MAX_AGE=(int, 5),
+    ASYNC_VIEWS=(bool, False),
+    SHARED_TABLE=(bool, False),
+    SHARED_TABLE_NAME=(str, 'playlivechess_servers'),
+    SHARED_TABLE_SLOTS=(int, 1024),
+    HEARTBEAT_TIMEOUT=(float, 15.0),
+    HEARTBEAT_TOKEN=(str, ''),
+    AWS_API_RATE=(float, 20.0),
+    AWS_API_BURST=(int, 40),
+    AWS_CACHE_TTL=(float, 300.0),
+    WARM_POOL_MIN_SIZE=(int, 0),
+    WARM_POOL_MAX_SIZE=(int, 0),
+    WARM_POOL_MODE=(str, 'stopped'),
+    PLACEMENT_MODE=(str, 'distinct'),
+    STATE_JOURNAL=(bool, False),
+    STATE_JOURNAL_PATH=(str, 'server_state.json'),
+    STATE_JOURNAL_MAX_AGE=(float, 180.0),
+    POOLS=(str, ''),
+    REPLICA_MODE=(bool, False),
+    REPLICA_LEASE_BACKEND=(str, 'sqlite'),
+    REPLICA_LEASE_PATH=(str, 'replica_lease.sqlite3'),
+    REPLICA_LEASE_TTL=(float, 15.0),
+    REPLICA_ID=(str, ''),
 )
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -156,12 +205,90 @@ DOWNSCALE_MARGIN = env('DOWNSCALE_MARGIN')
 THREAD_SLEEP_TIME = env('THREAD_SLEEP_TIME')
 SERVER_CAPACITY = env('SERVER_CAPACITY')
 BACKUP_GAMESERVER = env('BACKUP_GAMESERVER')
+SELECTION_POLICY = env('SELECTION_POLICY') # one of 'max_available', 'power_of_two', 'weighted_random', 'pack' (see CapacityIndex)
+PROVISIONING_WORKERS = env('PROVISIONING_WORKERS') # max server instances launched concurrently
+PLACEMENT_MODE = env('PLACEMENT_MODE') # 'distinct' (one gameserver task per EC2 instance) or 'binpack' (several tasks per instance)
+ASYNC_VIEWS = env('ASYNC_VIEWS') # serve async views and run the server management on the event loop; set by manager/asgi.py
+SNAPSHOT_MAX_AGE = env('SNAPSHOT_MAX_AGE') # seconds clients and CDNs may cache the list of available gameservers
+RESERVATION_TTL = env('RESERVATION_TTL') # seconds a client sent to a server is held against its capacity unless a health report reflects it
+
+# Game affinity (clients requesting a gameserver with a game_id or room_id)
+AFFINITY_LOAD_FACTOR = env('AFFINITY_LOAD_FACTOR') # max games routed to a server by the hash ring, relative to the average
+AFFINITY_TTL = env('AFFINITY_TTL') # seconds after its last request a game is forgotten
+
+# Admission control (clients wait for capacity instead of being sent to the backup gameserver)
+ADMISSION_CONTROL = env('ADMISSION_CONTROL') # hold clients in a wait queue (long-poll) while no server has capacity left
+ADMISSION_QUEUE_SIZE = env('ADMISSION_QUEUE_SIZE') # max waiting clients (per worker process)
+ADMISSION_DEFAULT_WAIT = env('ADMISSION_DEFAULT_WAIT') # seconds a client waits unless it passes ?wait=<seconds>
+ADMISSION_MAX_WAIT = env('ADMISSION_MAX_WAIT') # max seconds a client may ask to wait
+ADMISSION_POLL_INTERVAL = env('ADMISSION_POLL_INTERVAL') # seconds after which a waiting client checks for freed capacity itself
+ADMISSION_RETRY_AFTER = env('ADMISSION_RETRY_AFTER') # seconds a launch is expected to take until launches have been timed
+
+# Multiple worker processes
+SHARED_TABLE = env('SHARED_TABLE') # one worker process runs the server management and shares the server table with the others
+SHARED_TABLE_NAME = env('SHARED_TABLE_NAME') # name of the shared memory segment (and lock files)
+SHARED_TABLE_SLOTS = env('SHARED_TABLE_SLOTS') # max servers in the shared server table
+
+# Scaling steps
+SCALE_OUT_MAX_BURST = env('SCALE_OUT_MAX_BURST') # max server instances added in one update
+SCALE_IN_MAX_STEP = env('SCALE_IN_MAX_STEP') # max server instances moved to standby in one update
+SCALE_OUT_COOLDOWN = env('SCALE_OUT_COOLDOWN') # min seconds between scale-outs
+SCALE_IN_COOLDOWN = env('SCALE_IN_COOLDOWN') # min seconds between a scale-out/scale-in and the next scale-in
+SCALE_IN_STABLE_TICKS = env('SCALE_IN_STABLE_TICKS') # consecutive updates above the downscale margin needed to scale in
+
+# Predictive scaling
+PREDICTIVE_SCALING = env('PREDICTIVE_SCALING') # launch ahead of the capacity forecast from the assignment rate history
+FORECAST_BUCKET = env('FORECAST_BUCKET') # seconds per sample of the demand history; must divide a day
+FORECAST_PATH = os.path.join(BASE_DIR, env('FORECAST_PATH')) # relative to the manager directory
+FORECAST_LEAD_TIME = env('FORECAST_LEAD_TIME') # seconds to forecast ahead; 0 for the measured duration of a launch
+
+# Warm pool
+WARM_POOL_MIN_SIZE = env('WARM_POOL_MIN_SIZE') # min EC2 instances kept ready for scale-outs
+WARM_POOL_MAX_SIZE = env('WARM_POOL_MAX_SIZE') # max EC2 instances kept ready for scale-outs; 0 disables the warm pool
+WARM_POOL_MODE = env('WARM_POOL_MODE') # 'stopped' (cheaper, seconds to start) or 'running' (idle, instant)
+
+# State journal
+STATE_JOURNAL = env('STATE_JOURNAL') # save the server lists on every update and restore them on startup
+STATE_JOURNAL_PATH = os.path.join(BASE_DIR, env('STATE_JOURNAL_PATH')) # relative to the manager directory
+STATE_JOURNAL_MAX_AGE = env('STATE_JOURNAL_MAX_AGE') # seconds after which a journal is too old to be restored from (a few THREAD_SLEEP_TIME)
+
+# Pools of gameservers in several regions (or clusters)
+POOLS = json.loads(env('POOLS') or '{}') # json object mapping each pool name to its settings (see Pool); empty for a single pool
+
+# Active/standby replicas
+REPLICA_MODE = env('REPLICA_MODE') # replicas elect a leader which alone runs the scaling; the others serve clients from its replicated server table
+REPLICA_LEASE_BACKEND = env('REPLICA_LEASE_BACKEND') # 'sqlite' or 'file'; the lease path must be on storage shared by the replicas
+REPLICA_LEASE_PATH = os.path.join(BASE_DIR, env('REPLICA_LEASE_PATH')) # relative to the manager directory
+REPLICA_LEASE_TTL = env('REPLICA_LEASE_TTL') # seconds a lease lasts unless renewed
+REPLICA_ID = env('REPLICA_ID') # name of this replica in the lease; empty for hostname:pid
+
+# Health checks
+HEALTH_CHECK_TIMEOUT = env('HEALTH_CHECK_TIMEOUT') # seconds allowed for a single /health/ request
+HEALTH_CHECK_TICK_DEADLINE = env('HEALTH_CHECK_TICK_DEADLINE') # seconds allowed for a sweep over the whole fleet
+HEALTH_CHECK_MIN_INTERVAL = env('HEALTH_CHECK_MIN_INTERVAL') # seconds between checks of the hottest servers
+HEALTH_CHECK_MAX_INTERVAL = env('HEALTH_CHECK_MAX_INTERVAL') # seconds between checks of idle servers
+HEALTH_CHECK_DEAD_AFTER = env('HEALTH_CHECK_DEAD_AFTER') # consecutive failed checks (retried with backoff) after which a server is terminated
+
+# Heartbeats
+HEARTBEAT_TIMEOUT = env('HEARTBEAT_TIMEOUT') # seconds without a heartbeat after which a server is polled again
+HEARTBEAT_TOKEN = env('HEARTBEAT_TOKEN') # bearer token heartbeats must carry; empty to refuse heartbeats
 
 assert (DOWNSCALE_MARGIN - UPSCALE_MARGIN) > SERVER_CAPACITY
+assert SELECTION_POLICY in ('max_available', 'power_of_two', 'weighted_random', 'pack')
+assert PLACEMENT_MODE in ('distinct', 'binpack')
+assert 0 < HEALTH_CHECK_MIN_INTERVAL <= HEALTH_CHECK_MAX_INTERVAL
+assert FORECAST_BUCKET > 0 and 86400 % FORECAST_BUCKET == 0
+assert not (POOLS and SHARED_TABLE), "SHARED_TABLE doesn't support several pools"
+assert REPLICA_LEASE_BACKEND in ('sqlite', 'file')
+assert not (REPLICA_MODE and SHARED_TABLE), "REPLICA_MODE doesn't support SHARED_TABLE"
 
 # AWS Configurations
 AWS_REGION = env('AWS_REGION')
-ECS_CLIENT = boto3.client("ecs", region_name = AWS_REGION)
-EC2_CLIENT = boto3.client("ec2", region_name = AWS_REGION)
+ECS_CLIENT = None # boto3 client; created on first use (see scaling_manager/aws_client.py) unless set here
+EC2_CLIENT = None # boto3 client; created on first use (see scaling_manager/aws_client.py) unless set here
 ECS_INSTANCE_LAUNCH_TEMPLATE = env('ECS_INSTANCE_LAUNCH_TEMPLATE')
+ECS_CLUSTER = env('ECS_CLUSTER') # ECS cluster the gameserver tasks run in; empty for the default cluster
+AWS_API_RATE = env('AWS_API_RATE') # max AWS api calls per second (per client)
+AWS_API_BURST = env('AWS_API_BURST') # max AWS api calls in a burst (per client)
+AWS_CACHE_TTL = env('AWS_CACHE_TTL') # seconds the addresses of known instances are cached
 SERVER_TASK_DEFINITION = env('SERVER_TASK_DEFINITION')
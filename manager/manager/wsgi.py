@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'manager.settings')
 
 application = get_wsgi_application()
+
+# Imported after the app registry is ready
+from scaling_manager.apps import start_server_management
+
+# Starts the server management once per process, as WSGI servers other than runserver don't set RUN_MAIN
+start_server_management()
@@ -0,0 +1,152 @@
+"""This module has the AdmissionQueue class which holds the clients that find no gameserver with capacity left until one is available (long-poll)"""
+
+import asyncio
+from collections import deque
+from math import ceil
+from threading import Event
+from time import monotonic
+from django.conf import settings
+from . import metrics
+
+class Saturated(Exception):
+    """
+    Raised when a client isn't admitted, as the wait queue is full or the client's wait is over
+
+    Attributes:
+    * retry_after: time (in seconds) after which the client should retry
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__("No gameserver capacity available, retry after " + str(retry_after) + " seconds")
+        self.retry_after: int = retry_after
+
+def get_retry_after(eta: float, launch_duration: float, queue_depth: int) -> int:
+    """
+    Returns the time (in seconds) after which a client turned away should retry, expecting waves of SERVER_CAPACITY clients to be admitted
+    once the next launch in flight is running (in eta seconds, None if there is none) and every launch_duration seconds (None if unknown) after that.
+    """
+    if launch_duration is None:
+        launch_duration = settings.ADMISSION_RETRY_AFTER
+    if eta is None:
+        eta = launch_duration
+    return max(1, ceil(eta + launch_duration * (queue_depth // settings.SERVER_CAPACITY)))
+
+class Waiter():
+    """A client waiting in the queue; woken up from any thread once it is given a server"""
+
+    __slots__ = ('game_id', 'server', 'event', 'loop')
+
+    def __init__(self, game_id: str, loop: asyncio.AbstractEventLoop = None):
+        self.game_id: str = game_id
+        self.server = None
+        self.loop = loop
+        # Coroutines wait on an asyncio event, which may only be set from its loop
+        self.event = Event() if loop is None else asyncio.Event()
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+class AdmissionQueue():
+    """
+    Bounded FIFO queue of clients waiting for gameserver capacity, admitted oldest first by release() whenever capacity may have been freed (and every poll_interval seconds).
+
+    Attributes:
+    * lock: lock guarding the queue; it is the lock guarding the servers, so that admitting a client and reserving capacity for it is one atomic step
+    * try_acquire: function of a game id (or None) returning a server with capacity reserved for the client, or None if no server has capacity left
+    * retry_after: function of the queue depth returning the time (in seconds) after which a rejected client should retry
+    * max_size: max number of waiting clients
+    * poll_interval: time (in seconds) after which a waiting client checks for freed capacity itself
+    * waiters: deque of waiting clients, oldest first
+    """
+
+    def __init__(self, lock, try_acquire, retry_after, max_size: int = None, poll_interval: float = None):
+        self.lock = lock
+        self.try_acquire = try_acquire
+        self.retry_after = retry_after
+        self.max_size: int = settings.ADMISSION_QUEUE_SIZE if max_size is None else max_size
+        self.poll_interval: float = poll_interval or settings.ADMISSION_POLL_INTERVAL
+        self.waiters = deque()
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    def release(self) -> int:
+        """Admits the waiting clients oldest first, as long as there is capacity for them. Returns the number of clients admitted"""
+        admitted: int = 0
+        with self.lock:
+            while self.waiters:
+                waiter: Waiter = self.waiters[0]
+                server = self.try_acquire(waiter.game_id)
+                if server is None:
+                    break
+                self.waiters.popleft()
+                waiter.server = server
+                waiter.wake()
+                admitted += 1
+            if admitted > 0:
+                metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+        return admitted
+
+    def acquire(self, game_id: str = None, wait: float = 0.0):
+        """
+        Returns a server with capacity reserved for the client, waiting up to wait seconds for one.
+        Raises Saturated if the client isn't admitted.
+        """
+        start: float = monotonic()
+        server, waiter = self._enter(game_id, wait, None)
+        if waiter is None:
+            return server
+        while waiter.server is None:
+            remaining: float = start + wait - monotonic()
+            if remaining <= 0:
+                break
+            if not waiter.event.wait(min(self.poll_interval, remaining)):
+                self.release()
+        return self._leave(waiter, start)
+
+    async def acquire_async(self, game_id: str = None, wait: float = 0.0):
+        """asyncio counterpart of acquire; waiting doesn't block the event loop"""
+        start: float = monotonic()
+        server, waiter = self._enter(game_id, wait, asyncio.get_running_loop())
+        if waiter is None:
+            return server
+        while waiter.server is None:
+            remaining: float = start + wait - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(waiter.event.wait(), min(self.poll_interval, remaining))
+            except asyncio.TimeoutError:
+                self.release()
+        return self._leave(waiter, start)
+
+    def _enter(self, game_id: str, wait: float, loop) -> tuple:
+        """Returns a tuple (server, None) if the client is admitted right away and (None, waiter) if it has to wait"""
+        with self.lock:
+            if not self.waiters:
+                server = self.try_acquire(game_id)
+                if server is not None:
+                    metrics.ADMISSIONS.labels('immediate').inc()
+                    return server, None
+            if wait <= 0 or len(self.waiters) >= self.max_size:
+                metrics.ADMISSIONS.labels('rejected').inc()
+                raise Saturated(self.retry_after(len(self.waiters)))
+            waiter = Waiter(game_id, loop)
+            self.waiters.append(waiter)
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+            return None, waiter
+
+    def _leave(self, waiter: Waiter, start: float):
+        """Returns the server the waiting client was given; raises Saturated (and drops the client from the queue) if it wasn't given one in time"""
+        metrics.ADMISSION_WAIT.observe(monotonic() - start)
+        with self.lock:
+            if waiter.server is not None:
+                metrics.ADMISSIONS.labels('waited').inc()
+                return waiter.server
+            self.waiters.remove(waiter)
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(self.waiters))
+            metrics.ADMISSIONS.labels('timed_out').inc()
+            raise Saturated(self.retry_after(len(self.waiters)))
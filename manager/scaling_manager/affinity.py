@@ -0,0 +1,151 @@
+"""This module has the classes (HashRing and GameAffinity) which route all the clients of a game (or room) to the same gameserver"""
+
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import hashlib
+from math import ceil
+from time import monotonic
+from django.conf import settings
+
+def ring_hash(key: bytes) -> int:
+    """Returns the point of a key on the hash ring"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+class HashRing():
+    """
+    Consistent hash ring placing each node at vnodes points; a key belongs to the first node clockwise from its point. Note that the class isn't thread safe by itself.
+
+    Attributes:
+    * vnodes: number of points of each node on the ring
+    """
+
+    def __init__(self, vnodes: int = 64):
+        self.vnodes: int = vnodes
+        self._points: list = [] # sorted (point, node key) pairs
+        self._nodes: dict = {} # node key -> node
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def add(self, node, key: bytes) -> None:
+        """Adds the node, identified by a key which is the same in every process (e.g. task_key of its task arn)"""
+        if key in self._nodes:
+            self._nodes[key] = node
+            return
+        self._nodes[key] = node
+        for i in range(self.vnodes):
+            insort(self._points, (ring_hash(key + b'#' + str(i).encode()), key))
+
+    def remove(self, key: bytes) -> None:
+        if self._nodes.pop(key, None) is None:
+            return
+        self._points = [point for point in self._points if point[1] != key]
+
+    def lookup(self, key: bytes, accept=None):
+        """
+        Returns the first node clockwise from the point of the key for which accept(node) is True (any node if accept is None).
+        Returns None if no node is accepted.
+        """
+        if not self._points:
+            return None
+        start: int = bisect_left(self._points, (ring_hash(key), b''))
+        seen: set = set()
+        for i in range(len(self._points)):
+            node_key: bytes = self._points[(start + i) % len(self._points)][1]
+            if node_key in seen:
+                continue
+            seen.add(node_key)
+            node = self._nodes[node_key]
+            if accept is None or accept(node):
+                return node
+            if len(seen) == len(self._nodes):
+                break
+        return None
+
+class GameAffinity():
+    """
+    Sticky routing of games (or rooms) to the server instance hosting them, with new games placed by a hash ring with bounded loads.
+    Note that the class isn't thread safe by itself.
+
+    Attributes:
+    * ring: HashRing over the available server instances
+    * load_factor: max number of games hosted by a server instance, relative to the average
+    * ttl: time (in seconds) after its last request a game is forgotten
+    * games: OrderedDict mapping game id to [server, time of the last request], least recently requested first
+    * loads: dict mapping each available server instance to the number of games it hosts
+    """
+
+    def __init__(self, load_factor: float = None, ttl: float = None, vnodes: int = 64):
+        self.ring = HashRing(vnodes)
+        self.load_factor: float = load_factor or settings.AFFINITY_LOAD_FACTOR
+        self.ttl: float = ttl or settings.AFFINITY_TTL
+        self.games = OrderedDict()
+        self.loads: dict = {}
+
+    def add_server(self, server, key: bytes) -> None:
+        self.ring.add(server, key)
+        self.loads.setdefault(server, 0)
+
+    def remove_server(self, server, key: bytes) -> None:
+        """Removes a server instance which is no longer available; its games are routed anew on their next request"""
+        self.ring.remove(key)
+        self.loads.pop(server, None)
+
+    def lookup(self, game_id: str, now: float = None, exclude: set = ()):
+        """
+        Returns a tuple (server, hosting): the server instance the game should be routed to (None if there is none, see class docstring),
+        and whether it already hosts the game.
+        A new game isn't routed to the server instances in exclude (e.g. the ones being drained), while a hosted game stays where it is.
+        """
+        now = monotonic() if now is None else now
+        self._expire(now)
+        entry: list = self.games.get(game_id)
+        if entry is not None and entry[0] in self.loads:
+            return entry[0], True
+        if not self.loads:
+            return None, False
+        bound: int = ceil(self.load_factor * (len(self.games) + 1) / len(self.loads))
+        server = self.ring.lookup(
+            game_id.encode(),
+            lambda s: s.available_capacity > 0 and self.loads[s] < bound and s not in exclude
+        )
+        return server, False
+
+    def hosts(self, game_id: str, now: float = None) -> bool:
+        """Returns True if the game is hosted by an available server instance and False otherwise"""
+        now = monotonic() if now is None else now
+        self._expire(now)
+        entry: list = self.games.get(game_id)
+        return entry is not None and entry[0] in self.loads
+
+    def assign(self, game_id: str, server, now: float = None) -> None:
+        """Records that the game is hosted by the server instance"""
+        now = monotonic() if now is None else now
+        entry: list = self.games.get(game_id)
+        if entry is not None:
+            if entry[0] is not server:
+                self._unload(entry[0])
+                self._load(server)
+                entry[0] = server
+            entry[1] = now
+            self.games.move_to_end(game_id)
+        else:
+            self.games[game_id] = [server, now]
+            self._load(server)
+
+    def _expire(self, now: float) -> None:
+        while self.games:
+            game_id, entry = next(iter(self.games.items()))
+            if entry[1] > now - self.ttl:
+                break
+            del self.games[game_id]
+            self._unload(entry[0])
+
+    def _load(self, server) -> None:
+        if server in self.loads:
+            self.loads[server] += 1
+
+    def _unload(self, server) -> None:
+        # A server instance which moved back from standby starts over from 0 games
+        if self.loads.get(server, 0) > 0:
+            self.loads[server] -= 1
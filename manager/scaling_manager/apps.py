@@ -1,11 +1,40 @@
 from django.apps import AppConfig
+from django.conf import settings
 from .server_classes import ServerManagerThread
+from .shared_table import get_shared_table
 import os
+import sys
+
+def is_autoreloader_parent() -> bool:
+    """Returns True in the process of runserver which only watches the code and restarts the serving process (RUN_MAIN is set in the latter)"""
+    return 'runserver' in sys.argv and '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true'
+
+def start_server_management() -> None:
+    """Starts the server management of this process (unless already started), e.g. from the WSGI entry point (see manager/wsgi.py)"""
+    if settings.SHARED_TABLE:
+        # Only the worker process which owns the shared server table runs the server management
+        shared_table = get_shared_table()
+        if not shared_table.try_become_owner():
+            return
+        managers: list = [ServerManagerThread.get_instance()]
+        managers[0].shared_table = shared_table
+    else:
+        # Each pool has its own control loop
+        managers = ServerManagerThread.get_instances()
+    for manager in managers:
+        if manager.ident is None:
+            manager.start()
 
 class ScalingManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'scaling_manager'
     
     def ready(self):
-        if os.environ.get('RUN_MAIN') == 'true':
-            ServerManagerThread.get_instance().start()
\ No newline at end of file
+        if settings.ASYNC_VIEWS:
+            # Server management is started on the event loop (see manager/asgi.py)
+            return
+        if is_autoreloader_parent():
+            # The process serving the requests is the child, which is restarted on code changes
+            return
+        if settings.SHARED_TABLE or os.environ.get('RUN_MAIN') == 'true':
+            start_server_management()
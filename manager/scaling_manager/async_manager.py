@@ -0,0 +1,164 @@
+"""This module has classes (AsyncServerManager and ServerManagerLifespan) to run the server management on an asyncio event loop when the manager app is served over ASGI"""
+
+import asyncio
+from time import monotonic, perf_counter
+from django.conf import settings
+from .health_checks import AsyncHealthChecker
+from .server_classes import ServerManagerThread
+from .shared_table import get_shared_table
+from . import metrics
+
+class AsyncServerManager():
+    """
+    Runs the routine updates of a ServerManagerThread (not started as a thread) on the event loop; blocking steps run in the default executor.
+
+    Attributes:
+    * manager: the ServerManagerThread holding the server lists, the capacity index and the scaling policy
+    * health_checker: AsyncHealthChecker used to poll server instances concurrently
+    """
+
+    def __init__(self, manager: ServerManagerThread):
+        self.manager: ServerManagerThread = manager
+        self.health_checker = AsyncHealthChecker()
+
+    async def remove_servers(self, servers: list) -> None:
+        """Terminates the given server instances concurrently"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self.manager.remove_server, s) for s in servers])
+
+    async def check_servers(self) -> list:
+        """
+        Polls the servers whose health check is due concurrently and terminates the dead servers (see ServerManagerThread.check_servers).
+        Returns the list of servers which didn't respond to the health check.
+        """
+        manager = self.manager
+        health_states: dict = await self.health_checker.check(manager.get_servers_to_check())
+        unresponsive_servers: list = manager.apply_health_states(health_states)
+        await self.remove_servers(manager.drop_dead_servers(unresponsive_servers))
+        return unresponsive_servers
+
+    async def update(self) -> list:
+        """
+        Carries out one routine update (see ServerManagerThread.update).
+        Returns the list of servers which didn't respond to the health check.
+        """
+        start: float = perf_counter()
+        manager = self.manager
+        loop = asyncio.get_running_loop()
+        # The lease backend is blocking
+        if not await loop.run_in_executor(None, manager.renew_lease):
+            await loop.run_in_executor(None, manager.sync_replica)
+            manager.record_metrics()
+            metrics.TICK_DURATION.observe(perf_counter() - start)
+            return []
+
+        # Collecting a launch may wait for the placement of a task
+        await loop.run_in_executor(None, manager.collect_launched_servers)
+
+        with metrics.HEALTH_SWEEP_DURATION.time():
+            unresponsive_servers: list = await self.check_servers()
+
+        if manager.is_leader():
+            # Scaling may save the demand history and maintain the warm pool
+            with metrics.SCALING_DECISION_DURATION.time():
+                await loop.run_in_executor(None, manager.scale)
+
+            with metrics.STANDBY_REAPING_DURATION.time():
+                closing_servers: list = manager.reap_standby_servers()
+                if closing_servers:
+                    print("Removing extra servers")
+                    await self.remove_servers(closing_servers)
+
+        manager.publish_snapshot()
+        await loop.run_in_executor(None, manager.save_state)
+        await loop.run_in_executor(None, manager.publish_replica)
+        manager.record_metrics()
+        metrics.TICK_DURATION.observe(perf_counter() - start)
+        return unresponsive_servers
+
+    async def run(self) -> None:
+        """Main coroutine which carries out routinely maintainance and updates in the background"""
+
+        print("Starting async server management")
+
+        while(True):
+            try:
+                await self.update()
+            except Exception as e:
+                print("Server update failed due to the following exception")
+                print(e)
+            next_update: float = monotonic() + self.manager.thread_sleep_time
+
+            print("Ending server_update and sleeping")
+            # Until the next update, only the servers whose health check falls due are polled (and launches which completed are collected, see get_next_collection_time)
+            while True:
+                wake_up: float = next_update
+                for t in self.manager.get_wake_up_times():
+                    if t is not None:
+                        wake_up = min(wake_up, t)
+                await asyncio.sleep(max(wake_up - monotonic(), 0))
+                if monotonic() >= next_update:
+                    break
+                try:
+                    if await asyncio.get_running_loop().run_in_executor(None, self.manager.tend_lease):
+                        break
+                    if not self.manager.is_leader():
+                        continue
+                    await asyncio.get_running_loop().run_in_executor(None, self.manager.check_launched_servers)
+                    await self.check_servers()
+                    self.manager.publish_shared_table()
+                    await asyncio.get_running_loop().run_in_executor(None, self.manager.publish_replica)
+                except Exception as e:
+                    print("Health checks failed due to the following exception")
+                    print(e)
+
+class ServerManagerLifespan():
+    """
+    ASGI middleware which starts an AsyncServerManager per pool once per process (only in the owner of the shared server table if SHARED_TABLE is set), on lifespan startup or the first request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.task: asyncio.Task = None
+        self._lock: asyncio.Lock = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await self.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.stop()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if self.task is None:
+            await self.start()
+        await self.app(scope, receive, send)
+
+    async def start(self) -> None:
+        """Creates the manager of every pool (discovering running servers without blocking the event loop) and starts their routine updates"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.task is not None:
+                return
+            shared_table = None
+            if settings.SHARED_TABLE:
+                shared_table = get_shared_table()
+                if not shared_table.try_become_owner():
+                    # Another worker process runs the server management; this one only reads the shared server table
+                    self.task = asyncio.get_running_loop().create_future()
+                    return
+            loop = asyncio.get_running_loop()
+            managers: list = await loop.run_in_executor(None, ServerManagerThread.get_instances)
+            # There is a single pool with SHARED_TABLE
+            managers[0].shared_table = shared_table
+            # Each pool has its own routine updates
+            self.task = asyncio.ensure_future(asyncio.gather(*(AsyncServerManager(manager).run() for manager in managers)))
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,271 @@
+"""This module has a wrapper (AWSClient) for the boto3 clients used by aws_utils, which rate limits, retries and coalesces api calls, along with its building blocks (TokenBucket, TTLCache and SingleFlight)"""
+
+from threading import Event, Lock
+from time import monotonic, sleep
+import random
+from django.conf import settings
+from . import metrics
+
+# Error codes with which AWS apis reject a call due to throttling
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'RequestThrottled',
+    'RequestThrottledException',
+)
+
+def is_throttling_error(e: Exception) -> bool:
+    """Returns True if the exception is a botocore ClientError (or a WaiterError whose last poll failed) due to throttling and False otherwise"""
+    response = getattr(e, 'response', None) or getattr(e, 'last_response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+class TokenBucket():
+    """
+    Token bucket rate limiter; a call takes a token and tokens are refilled at a fixed rate up to the burst size
+
+    Attributes:
+    * rate: tokens added per second
+    * burst: max number of tokens in the bucket
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.updated_at: float = monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """Takes a token, waiting for one to be refilled if the bucket is empty"""
+        while True:
+            with self._lock:
+                now: float = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait: float = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+class TTLCache():
+    """
+    Thread safe dict whose entries expire ttl seconds after they were set
+
+    Attributes:
+    * ttl: time (in seconds) an entry is kept for
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl: float = ttl
+        self._entries: dict = {} # key -> (expiry, value)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= monotonic():
+                del self._entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_values(self, value) -> None:
+        """Drops the entries with the given value"""
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[1] == value]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+class _Flight():
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error: BaseException = None
+
+class SingleFlight():
+    """Coalesces concurrent calls with the same key: the first caller makes the call and the others wait for (and share) its result"""
+
+    def __init__(self):
+        self._flights: dict = {}
+        self._lock = Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            flight: _Flight = self._flights.get(key)
+            leader: bool = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+class AWSClient():
+    """
+    Wrapper around a boto3 client which can be used in its place. Every api call (including each page of a paginator and each wait of a waiter) takes a token from the bucket,
+    throttled calls are retried with jittered exponential backoff, and identical concurrent read-only calls are coalesced into one.
+
+    Attributes:
+    * client: the wrapped boto3 client
+    * bucket: TokenBucket limiting the rate of api calls
+    * max_retries: max number of retries of a throttled call
+    * base_delay: base of the exponential backoff (in seconds)
+    * max_delay: max backoff delay (in seconds)
+    """
+
+    READ_ONLY_PREFIXES = ('describe_', 'list_', 'get_')
+    PASS_THROUGH = ('can_paginate', 'meta', 'exceptions')
+    # Request (and response) key of the pagination token of the operations paginated by aws_utils; the others use the paginator of the wrapped client
+    PAGE_TOKENS = {'list_tasks': 'nextToken', 'describe_instances': 'NextToken'}
+
+    def __init__(self, client, rate: float = None, burst: int = None, max_retries: int = 5,
+                 base_delay: float = 0.1, max_delay: float = 5.0):
+        self.client = client
+        self.bucket = TokenBucket(rate or settings.AWS_API_RATE, burst or settings.AWS_API_BURST)
+        self.max_retries: int = max_retries
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self._single_flight = SingleFlight()
+        self._rng = random.Random()
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.client, name)
+        if name in self.PASS_THROUGH or name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def operation(**kwargs):
+            if name.startswith(self.READ_ONLY_PREFIXES):
+                key = (name, repr(sorted(kwargs.items())))
+                return self._single_flight.do(key, lambda: self.call(name, attribute, kwargs))
+            return self.call(name, attribute, kwargs)
+
+        return operation
+
+    def get_paginator(self, name: str):
+        if name not in self.PAGE_TOKENS:
+            return self.client.get_paginator(name)
+        return Paginator(self, name, self.PAGE_TOKENS[name])
+
+    def get_waiter(self, name: str):
+        return Waiter(self, name, self.client.get_waiter(name))
+
+    def call(self, name: str, method, kwargs: dict):
+        """Makes the api call, retrying with jittered exponential backoff if it is throttled"""
+        attempt: int = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return method(**kwargs)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= self.max_retries:
+                    raise
+                metrics.AWS_API_THROTTLES.labels(name).inc()
+                delay: float = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(name, "throttled, retrying in", round(delay, 3), "seconds")
+                sleep(delay)
+                attempt += 1
+
+class Paginator():
+    """Paginator of an AWSClient operation; every page is fetched with a call of the operation through the AWSClient"""
+
+    def __init__(self, client: AWSClient, name: str, token_key: str):
+        self.client: AWSClient = client
+        self.name: str = name
+        self.token_key: str = token_key
+
+    def paginate(self, **kwargs):
+        while True:
+            page: dict = getattr(self.client, self.name)(**kwargs)
+            yield page
+            token: str = page.get(self.token_key)
+            if not token:
+                return
+            kwargs = dict(kwargs, **{self.token_key: token})
+
+class Waiter():
+    """Waiter of an AWSClient; the wait is made as a call through the AWSClient (see AWSClient.call)"""
+
+    def __init__(self, client: AWSClient, name: str, waiter):
+        self.client: AWSClient = client
+        self.name: str = name
+        self.waiter = waiter
+
+    def wait(self, **kwargs) -> None:
+        self.client.call(self.name, self.waiter.wait, kwargs)
+
+_wrappers: dict = {} # id of the boto3 client -> AWSClient
+_wrappers_lock = Lock()
+
+def wrap_client(client) -> AWSClient:
+    """Returns the AWSClient wrapping the given boto3 client (one per client, so the rate limit is shared by all callers)"""
+    if isinstance(client, AWSClient):
+        return client
+    with _wrappers_lock:
+        wrapper: AWSClient = _wrappers.get(id(client))
+        if wrapper is None or wrapper.client is not client:
+            wrapper = AWSClient(client)
+            _wrappers[id(client)] = wrapper
+        return wrapper
+
+_default_clients: dict = {} # (service, region) -> boto3 client
+_default_clients_lock = Lock()
+
+def default_client(service: str, region: str = None):
+    """
+    Returns the boto3 client of the given service in the given region (settings.AWS_REGION by default), created on first use.
+    Importing boto3 and creating a client takes hundreds of milliseconds, which would otherwise delay the start of every process of the manager app.
+    """
+    key: tuple = (service, region or settings.AWS_REGION)
+    with _default_clients_lock:
+        client = _default_clients.get(key)
+        if client is None:
+            import boto3
+            client = boto3.client(service, region_name=key[1])
+            _default_clients[key] = client
+        return client
+
+def get_ecs_client(region: str = None) -> AWSClient:
+    """Returns the wrapped ECS client of the given region; settings.ECS_CLIENT (if set) is the client of settings.AWS_REGION, the default region"""
+    if settings.ECS_CLIENT is not None and region in (None, settings.AWS_REGION):
+        return wrap_client(settings.ECS_CLIENT)
+    return wrap_client(default_client('ecs', region))
+
+def get_ec2_client(region: str = None) -> AWSClient:
+    """Returns the wrapped EC2 client of the given region; settings.EC2_CLIENT (if set) is the client of settings.AWS_REGION, the default region"""
+    if settings.EC2_CLIENT is not None and region in (None, settings.AWS_REGION):
+        return wrap_client(settings.EC2_CLIENT)
+    return wrap_client(default_client('ec2', region))
@@ -1,8 +1,12 @@
 """
 This module has functions to perform certain AWS operations (required by our app) using boto3
 Note: There is no exception handling done by the module functions. Exceptions must be handled by the calling functions.
+The functions which don't take a client use the wrapped clients (see aws_client) of the given pool.
 """
 from django.conf import settings
+from .aws_client import TTLCache
+from .metrics import aws_call
+from .pools import Pool, get_default_pool
 
 # uncomment if running this separately (probably if MAIN)
 # ecs_client = boto3.client("ecs", region_name = "ap-south-1")
@@ -11,25 +15,55 @@ from django.conf import settings
 
 # all these functions throw exceptions if something is off and don't handle any unexpected paramters or api responses
 
-def running_task_waiter(task_arn: str, ecs_client) -> None:
+# Describe results which don't change while an instance is running are cached, so lookups of known instances make no api calls
+container_instance_ec2_ids = TTLCache(settings.AWS_CACHE_TTL) # container instance arn -> ec2 id
+instance_ips = TTLCache(settings.AWS_CACHE_TTL) # ec2 id -> public ip
+
+def invalidate_instance(ec2_id: str) -> None:
+    """Drops the cached details of the specified EC2 instance"""
+    instance_ips.invalidate(ec2_id)
+    container_instance_ec2_ids.invalidate_values(ec2_id)
+
+def clear_caches() -> None:
+    container_instance_ec2_ids.clear()
+    instance_ips.clear()
+
+def cluster_kwargs(cluster: str) -> dict:
+    """Returns the cluster argument of an ECS api call (none for the default cluster)"""
+    return {'cluster': cluster} if cluster else {}
+
+def running_task_waiter(task_arn: str, ecs_client, cluster: str = None) -> None:
     """Waits for the specified task to start running"""
     task_waiter = ecs_client.get_waiter('tasks_running')
     # wait till task status = 'RUNNING'
     task_waiter.wait(
-        # DEFAULT_CLUSTER
+        **cluster_kwargs(cluster),
         tasks=[
             task_arn,
         ]
     )
 
-def get_task_description(task_arn: str, ecs_client) -> dict:
+# Max number of resources that can be described in a single call
+DESCRIBE_TASKS_BATCH_SIZE = 100
+DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE = 100
+DESCRIBE_INSTANCES_BATCH_SIZE = 1000
+# Max length of a placement constraint expression
+PLACEMENT_EXPRESSION_MAX_LENGTH = 2000
+
+def _batches(items: list, batch_size: int):
+    """Yields consecutive slices of items with at most batch_size elements each"""
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+def get_task_description(task_arn: str, ecs_client, cluster: str = None) -> dict:
     """Returns description of the specified task"""
-    task_description = ecs_client.describe_tasks(
-        # DEFAULT_CLUSTER
-        tasks=[
-            task_arn,
-        ]
-    )['tasks'][0]
+    with aws_call('describe_tasks'):
+        task_description = ecs_client.describe_tasks(
+            **cluster_kwargs(cluster),
+            tasks=[
+                task_arn,
+            ]
+        )['tasks'][0]
     return task_description
 
 def get_exposed_port(task_description: dict) -> str:
@@ -38,85 +72,295 @@ def get_exposed_port(task_description: dict) -> str:
     port: str = str(network_binding['hostPort'])
     return port
 
-def get_ec2_id(task_description: dict, ecs_client) -> str:
+def get_ec2_id(task_description: dict, ecs_client, cluster: str = None) -> str:
     """Returns ec2 id of the instance on which task is running"""
     container_instance_arn = task_description['containerInstanceArn']
-    container_description = ecs_client.describe_container_instances(
-        # DEFAULT_CLUSTER
-        containerInstances=[
-            container_instance_arn,
-        ]
-    )['containerInstances'][0]
-    ec2_id: str = container_description['ec2InstanceId'] # Extract ec2 id 
+    ec2_id: str = container_instance_ec2_ids.get(container_instance_arn)
+    if ec2_id is not None:
+        return ec2_id
+    with aws_call('describe_container_instances'):
+        container_description = ecs_client.describe_container_instances(
+            **cluster_kwargs(cluster),
+            containerInstances=[
+                container_instance_arn,
+            ]
+        )['containerInstances'][0]
+    ec2_id = container_description['ec2InstanceId'] # Extract ec2 id 
+    container_instance_ec2_ids.set(container_instance_arn, ec2_id)
     return ec2_id
 
 def get_ip(ec2_id: str, ec2_client) -> str:
     """Returns the Public IP address of the EC2 instance"""
-    ec2_instance_description = ec2_client.describe_instances(
-        InstanceIds=[
-            ec2_id,
-        ]
-    )['Reservations'][0]['Instances'][0]
-    ip: str = str(ec2_instance_description['PublicIpAddress'])
+    ip: str = instance_ips.get(ec2_id)
+    if ip is not None:
+        return ip
+    with aws_call('describe_instances'):
+        ec2_instance_description = ec2_client.describe_instances(
+            InstanceIds=[
+                ec2_id,
+            ]
+        )['Reservations'][0]['Instances'][0]
+    ip = str(ec2_instance_description['PublicIpAddress'])
+    instance_ips.set(ec2_id, ip)
     return ip
     
-def launch_task(task_definition: str) -> str:
-    """Inititates a task in a distinct ECS instance and returns the task arn"""
-    ecs_client = settings.ECS_CLIENT
-    response = ecs_client.run_task(
-        taskDefinition=task_definition,
-        launchType='EC2',
-        # DEFAULT_CLUSTER
-        placementConstraints=[
-            {
-                "type": "distinctInstance" # The distinctInstance constraint places each task in the group on a different instance. It can be specified with the following actions: CreateService, UpdateService, and RunTask
-            }
-        ],
-        count=1
-    )
+def describe_tasks(task_arns: list, ecs_client, cluster: str = None) -> list:
+    """Returns descriptions of the specified tasks using one describe_tasks call per DESCRIBE_TASKS_BATCH_SIZE tasks"""
+    task_descriptions: list = []
+    for batch in _batches(task_arns, DESCRIBE_TASKS_BATCH_SIZE):
+        with aws_call('describe_tasks'):
+            response = ecs_client.describe_tasks(
+                **cluster_kwargs(cluster),
+                tasks=batch
+            )
+        for failure in response.get('failures', []):
+            print("Unable to describe task", failure.get('arn'), "due to", failure.get('reason'))
+        task_descriptions += response['tasks']
+    return task_descriptions
+
+def get_ec2_ids(container_instance_arns: list, ecs_client, cluster: str = None) -> dict:
+    """Returns a dict mapping each of the specified container instance arns to the ec2 id of the instance; only the ones not cached are described"""
+    ec2_ids: dict = {}
+    missing: list = []
+    for arn in container_instance_arns:
+        ec2_id = container_instance_ec2_ids.get(arn)
+        if ec2_id is None:
+            missing.append(arn)
+        else:
+            ec2_ids[arn] = ec2_id
+    for batch in _batches(missing, DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE):
+        with aws_call('describe_container_instances'):
+            container_descriptions = ecs_client.describe_container_instances(
+                **cluster_kwargs(cluster),
+                containerInstances=batch
+            )['containerInstances']
+        for container_description in container_descriptions:
+            ec2_ids[container_description['containerInstanceArn']] = container_description['ec2InstanceId']
+            container_instance_ec2_ids.set(container_description['containerInstanceArn'], container_description['ec2InstanceId'])
+    return ec2_ids
+
+def get_ips(ec2_ids: list, ec2_client) -> dict:
+    """Returns a dict mapping each of the specified EC2 instances to its Public IP address; only the ones not cached are described"""
+    ips: dict = {}
+    missing: list = []
+    for ec2_id in ec2_ids:
+        ip = instance_ips.get(ec2_id)
+        if ip is None:
+            missing.append(ec2_id)
+        else:
+            ips[ec2_id] = ip
+    for batch in _batches(missing, DESCRIBE_INSTANCES_BATCH_SIZE):
+        with aws_call('describe_instances'):
+            reservations = ec2_client.describe_instances(InstanceIds=batch)['Reservations']
+        for reservation in reservations:
+            for instance in reservation['Instances']:
+                if 'PublicIpAddress' in instance:
+                    ips[instance['InstanceId']] = str(instance['PublicIpAddress'])
+                    instance_ips.set(instance['InstanceId'], ips[instance['InstanceId']])
+    return ips
+
+def discover_servers(task_arns: list, ecs_client, ec2_client, cluster: str = None) -> list:
+    """
+    Returns details of the specified tasks as a list of dicts with keys 'task_arn', 'ec2_id' and 'address', using batched api calls.
+    Tasks which aren't RUNNING yet are waited for, and tasks which can't be described are left out.
+    """
+    task_descriptions: list = describe_tasks(task_arns, ecs_client, cluster)
+
+    pending_task_arns: list = [t['taskArn'] for t in task_descriptions if t['lastStatus'] != 'RUNNING']
+    if len(pending_task_arns) > 0:
+        for batch in _batches(pending_task_arns, DESCRIBE_TASKS_BATCH_SIZE):
+            ecs_client.get_waiter('tasks_running').wait(
+                **cluster_kwargs(cluster),
+                tasks=batch
+            )
+        task_descriptions = [t for t in task_descriptions if t['lastStatus'] == 'RUNNING']
+        task_descriptions += describe_tasks(pending_task_arns, ecs_client, cluster)
+
+    container_instance_arns: list = list({t['containerInstanceArn'] for t in task_descriptions})
+    ec2_ids: dict = get_ec2_ids(container_instance_arns, ecs_client, cluster) if container_instance_arns else {}
+    ips: dict = get_ips(list(set(ec2_ids.values())), ec2_client) if ec2_ids else {}
+
+    servers: list = []
+    for task_description in task_descriptions:
+        ec2_id = ec2_ids.get(task_description['containerInstanceArn'])
+        if ec2_id not in ips:
+            print("Unable to find address of task", task_description['taskArn'])
+            continue
+        servers.append({
+            'task_arn': task_description['taskArn'],
+            'ec2_id': ec2_id,
+            'address': ips[ec2_id] + ":" + get_exposed_port(task_description),
+        })
+    return servers
+
+def launch_task(task_definition: str, ec2_id: str = None, pool: Pool = None) -> str:
+    """
+    Inititates a task in a distinct ECS instance and returns the task arn
+    If ec2_id is given, the task is placed on that instance (so it can't take an instance of the warm pool or of another launch)
+    """
+    pool = pool or get_default_pool()
+    ecs_client = pool.ecs_client()
+    placement_constraints: list = [
+        {
+            "type": "distinctInstance" # The distinctInstance constraint places each task in the group on a different instance. It can be specified with the following actions: CreateService, UpdateService, and RunTask
+        }
+    ]
+    if ec2_id is not None:
+        placement_constraints.append({"type": "memberOf", "expression": "ec2InstanceId == " + ec2_id})
+    with aws_call('run_task'):
+        response = ecs_client.run_task(
+            taskDefinition=task_definition,
+            launchType='EC2',
+            **cluster_kwargs(pool.cluster),
+            placementConstraints=placement_constraints,
+            count=1
+        )
     task_arn = response['tasks'][0]["taskArn"]
     return task_arn
 
-def get_tasks(task_family: str) -> list:
+def place_task(task_definition: str, pool: Pool = None, exclude_ec2_ids: set = ()) -> dict:
+    """
+    Inititates a task on the fullest registered ECS instance which can fit it (binpack), other than the ones in exclude_ec2_ids (e.g. the ones of the warm pool).
+    Returns the started task's description (with 'taskArn' and 'containerInstanceArn') or None if no instance can fit the task.
+    """
+    pool = pool or get_default_pool()
+    ecs_client = pool.ecs_client()
+    kwargs: dict = {}
+    if exclude_ec2_ids:
+        expression: str = "ec2InstanceId not_in [" + ", ".join("'" + i + "'" for i in sorted(exclude_ec2_ids)) + "]"
+        if len(expression) > PLACEMENT_EXPRESSION_MAX_LENGTH:
+            print("Too many instances to exclude from the task placement")
+            return None
+        kwargs['placementConstraints'] = [{"type": "memberOf", "expression": expression}]
+    with aws_call('run_task'):
+        response = ecs_client.run_task(
+            taskDefinition=task_definition,
+            launchType='EC2',
+            **cluster_kwargs(pool.cluster),
+            placementStrategy=[
+                {"type": "binpack", "field": "memory"},
+                {"type": "binpack", "field": "cpu"},
+            ],
+            count=1,
+            **kwargs
+        )
+    if len(response['tasks']) > 0:
+        return response['tasks'][0]
+    reasons: list = [failure.get('reason', '') for failure in response.get('failures', [])]
+    if all(reason.startswith('RESOURCE:') for reason in reasons):
+        # RESOURCE:CPU, RESOURCE:MEMORY, RESOURCE:PORTS...: no registered instance has room for the task
+        return None
+    raise Exception("Unable to place task due to " + ", ".join(reasons))
+
+def get_tasks(task_family: str, pool: Pool = None) -> list:
     """Returns the list of tasks (arns) of the specified family with desired status = RUNNING"""
-    ecs_client = settings.ECS_CLIENT
-    task_arns = ecs_client.list_tasks(
-        # DEFAULT_CLUSTER
-        family=task_family,
-        desiredStatus='RUNNING'
-    )['taskArns']
+    pool = pool or get_default_pool()
+    ecs_client = pool.ecs_client()
+    task_arns: list = []
+    paginator = ecs_client.get_paginator('list_tasks')
+    # Timed as a whole; the pages are fetched one after the other
+    with aws_call('list_tasks'):
+        for page in paginator.paginate(
+            **cluster_kwargs(pool.cluster),
+            family=task_family,
+            desiredStatus='RUNNING'
+        ):
+            task_arns += page['taskArns']
     return task_arns
 
-def stop_task(task_arn: str, reason_to_stop: str = "Not specified"):
+def stop_task(task_arn: str, reason_to_stop: str = "Not specified", pool: Pool = None):
     """Stops the given task"""
-    ecs_client = settings.ECS_CLIENT
-    response = ecs_client.stop_task(
-        # DEFAULT_CLUSTER
-        task=task_arn,
-        reason=reason_to_stop
-    )
+    pool = pool or get_default_pool()
+    ecs_client = pool.ecs_client()
+    with aws_call('stop_task'):
+        response = ecs_client.stop_task(
+            **cluster_kwargs(pool.cluster),
+            task=task_arn,
+            reason=reason_to_stop
+        )
     
-def launch_ecs_instance() -> None:
-    """Launches an ECS instance and waits for its status to be OK"""
-    # DEFAULT_CLUSTER: Refer to user data section of https://docs.aws.amazon.com/AmazonECS/latest/developerguide/launch_container_instance.html#linux-liw-advanced-details for additional steps required to use a different cluster
-    ec2_client = settings.EC2_CLIENT
-    response = ec2_client.run_instances(
-        MaxCount=1,
-        MinCount=1,
-        LaunchTemplate={
-            'LaunchTemplateName': settings.ECS_INSTANCE_LAUNCH_TEMPLATE,
-        }
-    )
+def launch_ecs_instance(tags: dict = None, pool: Pool = None) -> str:
+    """Launches an ECS instance (with the given tags) from the launch template of the pool, waits for its status to be OK and returns its ec2 id"""
+    id = run_ecs_instance(tags, pool)
+    wait_for_instance(id, pool)
+    return id
+
+def run_ecs_instance(tags: dict = None, pool: Pool = None) -> str:
+    """Launches an ECS instance (with the given tags) from the launch template of the pool and returns its ec2 id without waiting for it (see wait_for_instance)"""
+    # The launch template registers the instance to the cluster of the pool: refer to user data section of https://docs.aws.amazon.com/AmazonECS/latest/developerguide/launch_container_instance.html#linux-liw-advanced-details for the steps required to use a cluster other than the default one
+    pool = pool or get_default_pool()
+    ec2_client = pool.ec2_client()
+    kwargs: dict = {}
+    if tags:
+        kwargs['TagSpecifications'] = [{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        }]
+    with aws_call('run_instances'):
+        response = ec2_client.run_instances(
+            MaxCount=1,
+            MinCount=1,
+            LaunchTemplate={
+                'LaunchTemplateName': pool.launch_template,
+            },
+            **kwargs
+        )
     # print(response)
     id = response['Instances'][0]['InstanceId']
+    invalidate_instance(id)
+    return id
+
+def wait_for_instance(id: str, pool: Pool = None) -> None:
+    """Waits for the status of the specified EC2 instance to be OK"""
+    pool = pool or get_default_pool()
+    pool.ec2_client().get_waiter('instance_status_ok').wait(InstanceIds=[id,])
+    print("ECS instance launched in pool", pool.name)
+
+def start_ec2(id: str, pool: Pool = None) -> None:
+    """Starts the specified (stopped) EC2 instance and waits for its status to be OK"""
+    ec2_client = (pool or get_default_pool()).ec2_client()
+    with aws_call('start_instances'):
+        ec2_client.start_instances(InstanceIds=[id,])
+    # The public ip of an instance changes when it is stopped and started
+    invalidate_instance(id)
     ec2_client.get_waiter('instance_status_ok').wait(InstanceIds=[id,])
-    print("ECS instance launched in default cluster")
-    return
+    print("EC2 instance ", id, " started")
+
+def stop_ec2(id: str, pool: Pool = None) -> None:
+    """Stops the specified EC2 instance and waits for it to be stopped"""
+    ec2_client = (pool or get_default_pool()).ec2_client()
+    with aws_call('stop_instances'):
+        ec2_client.stop_instances(InstanceIds=[id,])
+    invalidate_instance(id)
+    ec2_client.get_waiter('instance_stopped').wait(InstanceIds=[id,])
+    print("EC2 instance ", id, " stopped")
+
+def get_tagged_instances(tag_key: str, tag_value: str = None, pool: Pool = None) -> dict:
+    """Returns a dict mapping the ec2 id of every running or stopped instance with the given tag (and tag value, if given) to its state ('running' or 'stopped')"""
+    ec2_client = (pool or get_default_pool()).ec2_client()
+    filters: list = [
+        {'Name': 'tag-key', 'Values': [tag_key]},
+        {'Name': 'instance-state-name', 'Values': ['running', 'stopped']},
+    ]
+    if tag_value is not None:
+        filters.append({'Name': 'tag:' + tag_key, 'Values': [tag_value]})
+    instances: dict = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    with aws_call('describe_instances'):
+        for page in paginator.paginate(
+            Filters=filters
+        ):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance['State']['Name']
+    return instances
 
-def terminate_ec2(id: str) -> None:
+def terminate_ec2(id: str, pool: Pool = None) -> None:
     """Terminates the specified EC2 instance"""
-    ec2_client = settings.EC2_CLIENT
-    response = ec2_client.terminate_instances(InstanceIds=[id,])
+    ec2_client = (pool or get_default_pool()).ec2_client()
+    with aws_call('terminate_instances'):
+        response = ec2_client.terminate_instances(InstanceIds=[id,])
+    invalidate_instance(id)
     # print(response)
     print("EC2 instance ", id, " terminated")
     return
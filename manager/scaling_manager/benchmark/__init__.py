@@ -0,0 +1 @@
+"""Benchmark harness for the manager app on a fake ECS/EC2 and fake gameservers, run with `python manage.py benchmark` (and the scaling policy simulator, run with `python manage.py simulate`)"""
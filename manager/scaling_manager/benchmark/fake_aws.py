@@ -0,0 +1,354 @@
+"""This module has an in-process stand-in (FakeCloud) for the ECS and EC2 clients used by aws_utils, with configurable api latency and launch delays"""
+
+from collections import Counter
+from itertools import count
+from threading import RLock
+from time import monotonic, sleep
+from .fake_gameservers import FakeGameserverPool, constant
+
+class FakeAWSError(Exception):
+    """Raised by the fake clients where the real ones would raise a ClientError"""
+
+class FakeCloud():
+    """
+    State of the fake ECS cluster and EC2 instances, shared by a FakeECSClient (ecs) and a FakeEC2Client (ec2).
+
+    Attributes:
+    * api_latency: time (in seconds) every api call takes
+    * launch_delay: time (in seconds) an EC2 instance takes from run_instances to status OK
+    * start_delay: time (in seconds) a stopped EC2 instance takes from start_instances to status OK
+    * tasks_per_instance: number of gameserver tasks whose cpu and memory fit on an instance
+    * task_start_delay: time (in seconds) a task takes from run_task to RUNNING
+    * gameservers: FakeGameserverPool serving the health api of the tasks (None to not serve it)
+    * capacity_curve: capacity curve of the fake gameservers of newly started tasks
+    * instances: dict mapping ec2 id to the instance record
+    * tasks: dict mapping task arn to the task record
+    * calls: Counter of api calls by operation name
+    """
+
+    def __init__(self, api_latency: float = 0.0, launch_delay: float = 0.0, task_start_delay: float = 0.0,
+                 gameservers: FakeGameserverPool = None, capacity_curve=None, start_delay: float = 0.0, tasks_per_instance: int = 1):
+        self.api_latency: float = api_latency
+        self.tasks_per_instance: int = tasks_per_instance
+        self.launch_delay: float = launch_delay
+        self.start_delay: float = start_delay
+        self.task_start_delay: float = task_start_delay
+        self.gameservers: FakeGameserverPool = gameservers
+        self.capacity_curve = capacity_curve or constant(0)
+
+        self.instances: dict = {}
+        self.tasks: dict = {}
+        self.calls = Counter()
+        self.lock = RLock()
+        self._ids = count(1)
+        self._ports = count(20000) # used if gameservers aren't served
+
+        self.ecs = FakeECSClient(self)
+        self.ec2 = FakeEC2Client(self)
+
+    def call(self, operation: str) -> None:
+        """Records an api call and waits for the api latency"""
+        with self.lock:
+            self.calls[operation] += 1
+        if self.api_latency > 0:
+            sleep(self.api_latency)
+
+    def new_instance(self, ready_at: float, tags: dict = None) -> dict:
+        with self.lock:
+            i = next(self._ids)
+            instance = {
+                'InstanceId': "i-%08x" % i,
+                'PublicIpAddress': "127.0.0.1",
+                'ContainerInstanceArn': "arn:aws:ecs:fake:container-instance/%d" % i,
+                'State': 'running',
+                'ready_at': ready_at,
+                'launched_at': monotonic(),
+                'terminated_at': None,
+                'task_arns': set(),
+                'tags': dict(tags or {}),
+            }
+            self.instances[instance['InstanceId']] = instance
+            return instance
+
+    def new_task(self, instance: dict, family: str, ready_at: float) -> dict:
+        with self.lock:
+            if self.gameservers is not None:
+                port: int = self.gameservers.start_server(self.capacity_curve)
+            else:
+                port = next(self._ports)
+            task = {
+                'taskArn': "arn:aws:ecs:fake:task/%d" % next(self._ids),
+                'family': family,
+                'containerInstanceArn': instance['ContainerInstanceArn'],
+                'ec2_id': instance['InstanceId'],
+                'hostPort': port,
+                'desiredStatus': 'RUNNING',
+                'ready_at': ready_at,
+            }
+            self.tasks[task['taskArn']] = task
+            instance['task_arns'].add(task['taskArn'])
+            return task
+
+    def add_running_servers(self, n: int, family: str = 'LaunchGameserver') -> list:
+        """Adds n instances, each running a task of the given family, and returns the task arns"""
+        now = monotonic()
+        return [self.new_task(self.new_instance(now), family, now)['taskArn'] for _ in range(n)]
+
+    def stop_task(self, task_arn: str) -> None:
+        with self.lock:
+            task = self.tasks.get(task_arn)
+            if task is None or task['desiredStatus'] == 'STOPPED':
+                return
+            task['desiredStatus'] = 'STOPPED'
+            instance = self.instances.get(task['ec2_id'])
+            if instance is not None:
+                instance['task_arns'].discard(task_arn)
+            if self.gameservers is not None:
+                self.gameservers.stop_server(task['hostPort'])
+
+    def running_tasks(self) -> list:
+        with self.lock:
+            return [t for t in self.tasks.values() if t['desiredStatus'] == 'RUNNING']
+
+    def running_instances(self) -> list:
+        with self.lock:
+            return [i for i in self.instances.values() if i['State'] == 'running']
+
+    def instance_seconds(self, now: float = None) -> float:
+        """Returns the time (in seconds) the instances have been up for (from launch until termination), summed over the instances"""
+        now = monotonic() if now is None else now
+        with self.lock:
+            return sum(
+                (i['terminated_at'] if i['terminated_at'] is not None else now) - i['launched_at']
+                for i in self.instances.values()
+            )
+
+    def task_description(self, task: dict) -> dict:
+        running: bool = task['desiredStatus'] == 'RUNNING' and monotonic() >= task['ready_at']
+        return {
+            'taskArn': task['taskArn'],
+            'containerInstanceArn': task['containerInstanceArn'],
+            'lastStatus': 'RUNNING' if running else ('STOPPED' if task['desiredStatus'] == 'STOPPED' else 'PENDING'),
+            'desiredStatus': task['desiredStatus'],
+            'containers': [{'networkBindings': [{'hostPort': task['hostPort']}]}],
+        }
+
+    @staticmethod
+    def wait_until(ready_at: float) -> None:
+        delay = ready_at - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+class FakePaginator():
+    def __init__(self, method, key: str):
+        self.method = method
+        self.key: str = key
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.method(nextToken=token, **kwargs) if token else self.method(**kwargs)
+            yield page
+            token = page.get('nextToken')
+            if not token:
+                return
+
+class FakeWaiter():
+    def __init__(self, wait):
+        self.wait = wait
+
+class FakeECSClient():
+    """Stand-in for the boto3 ECS client (only the operations used by aws_utils)"""
+
+    PAGE_SIZE = 100
+
+    def __init__(self, cloud: FakeCloud):
+        self.cloud: FakeCloud = cloud
+
+    def get_paginator(self, operation: str) -> FakePaginator:
+        if operation == 'list_tasks':
+            return FakePaginator(self.list_tasks, 'taskArns')
+        raise FakeAWSError("No fake paginator for " + operation)
+
+    def get_waiter(self, name: str) -> FakeWaiter:
+        if name == 'tasks_running':
+            return FakeWaiter(self._wait_tasks_running)
+        raise FakeAWSError("No fake waiter for " + name)
+
+    def _wait_tasks_running(self, tasks: list, **kwargs) -> None:
+        self.cloud.call('describe_tasks')
+        for task_arn in tasks:
+            task = self.cloud.tasks.get(task_arn)
+            if task is None or task['desiredStatus'] != 'RUNNING':
+                raise FakeAWSError("Waiter TasksRunning failed: task " + task_arn + " is not running")
+            self.cloud.wait_until(task['ready_at'])
+
+    def list_tasks(self, family: str = None, desiredStatus: str = 'RUNNING', nextToken: str = None, **kwargs) -> dict:
+        self.cloud.call('list_tasks')
+        task_arns = sorted(
+            t['taskArn'] for t in self.cloud.running_tasks()
+            if (family is None or t['family'] == family) and t['desiredStatus'] == desiredStatus
+        )
+        start = int(nextToken or 0)
+        page = {'taskArns': task_arns[start:start + self.PAGE_SIZE]}
+        if start + self.PAGE_SIZE < len(task_arns):
+            page['nextToken'] = str(start + self.PAGE_SIZE)
+        return page
+
+    def describe_tasks(self, tasks: list, **kwargs) -> dict:
+        self.cloud.call('describe_tasks')
+        if len(tasks) > 100:
+            raise FakeAWSError("describe_tasks accepts at most 100 tasks")
+        descriptions, failures = [], []
+        for task_arn in tasks:
+            task = self.cloud.tasks.get(task_arn)
+            if task is None:
+                failures.append({'arn': task_arn, 'reason': 'MISSING'})
+            else:
+                descriptions.append(self.cloud.task_description(task))
+        return {'tasks': descriptions, 'failures': failures}
+
+    def describe_container_instances(self, containerInstances: list, **kwargs) -> dict:
+        self.cloud.call('describe_container_instances')
+        if len(containerInstances) > 100:
+            raise FakeAWSError("describe_container_instances accepts at most 100 container instances")
+        by_arn: dict = {i['ContainerInstanceArn']: i for i in self.cloud.instances.values()}
+        return {'containerInstances': [
+            {
+                'containerInstanceArn': arn,
+                'ec2InstanceId': by_arn[arn]['InstanceId'],
+                'runningTasksCount': len(by_arn[arn]['task_arns']),
+            }
+            for arn in containerInstances if arn in by_arn
+        ]}
+
+    def run_task(self, taskDefinition: str, count: int = 1, placementConstraints: list = (), placementStrategy: list = (), **kwargs) -> dict:
+        """
+        Places the task on a registered instance with room for it (tasks_per_instance), optionally a given one (memberOf 'ec2InstanceId == <id>') or any but the given ones (memberOf "ec2InstanceId not_in ['<id>', ...]").
+        With the distinctInstance constraint only instances without a task are considered, and with the binpack strategy the fullest instance is chosen.
+        """
+        self.cloud.call('run_task')
+        now = monotonic()
+        member_of: str = None
+        excluded: set = set()
+        distinct: bool = False
+        for constraint in placementConstraints:
+            if constraint['type'] == 'memberOf' and ' not_in ' in constraint['expression']:
+                excluded = {i.strip(" '") for i in constraint['expression'].split('[')[1].rstrip(']').split(',')}
+            elif constraint['type'] == 'memberOf':
+                member_of = constraint['expression'].split('==')[1].strip()
+            elif constraint['type'] == 'distinctInstance':
+                distinct = True
+        with self.cloud.lock:
+            free_instances = [
+                i for i in self.cloud.running_instances()
+                if now >= i['ready_at'] and member_of in (None, i['InstanceId']) and i['InstanceId'] not in excluded
+                and len(i['task_arns']) < (1 if distinct else self.cloud.tasks_per_instance)
+            ]
+            if any(strategy['type'] == 'binpack' for strategy in placementStrategy):
+                free_instances.sort(key=lambda i: len(i['task_arns']), reverse=True)
+            if len(free_instances) < count:
+                return {'tasks': [], 'failures': [{'reason': 'RESOURCE:MEMORY'}]}
+            tasks = [
+                self.cloud.new_task(instance, taskDefinition, now + self.cloud.task_start_delay)
+                for instance in free_instances[:count]
+            ]
+        return {'tasks': [self.cloud.task_description(t) for t in tasks], 'failures': []}
+
+    def stop_task(self, task: str, reason: str = None, **kwargs) -> dict:
+        self.cloud.call('stop_task')
+        self.cloud.stop_task(task)
+        return {'task': self.cloud.task_description(self.cloud.tasks[task])}
+
+class FakeEC2Client():
+    """Stand-in for the boto3 EC2 client (only the operations used by aws_utils)"""
+
+    def __init__(self, cloud: FakeCloud):
+        self.cloud: FakeCloud = cloud
+
+    def get_paginator(self, operation: str) -> FakePaginator:
+        if operation == 'describe_instances':
+            return FakePaginator(self.describe_instances, 'Reservations')
+        raise FakeAWSError("No fake paginator for " + operation)
+
+    def get_waiter(self, name: str) -> FakeWaiter:
+        if name == 'instance_status_ok':
+            return FakeWaiter(self._wait_instance_status_ok)
+        if name == 'instance_stopped':
+            return FakeWaiter(self._wait_instance_stopped)
+        raise FakeAWSError("No fake waiter for " + name)
+
+    def _wait_instance_status_ok(self, InstanceIds: list, **kwargs) -> None:
+        self.cloud.call('describe_instance_status')
+        for ec2_id in InstanceIds:
+            if self.cloud.instances[ec2_id]['State'] != 'running':
+                raise FakeAWSError("Waiter InstanceStatusOk failed: instance " + ec2_id + " is not running")
+            self.cloud.wait_until(self.cloud.instances[ec2_id]['ready_at'])
+
+    def _wait_instance_stopped(self, InstanceIds: list, **kwargs) -> None:
+        # Instances stop right away
+        self.cloud.call('describe_instances')
+
+    def run_instances(self, MinCount: int = 1, MaxCount: int = 1, TagSpecifications: list = (), **kwargs) -> dict:
+        self.cloud.call('run_instances')
+        ready_at = monotonic() + self.cloud.launch_delay
+        tags: dict = {
+            tag['Key']: tag['Value']
+            for spec in TagSpecifications if spec['ResourceType'] == 'instance'
+            for tag in spec['Tags']
+        }
+        instances = [self.cloud.new_instance(ready_at, tags) for _ in range(MaxCount)]
+        return {'Instances': [{'InstanceId': i['InstanceId']} for i in instances]}
+
+    def describe_instances(self, InstanceIds: list = None, Filters: list = (), **kwargs) -> dict:
+        self.cloud.call('describe_instances')
+        with self.cloud.lock:
+            if InstanceIds is not None:
+                instances = [self.cloud.instances[i] for i in InstanceIds if i in self.cloud.instances]
+            else:
+                instances = list(self.cloud.instances.values())
+        for f in Filters:
+            if f['Name'] == 'tag-key':
+                instances = [i for i in instances if any(k in i['tags'] for k in f['Values'])]
+            elif f['Name'] == 'instance-state-name':
+                instances = [i for i in instances if i['State'] in f['Values']]
+            else:
+                raise FakeAWSError("No fake filter " + f['Name'])
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': i['InstanceId'], 'PublicIpAddress': i['PublicIpAddress'], 'State': {'Name': i['State']}}
+            for i in instances
+        ]}]}
+
+    def start_instances(self, InstanceIds: list, **kwargs) -> dict:
+        self.cloud.call('start_instances')
+        with self.cloud.lock:
+            for ec2_id in InstanceIds:
+                instance = self.cloud.instances[ec2_id]
+                if instance['State'] == 'stopped':
+                    instance['State'] = 'running'
+                    instance['ready_at'] = monotonic() + self.cloud.start_delay
+        return {'StartingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def stop_instances(self, InstanceIds: list, **kwargs) -> dict:
+        self.cloud.call('stop_instances')
+        with self.cloud.lock:
+            for ec2_id in InstanceIds:
+                instance = self.cloud.instances[ec2_id]
+                for task_arn in list(instance['task_arns']):
+                    self.cloud.stop_task(task_arn)
+                instance['State'] = 'stopped'
+        return {'StoppingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def terminate_instances(self, InstanceIds: list, **kwargs) -> dict:
+        self.cloud.call('terminate_instances')
+        with self.cloud.lock:
+            for ec2_id in InstanceIds:
+                instance = self.cloud.instances.get(ec2_id)
+                if instance is None:
+                    continue
+                for task_arn in list(instance['task_arns']):
+                    self.cloud.stop_task(task_arn)
+                if instance['State'] != 'terminated':
+                    instance['terminated_at'] = monotonic()
+                instance['State'] = 'terminated'
+        return {'TerminatingInstances': [{'InstanceId': i} for i in InstanceIds]}
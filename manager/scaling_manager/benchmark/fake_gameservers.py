@@ -0,0 +1,131 @@
+"""This module has the FakeGameserverPool class which serves the health api of many fake gameservers locally, along with a few scripted capacity curves"""
+
+import asyncio
+import json
+from threading import Thread
+from time import monotonic
+
+# Capacity curves map the time (in seconds) since the epoch of the pool to the available capacity reported by a fake gameserver
+
+def constant(capacity: int):
+    """Always reports the same capacity"""
+    return lambda t: capacity
+
+def step(before: int, after: int, at: float):
+    """Reports before until time at, and after from then on (e.g. a sudden burst of players)"""
+    return lambda t: before if t < at else after
+
+def ramp(start: int, end: int, duration: float):
+    """Moves linearly from start to end over duration seconds and stays at end"""
+    return lambda t: int(start + (end - start) * min(max(t / duration, 0), 1)) if duration > 0 else end
+
+class FakeGameserver():
+    """
+    State of a fake gameserver
+
+    Attributes:
+    * port: port of the health api on 127.0.0.1
+    * capacity_curve: capacity curve of the fake gameserver
+    * ready_to_close: boolean flag reported by the health api
+    * requests: number of health api requests served
+    """
+
+    def __init__(self, capacity_curve):
+        self.port: int = None
+        self.capacity_curve = capacity_curve
+        self.ready_to_close: bool = False
+        self.requests: int = 0
+        self.listener: asyncio.AbstractServer = None
+        self.connections: set = set() # writers of the open connections
+
+    def close(self) -> None:
+        """Stops accepting connections and drops the open ones (must run on the event loop)"""
+        self.listener.close()
+        for writer in list(self.connections):
+            writer.close()
+
+class FakeGameserverPool():
+    """
+    Serves the health api of many fake gameservers, each on its own port of 127.0.0.1, from a single asyncio event loop running on a background thread.
+
+    Attributes:
+    * gameservers: dict mapping port to FakeGameserver
+    * epoch: monotonic time (in seconds) capacity curves are evaluated relative to
+    """
+
+    def __init__(self):
+        self.gameservers: dict = {}
+        self.epoch: float = monotonic()
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self.loop.run_forever, name='fake-gameservers', daemon=True)
+        self._thread.start()
+
+    def reset_epoch(self) -> None:
+        """Restarts the capacity curves from time 0"""
+        self.epoch = monotonic()
+
+    def start_server(self, capacity_curve) -> int:
+        """Starts a fake gameserver with the given capacity curve and returns its port"""
+        gameserver = FakeGameserver(capacity_curve)
+        listener = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(lambda r, w: self._serve(gameserver, r, w), '127.0.0.1', 0),
+            self.loop
+        ).result()
+        gameserver.listener = listener
+        gameserver.port = listener.sockets[0].getsockname()[1]
+        self.gameservers[gameserver.port] = gameserver
+        return gameserver.port
+
+    def stop_server(self, port: int) -> None:
+        """Stops the fake gameserver on the given port; its health api stops responding"""
+        gameserver = self.gameservers.pop(port, None)
+        if gameserver is not None:
+            self.loop.call_soon_threadsafe(gameserver.close)
+
+    def set_curve(self, capacity_curve, ports: list = None) -> None:
+        """Sets the capacity curve of the given fake gameservers (all by default)"""
+        for port in (self.gameservers if ports is None else ports):
+            self.gameservers[port].capacity_curve = capacity_curve
+
+    def close(self) -> None:
+        """Stops all fake gameservers and the event loop"""
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _shutdown(self) -> None:
+        for gameserver in self.gameservers.values():
+            gameserver.close()
+        self.gameservers.clear()
+        # Closed connections end their handlers; only the ones that don't notice in time are cancelled
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=1.0)
+            for task in pending:
+                task.cancel()
+
+    def _state(self, gameserver: FakeGameserver) -> bytes:
+        capacity: int = gameserver.capacity_curve(monotonic() - self.epoch)
+        return json.dumps({'available_capacity': capacity, 'ready_to_close': gameserver.ready_to_close}).encode()
+
+    async def _serve(self, gameserver: FakeGameserver, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answers every request on the connection with the health state until the client closes it"""
+        gameserver.connections.add(writer)
+        try:
+            while True:
+                request: bytes = await reader.readuntil(b"\r\n\r\n")
+                if not request:
+                    break
+                gameserver.requests += 1
+                body: bytes = self._state(gameserver)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                    + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            gameserver.connections.discard(writer)
+            writer.close()
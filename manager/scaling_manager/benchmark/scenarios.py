@@ -0,0 +1,332 @@
+"""This module has the benchmark scenarios; each one builds a fleet on a FakeCloud, runs the real ServerManagerThread against it and returns its measurements as a dict"""
+
+import asyncio
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from threading import Thread
+from time import monotonic, perf_counter_ns, sleep
+from django.test import Client, override_settings
+from ..admission import Saturated
+from ..aws_utils import clear_caches
+from ..capacity_index import CapacityIndex
+from ..server_classes import ServerManagerThread
+from .fake_aws import FakeCloud
+from .fake_gameservers import FakeGameserverPool, constant
+
+SERVER_CAPACITY = 10
+
+def percentile(samples: list, p: float) -> float:
+    """Returns the p-th percentile (0-100) of the samples using the nearest rank"""
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+def latency_summary(samples_ns: list) -> dict:
+    """Returns p50/p99/max of latency samples (nanoseconds) in microseconds"""
+    return {
+        'p50_us': percentile(samples_ns, 50) / 1000,
+        'p99_us': percentile(samples_ns, 99) / 1000,
+        'max_us': max(samples_ns) / 1000,
+    }
+
+@contextmanager
+def fleet(size: int, api_latency: float = 0.0, launch_delay: float = 0.0, capacity_curve=None, start_delay: float = 0.0,
+          tasks_per_instance: int = 1, **settings_overrides):
+    """
+    Runs a fleet of size fake gameservers on a FakeCloud and yields (cloud, gameservers, manager) with a fresh ServerManagerThread (not started) discovering it.
+    By default the margins are set such that the fleet is neither upscaled nor downscaled.
+    """
+    gameservers = FakeGameserverPool()
+    cloud = FakeCloud(
+        api_latency=api_latency,
+        launch_delay=launch_delay,
+        start_delay=start_delay,
+        tasks_per_instance=tasks_per_instance,
+        gameservers=gameservers,
+        capacity_curve=capacity_curve or constant(SERVER_CAPACITY),
+    )
+    cloud.add_running_servers(size)
+    overrides = {
+        'ECS_CLIENT': cloud.ecs,
+        'EC2_CLIENT': cloud.ec2,
+        'SERVER_CAPACITY': SERVER_CAPACITY,
+        'UPSCALE_MARGIN': 1,
+        'DOWNSCALE_MARGIN': size * SERVER_CAPACITY + 100,
+        'THREAD_SLEEP_TIME': 0,
+        'SHARED_TABLE': False,
+        'STATE_JOURNAL': False,
+        # Every server is due for a health check on every update, unless a scenario sets the intervals
+        'HEALTH_CHECK_MIN_INTERVAL': 1e-6,
+        'HEALTH_CHECK_MAX_INTERVAL': 1e-6,
+    }
+    overrides.update(settings_overrides)
+    # Instance ids of the fake clouds repeat, so nothing may be carried over from a previous fleet
+    clear_caches()
+    try:
+        with override_settings(**overrides):
+            ServerManagerThread.reset_instance()
+            manager = ServerManagerThread.get_instance()
+            try:
+                yield cloud, gameservers, manager
+            finally:
+                # Launches still in flight must not outlive the fake clients
+                manager.provisioner.shutdown()
+                manager.warm_pool.shutdown()
+    finally:
+        ServerManagerThread.reset_instance()
+        gameservers.close()
+
+def bench_bootstrap(size: int, api_latency: float) -> dict:
+    """Time to discover a running fleet (constructing the ServerManagerThread) and the api calls it takes"""
+    start = monotonic()
+    with fleet(size, api_latency=api_latency) as (cloud, gameservers, manager):
+        return {
+            'duration_s': monotonic() - start,
+            'servers_discovered': len(manager.available_servers),
+            'api_calls': sum(cloud.calls.values()),
+        }
+
+def bench_warm_restart(size: int, api_latency: float) -> dict:
+    """Time to restart from the state journal (constructing the ServerManagerThread) and to reconcile it with AWS in the background"""
+    with tempfile.TemporaryDirectory() as directory:
+        journal_path: str = os.path.join(directory, "server_state.json")
+        with fleet(size, api_latency=api_latency, STATE_JOURNAL=True, STATE_JOURNAL_PATH=journal_path) as (cloud, gameservers, manager):
+            manager.save_state()
+            ServerManagerThread.reset_instance()
+            calls_before: int = sum(cloud.calls.values())
+            start = monotonic()
+            restarted = ServerManagerThread.get_instance()
+            duration: float = monotonic() - start
+            restored: int = len(restarted.available_servers)
+            restarted.reconciliation.join()
+            return {
+                'duration_s': duration,
+                'servers_restored': restored,
+                'reconciliation_s': monotonic() - start,
+                'api_calls': sum(cloud.calls.values()) - calls_before,
+            }
+
+def bench_tick_duration(size: int, api_latency: float, ticks: int = 5) -> dict:
+    """Duration of a routine update of the control loop (health sweep, scaling decision, standby reaping)"""
+    with fleet(size, api_latency=api_latency) as (cloud, gameservers, manager):
+        durations: list = []
+        for _ in range(ticks):
+            start = perf_counter_ns()
+            manager.update()
+            durations.append(perf_counter_ns() - start)
+        return {
+            'ticks': ticks,
+            'mean_ms': sum(durations) / len(durations) / 1e6,
+            'max_ms': max(durations) / 1e6,
+            'total_available_capacity': manager.total_available_capacity,
+        }
+
+def bench_selection_latency(size: int, samples: int = 20000) -> dict:
+    """Latency of selecting (and reserving) a server for a client, for each selection policy and with a game id (affinity)"""
+    results: dict = {}
+    with fleet(size) as (cloud, gameservers, manager):
+        manager.update()
+        for policy in CapacityIndex.POLICIES:
+            manager.selection_policy = policy
+            latencies: list = []
+            for _ in range(samples):
+                start = perf_counter_ns()
+                manager.get_available_server()
+                latencies.append(perf_counter_ns() - start)
+            results[policy] = latency_summary(latencies)
+            # Settle the reservations so that every policy starts from the same capacities
+            for s in manager.available_servers:
+                s.reservations.clear()
+                manager.capacity_index.update(s)
+
+        # Two clients per game; servers are given room for all the games, so this measures routing rather than a saturated ring
+        for s in manager.available_servers:
+            s.reported_capacity = samples
+            manager.capacity_index.update(s)
+        latencies: list = []
+        for i in range(samples):
+            game_id: str = "game-" + str(i // 2)
+            start = perf_counter_ns()
+            manager.get_available_server(game_id)
+            latencies.append(perf_counter_ns() - start)
+        results['affinity'] = latency_summary(latencies)
+    return results
+
+def bench_assignment_throughput(size: int, duration: float = 1.0, threads: int = 4, batch_size: int = 50) -> dict:
+    """
+    Requests/sec of the /available-gameserver/ api through the whole Django stack, from one and from several client threads,
+    and clients assigned per second through the /available-gameserver-batch/ api from one client thread
+    """
+    results: dict = {}
+    with fleet(size) as (cloud, gameservers, manager):
+        manager.update()
+
+        def client_loop(counts: list, index: int, deadline: float) -> None:
+            client = Client()
+            while monotonic() < deadline:
+                client.get('/available-gameserver/')
+                counts[index] += 1
+
+        for n in (1, threads):
+            counts: list = [0] * n
+            deadline = monotonic() + duration
+            workers = [Thread(target=client_loop, args=(counts, i, deadline)) for i in range(n)]
+            start = monotonic()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            results[str(n) + '_thread_rps'] = sum(counts) / (monotonic() - start)
+
+        # Clients assigned per second through the batch api, with batches of batch_size single clients and enough capacity for all of them
+        for s in manager.available_servers:
+            s.reported_capacity = 10 ** 9
+            manager.capacity_index.update(s)
+        client = Client()
+        body: str = json.dumps({'count': batch_size})
+        assigned: int = 0
+        start = monotonic()
+        while monotonic() - start < duration:
+            client.post('/available-gameserver-batch/', body, content_type='application/json')
+            assigned += batch_size
+        results['batch_' + str(batch_size) + '_clients_per_s'] = assigned / (monotonic() - start)
+    return results
+
+def bench_scale_out_reaction(size: int, api_latency: float, launch_delay: float, warm_pool: bool = False, binpack: bool = False,
+                             timeout: float = 60.0) -> dict:
+    """
+    Time from a sudden burst (every gameserver reports zero capacity) until the launched servers restore the upscale margin.
+    With warm_pool set, the launches take stopped instances of a warm pool, and with binpack set, the tasks are packed onto the running instances.
+    """
+    upscale_margin: int = 5 * SERVER_CAPACITY
+    extra_settings: dict = {}
+    if warm_pool:
+        extra_settings.update({'WARM_POOL_MIN_SIZE': 5, 'WARM_POOL_MAX_SIZE': 10, 'WARM_POOL_MODE': 'stopped'})
+    if binpack:
+        extra_settings['PLACEMENT_MODE'] = 'binpack'
+    with fleet(
+        size, api_latency=api_latency, launch_delay=launch_delay, start_delay=launch_delay / 5, tasks_per_instance=2 if binpack else 1,
+        UPSCALE_MARGIN=upscale_margin, SCALE_OUT_MAX_BURST=10, PROVISIONING_WORKERS=10, **extra_settings
+    ) as (cloud, gameservers, manager):
+        manager.update()
+        deadline: float = monotonic() + timeout
+        while len(manager.warm_pool.instances) < manager.warm_pool.min_size and monotonic() < deadline:
+            sleep(0.01)
+        # Existing gameservers fill up, newly launched ones report full capacity
+        gameservers.set_curve(constant(0))
+        start = monotonic()
+        ticks: int = 0
+        first_launch: float = None
+        while monotonic() - start < timeout:
+            manager.update()
+            ticks += 1
+            if first_launch is None and manager.provisioner.in_flight() > 0:
+                first_launch = monotonic() - start
+            if manager.total_available_capacity >= upscale_margin:
+                break
+            sleep(0.01)
+        return {
+            'reaction_s': monotonic() - start,
+            'first_launch_s': first_launch,
+            'recovered': manager.total_available_capacity >= upscale_margin,
+            'ticks': ticks,
+            'servers_launched': len(manager.available_servers) - size,
+        }
+
+def bench_health_check_load(size: int, duration: float = 2.0, min_interval: float = 0.05, max_interval: float = 0.5) -> dict:
+    """
+    Health api requests per server per second made by the adaptive health scheduler over duration seconds, with a tenth of the fleet nearly full and the rest idle.
+    A fixed cadence would have to poll every server at min_interval to keep the nearly full ones as fresh.
+    """
+    with fleet(size, HEALTH_CHECK_MIN_INTERVAL=min_interval, HEALTH_CHECK_MAX_INTERVAL=max_interval) as (cloud, gameservers, manager):
+        hot_ports: list = list(gameservers.gameservers)[:max(1, size // 10)]
+        gameservers.set_curve(constant(0), hot_ports)
+        manager.update()
+        for gameserver in gameservers.gameservers.values():
+            gameserver.requests = 0
+        start = monotonic()
+        while monotonic() - start < duration:
+            next_check: float = manager.get_next_check_time()
+            sleep(max(min(next_check, start + duration) - monotonic(), 0))
+            manager.check_servers()
+        elapsed: float = monotonic() - start
+        hot: list = [gameservers.gameservers[p].requests for p in hot_ports]
+        idle: list = [g.requests for p, g in gameservers.gameservers.items() if p not in hot_ports]
+        total: int = sum(hot) + sum(idle)
+        return {
+            'hot_requests_per_server_s': sum(hot) / len(hot) / elapsed,
+            'idle_requests_per_server_s': sum(idle) / max(len(idle), 1) / elapsed,
+            'requests_per_s': total / elapsed,
+            'fixed_cadence_requests_per_s': size / min_interval,
+        }
+
+def bench_admission_burst(size: int, api_latency: float, launch_delay: float, admission: bool = True, clients: int = 5 * SERVER_CAPACITY,
+                          wait: float = 10.0) -> dict:
+    """
+    Outcome of a burst of clients arriving while every gameserver is full, until the launched servers take them.
+    With admission set (ADMISSION_CONTROL), the clients long-poll for capacity; without it, they are sent to the full gameservers right away (oversubscribed).
+    """
+    with fleet(
+        size, api_latency=api_latency, launch_delay=launch_delay, UPSCALE_MARGIN=clients, SCALE_OUT_MAX_BURST=10, PROVISIONING_WORKERS=10,
+        ADMISSION_CONTROL=admission, ADMISSION_QUEUE_SIZE=clients, ADMISSION_POLL_INTERVAL=0.01
+    ) as (cloud, gameservers, manager):
+        manager.update()
+        # Existing gameservers fill up, newly launched ones report full capacity
+        gameservers.set_curve(constant(0))
+        manager.update()
+        outcomes: dict = {'admitted': 0, 'oversubscribed': 0, 'rejected': 0, 'backup': 0}
+        waits: list = []
+
+        async def client(game_id: str) -> None:
+            start = monotonic()
+            try:
+                if admission:
+                    server = await manager.admit_async(game_id, wait)
+                else:
+                    server = manager.get_available_server(game_id)
+                    if server.available_capacity < 0:
+                        outcomes['oversubscribed'] += 1
+                        return
+                outcomes['admitted'] += 1
+                waits.append(monotonic() - start)
+            except Saturated:
+                outcomes['rejected'] += 1
+            except IndexError:
+                outcomes['backup'] += 1
+
+        async def burst() -> None:
+            await asyncio.gather(*[client(str(i)) for i in range(clients)])
+
+        burst_thread = Thread(target=asyncio.run, args=(burst(),))
+        burst_thread.start()
+        while burst_thread.is_alive():
+            manager.update()
+            sleep(0.01)
+        return dict(outcomes, **{
+            'wait_p50_s': percentile(waits, 50),
+            'wait_max_s': max(waits) if waits else None,
+        })
+
+def run_benchmarks(sizes: list, api_latency: float = 0.005, launch_delay: float = 1.0, duration: float = 1.0) -> dict:
+    """Runs all scenarios for every fleet size and returns the results keyed by size"""
+    results: dict = {}
+    for size in sizes:
+        print("Benchmarking a fleet of", size, "servers")
+        results[str(size)] = {
+            'bootstrap': bench_bootstrap(size, api_latency),
+            'warm_restart': bench_warm_restart(size, api_latency),
+            'tick_duration': bench_tick_duration(size, api_latency),
+            'health_check_load': bench_health_check_load(size),
+            'selection_latency': bench_selection_latency(size),
+            'assignment_throughput': bench_assignment_throughput(size, duration),
+            'scale_out_reaction': bench_scale_out_reaction(size, api_latency, launch_delay),
+            'scale_out_reaction_warm_pool': bench_scale_out_reaction(size, api_latency, launch_delay, warm_pool=True),
+            'scale_out_reaction_binpack': bench_scale_out_reaction(size, api_latency, launch_delay, binpack=True),
+            'admission_burst': bench_admission_burst(size, api_latency, launch_delay),
+            'admission_burst_disabled': bench_admission_burst(size, api_latency, launch_delay, admission=False),
+        }
+    return results
@@ -0,0 +1,381 @@
+"""This module has the scaling policy simulator, which runs the real ServerManagerThread under a virtual clock against simulated gameservers and launches fed by a demand trace, so that days of traffic run in seconds"""
+
+import csv
+import heapq
+import math
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+from django.conf import settings
+from django.test import override_settings
+from .. import affinity, aws_client, forecast, health_scheduler, metrics, provisioning, reservations, scaling_policy, server_classes, warm_pool
+from ..aws_utils import clear_caches
+from ..forecast import SECONDS_PER_DAY, DemandHistory
+from ..provisioning import Launch, Provisioner
+from ..server_classes import Server, ServerManagerThread
+from . import fake_aws
+from .fake_aws import FakeCloud
+
+class VirtualClock():
+    """
+    Simulated time (in seconds) which install() swaps in for the monotonic and wall clock functions the modules of the manager app import; time 0 is a midnight.
+
+    Attributes:
+    * now: current simulated time
+    """
+
+    # (module, name of the clock function it imports)
+    CLOCKS = (
+        (server_classes, 'monotonic'),
+        (provisioning, 'monotonic'),
+        (reservations, 'monotonic'),
+        (scaling_policy, 'monotonic'),
+        (health_scheduler, 'monotonic'),
+        (warm_pool, 'monotonic'),
+        (affinity, 'monotonic'),
+        (aws_client, 'monotonic'),
+        (fake_aws, 'monotonic'),
+        (forecast, 'time'),
+    )
+
+    def __init__(self, start: float = 0.0):
+        self.now: float = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, t: float) -> None:
+        """Moves the clock forward to time t (it never goes back)"""
+        self.now = max(self.now, t)
+
+    @contextmanager
+    def install(self):
+        """Runs its block with the clock in place of the clock functions of the manager app"""
+        saved: list = [(module, name, getattr(module, name)) for module, name in self.CLOCKS]
+        for module, name, _ in saved:
+            setattr(module, name, self)
+        try:
+            yield self
+        finally:
+            for module, name, clock in saved:
+                setattr(module, name, clock)
+
+class DemandTrace():
+    """
+    Arrival rate (clients per second) over time, constant within buckets of bucket_width seconds; the trace repeats once it runs out.
+
+    Attributes:
+    * rates: list of the arrival rate of each bucket
+    * bucket_width: width (in seconds) of a bucket
+    * start: time of the day (in seconds) at which the first bucket starts
+    """
+
+    def __init__(self, rates: list, bucket_width: float, start: float = 0.0):
+        if not rates or bucket_width <= 0:
+            raise ValueError("A demand trace needs at least one bucket of positive width")
+        self.rates: list = list(rates)
+        self.bucket_width: float = bucket_width
+        self.start: float = start
+
+    def _index(self, t: float) -> int:
+        return math.floor((t - self.start) / self.bucket_width)
+
+    def rate(self, t: float) -> float:
+        """Returns the arrival rate at time t"""
+        return self.rates[self._index(t) % len(self.rates)]
+
+    def next_change(self, t: float) -> float:
+        """Returns the time at which the bucket of time t ends"""
+        return self.start + (self._index(t) + 1) * self.bucket_width
+
+    def next_arrival(self, t: float, rng: random.Random, until: float) -> float:
+        """Returns the time of the next arrival after time t of a Poisson process following the trace, or inf if there is none before until"""
+        while t < until:
+            rate: float = self.rate(t)
+            end: float = self.next_change(t)
+            # Arrivals are memoryless, so the draw simply starts over at the end of the bucket
+            if rate > 0:
+                arrival: float = t + rng.expovariate(rate)
+                if arrival < end:
+                    return arrival
+            t = end
+        return math.inf
+
+    @classmethod
+    def daily(cls, peak_rate: float, base_rate: float, peak_hour: float = 20.0, peak_width: float = 2.0, bucket_width: float = 60.0):
+        """Returns a synthetic day: base_rate clients per second, rising to peak_rate around peak_hour (a bell curve with a standard deviation of peak_width hours)"""
+        rates: list = []
+        for i in range(int(SECONDS_PER_DAY // bucket_width)):
+            hour: float = (i + 0.5) * bucket_width / 3600
+            distance: float = min(abs(hour - peak_hour), 24 - abs(hour - peak_hour))
+            rates.append(base_rate + (peak_rate - base_rate) * math.exp(-distance ** 2 / (2 * peak_width ** 2)))
+        return cls(rates, bucket_width)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Returns the trace recorded in the given file:
+        * a demand history written with PREDICTIVE_SCALING (see DemandHistory); buckets missed while the manager app was down carry the previous rate over
+        * a csv file of 'seconds,rate' rows, one per bucket (evenly spaced, the first one at the start of the trace)
+        Raises ValueError if the file can't be read.
+        """
+        if path.endswith('.csv'):
+            with open(path, newline='') as f:
+                rows: list = [(float(row[0]), float(row[1])) for row in csv.reader(f) if row and not row[0].startswith('#')]
+            if len(rows) < 2:
+                raise ValueError("A csv demand trace needs at least two rows")
+            return cls([rate for _, rate in rows], rows[1][0] - rows[0][0], rows[0][0])
+
+        history: DemandHistory = DemandHistory.open(path)
+        samples: list = history.samples() if history is not None else []
+        if not samples:
+            raise ValueError("No demand history could be read from " + path)
+        rates: list = []
+        previous: int = samples[0][0] - 1
+        for bucket, assignments, _, _ in samples:
+            rate: float = assignments / history.bucket_width
+            rates += [rates[-1] if rates else rate] * (bucket - previous - 1)
+            rates.append(rate)
+            previous = bucket
+        return cls(rates, history.bucket_width, samples[0][0] * history.bucket_width % SECONDS_PER_DAY)
+
+class SimulatedFleet():
+    """
+    Model of the gameservers: the clients connected to each one, each of which stays for a session drawn from an exponential distribution.
+    It stands in for the HealthChecker (see check), so that the manager app only learns of arrivals and departures through its health checks, as it would in production.
+
+    Attributes:
+    * server_capacity: number of clients a gameserver can host
+    * session_duration: mean time (in seconds) a client stays connected
+    * rng: random.Random the session durations are drawn from
+    * clients: dict mapping task arn to the number of clients connected to the gameserver
+    * departures: min heap of (time, task arn) of the sessions
+    """
+
+    def __init__(self, server_capacity: int, session_duration: float, rng: random.Random):
+        self.server_capacity: int = server_capacity
+        self.session_duration: float = session_duration
+        self.rng: random.Random = rng
+        self.clients: dict = {}
+        self.departures: list = []
+
+    def connect(self, server: Server, now: float) -> bool:
+        """Connects a client sent to the server. Returns True if the gameserver had room for it and False if it was full (the client is turned away)"""
+        connected: int = self.clients.get(server.task_arn, 0)
+        if connected >= self.server_capacity:
+            return False
+        self.clients[server.task_arn] = connected + 1
+        heapq.heappush(self.departures, (now + self.rng.expovariate(1 / self.session_duration), server.task_arn))
+        return True
+
+    def next_departure(self) -> float:
+        """Returns the time of the next departure, or None if no client is connected"""
+        return self.departures[0][0] if self.departures else None
+
+    def depart(self, now: float) -> list:
+        """Ends the sessions which are over and returns the task arns of their gameservers"""
+        departed: list = []
+        while self.departures and self.departures[0][0] <= now:
+            _, task_arn = heapq.heappop(self.departures)
+            if task_arn in self.clients:
+                self.clients[task_arn] -= 1
+                departed.append(task_arn)
+        return departed
+
+    def free_capacity(self, servers: list) -> int:
+        """Returns the number of clients the given gameservers can still host"""
+        return sum(self.server_capacity - self.clients.get(s.task_arn, 0) for s in servers)
+
+    def check(self, servers: list) -> dict:
+        """Returns the health state of the given gameservers (see HealthChecker.check); a gameserver is ready to close once no client is connected"""
+        results: dict = {}
+        for s in servers:
+            connected: int = self.clients.get(s.task_arn, 0)
+            results[s] = {'available_capacity': self.server_capacity - connected, 'ready_to_close': connected == 0}
+        return results
+
+class SimulatedProvisioner(Provisioner):
+    """
+    Provisioner whose launches take launch_delay seconds (give or take up to launch_jitter of it) of simulated time, at most PROVISIONING_WORKERS at once, and register their instances and tasks with the FakeCloud.
+
+    Attributes:
+    * cloud: FakeCloud the instances and tasks are registered with
+    * launch_delay: mean time (in seconds) a launch takes
+    * launch_jitter: max deviation of a launch from launch_delay, as a fraction of it
+    * rng: random.Random the launch times are drawn from
+    * pending: min heap of (time, launch id, launch) of the launches yet to complete
+    * launched: number of launches requested
+    """
+
+    def __init__(self, task_family: str, server_class, cloud: FakeCloud, launch_delay: float, launch_jitter: float, rng: random.Random):
+        super().__init__(task_family, server_class, max_workers=1, placement_mode='distinct')
+        self.cloud: FakeCloud = cloud
+        self.launch_delay: float = launch_delay
+        self.launch_jitter: float = launch_jitter
+        self.rng: random.Random = rng
+        self.pending: list = []
+        self.launched: int = 0
+        self._workers: list = [0.0] * settings.PROVISIONING_WORKERS # times at which the workers are free
+
+    def launch(self) -> Launch:
+        launch = Launch(next(self._ids))
+        start: float = max(launch.started_at, heapq.heappop(self._workers))
+        done: float = start + self.launch_delay * (1 + self.rng.uniform(-self.launch_jitter, self.launch_jitter))
+        heapq.heappush(self._workers, done)
+        instance: dict = self.cloud.new_instance(done)
+        instance['launched_at'] = start
+        launch.ec2_id = instance['InstanceId']
+        with self._lock:
+            self.launches.append(launch)
+        heapq.heappush(self.pending, (done, launch.launch_id, launch))
+        self.launched += 1
+        return launch
+
+    def next_completion(self) -> float:
+        """Returns the time at which the next launch completes, or None if no launch is in flight"""
+        return self.pending[0][0] if self.pending else None
+
+    def complete(self, now: float) -> None:
+        """Starts the tasks of the launches whose instance is up by now; they are RUNNING and collected on the next update"""
+        while self.pending and self.pending[0][0] <= now:
+            done, _, launch = heapq.heappop(self.pending)
+            task: dict = self.cloud.new_task(self.cloud.instances[launch.ec2_id], self.task_family, done)
+            launch.task_arn = task['taskArn']
+            launch.server = self.server_class(task['taskArn'], launch.ec2_id, "127.0.0.1:" + str(task['hostPort']))
+            launch.finished_at = done
+            launch.state = 'RUNNING'
+
+@contextmanager
+def simulated_manager(clock: VirtualClock, initial_servers: int, session_duration: float, launch_delay: float, launch_jitter: float, seed: int,
+                      **settings_overrides):
+    """
+    Yields (cloud, fleet, manager) with a fresh ServerManagerThread (not started) running under the clock against a FakeCloud of initial_servers gameservers and a SimulatedFleet.
+    The settings overrides make up the scaling policy simulated.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cloud = FakeCloud()
+        overrides: dict = {
+            'ECS_CLIENT': cloud.ecs,
+            'EC2_CLIENT': cloud.ec2,
+            'SHARED_TABLE': False,
+            'STATE_JOURNAL': False,
+            'ADMISSION_CONTROL': False,
+            'WARM_POOL_MAX_SIZE': 0,
+            'PLACEMENT_MODE': 'distinct',
+            # AWS apis answer right away, so only the launch delay is simulated
+            'AWS_API_RATE': 1e9,
+            'AWS_API_BURST': 10 ** 9,
+            # The demand forecast (if enabled) learns from scratch
+            'FORECAST_PATH': os.path.join(directory, "demand_history.bin"),
+        }
+        overrides.update(settings_overrides)
+        # Instance ids of the fake clouds repeat, so nothing may be carried over from a previous run
+        clear_caches()
+        with override_settings(**overrides), clock.install():
+            cloud.add_running_servers(initial_servers)
+            ServerManagerThread.reset_instance()
+            manager = ServerManagerThread.get_instance()
+            try:
+                # Sessions and launches draw from their own streams, so every policy sees the same sessions and launch delays
+                fleet = SimulatedFleet(settings.SERVER_CAPACITY, session_duration, random.Random(str(seed) + "-sessions"))
+                manager.health_checker = fleet
+                manager.provisioner.shutdown()
+                manager.provisioner = SimulatedProvisioner(
+                    manager.task_family, Server, cloud, launch_delay, launch_jitter, random.Random(str(seed) + "-launches")
+                )
+                yield cloud, fleet, manager
+            finally:
+                manager.provisioner.shutdown()
+                manager.warm_pool.shutdown()
+                ServerManagerThread.reset_instance()
+
+def simulate(trace: DemandTrace, duration: float, initial_servers: int = 1, session_duration: float = 1200.0, launch_delay: float = 180.0,
+             launch_jitter: float = 0.2, seed: int = 0, **settings_overrides) -> dict:
+    """
+    Runs the scaling policy given by the settings overrides against the trace for duration seconds of simulated time and returns its report:
+    * clients: number of clients which arrived
+    * backup_fallbacks: clients sent to the backup gameserver as no server was available
+    * turned_away: clients sent to a gameserver which was full (the manager app's view of its capacity was stale)
+    * below_capacity_s: simulated time during which the available gameservers had no room left for a client
+    * server_hours: instance hours consumed (from launch until termination, including booting and standby instances)
+    * scale_out_events, scale_in_events: scaling decisions carried out
+    * launches: server instances launched
+    * peak_servers: max number of available servers
+    The manager app carries out an update every THREAD_SLEEP_TIME seconds and polls the servers which are due in between (batched to whole seconds), as in ServerManagerThread.run.
+    """
+    clock = VirtualClock()
+    with simulated_manager(clock, initial_servers, session_duration, launch_delay, launch_jitter, seed, **settings_overrides) as (cloud, fleet, manager):
+        rng = random.Random(str(seed) + "-arrivals")
+        update_interval: float = max(manager.thread_sleep_time, 1)
+        scale_events: dict = {d: metrics.SCALE_EVENTS.labels(d).value for d in ('up', 'down')}
+        report: dict = {'clients': 0, 'backup_fallbacks': 0, 'turned_away': 0, 'below_capacity_s': 0.0, 'peak_servers': 0}
+
+        # True free capacity of the available servers, kept up to date between the calls to the manager app
+        available: set = set()
+        free_capacity: int = 0
+
+        def refresh() -> None:
+            nonlocal available, free_capacity
+            servers: list = manager.get_available_servers()
+            available = {s.task_arn for s in servers}
+            free_capacity = fleet.free_capacity(servers)
+            report['peak_servers'] = max(report['peak_servers'], len(servers))
+
+        next_update: float = 0.0
+        next_arrival: float = trace.next_arrival(0.0, rng, duration)
+        while True:
+            # Health checks which fall due are batched to the next whole second
+            next_check: float = manager.get_next_check_time()
+            if next_check is not None:
+                next_check = math.ceil(next_check)
+            events: list = [next_update, next_arrival, fleet.next_departure(), manager.provisioner.next_completion(), next_check]
+            t: float = max(min(e for e in events if e is not None), clock.now)
+            if free_capacity <= 0:
+                report['below_capacity_s'] += min(t, duration) - clock.now
+            if t >= duration:
+                break
+            clock.advance(t)
+
+            for task_arn in fleet.depart(t):
+                if task_arn in available:
+                    free_capacity += 1
+            manager.provisioner.complete(t)
+            if t >= next_update:
+                manager.update()
+                next_update = t + update_interval
+                refresh()
+            elif next_check is not None and next_check <= t:
+                manager.check_launched_servers()
+                manager.check_servers()
+                refresh()
+
+            if t >= next_arrival:
+                report['clients'] += 1
+                try:
+                    server: Server = manager.get_available_server()
+                except IndexError:
+                    # The view sends the client to the backup gameserver
+                    report['backup_fallbacks'] += 1
+                else:
+                    if not fleet.connect(server, t):
+                        report['turned_away'] += 1
+                    elif server.task_arn in available:
+                        free_capacity -= 1
+                next_arrival = trace.next_arrival(t, rng, duration)
+
+        report.update({
+            'server_hours': cloud.instance_seconds(duration) / 3600,
+            'scale_out_events': metrics.SCALE_EVENTS.labels('up').value - scale_events['up'],
+            'scale_in_events': metrics.SCALE_EVENTS.labels('down').value - scale_events['down'],
+            'launches': manager.provisioner.launched,
+        })
+        return report
+
+def run_simulations(policies: dict, trace: DemandTrace, duration: float, **options) -> dict:
+    """Runs every policy (name -> settings overrides) against the same trace and the same random arrivals and returns the reports keyed by policy name"""
+    results: dict = {}
+    for name, overrides in policies.items():
+        print("Simulating policy", name)
+        results[name] = simulate(trace, duration, **options, **overrides)
+    return results
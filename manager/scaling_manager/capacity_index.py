@@ -0,0 +1,212 @@
+"""This module has the CapacityIndex class which indexes available servers by their available capacity for fast selection"""
+
+import heapq
+from itertools import count
+import random
+
+class CapacityIndex():
+    """
+    Index of servers by available capacity, which selects a server as per one of the following policies:
+    * max_available: server with the max available capacity (max-heap)
+    * power_of_two: better of two servers picked at random
+    * weighted_random: server picked with probability proportional to its available capacity (Fenwick tree)
+    * pack: fullest server with capacity left other than the draining ones, or else the max_available one (min-heap built on first use)
+    The index must be told (using update) whenever the capacity of a server changes. Note that it isn't thread safe by itself.
+
+    Attributes:
+    * draining: set of servers new clients are steered away from by the pack policy (see ServerManagerThread.update_drain_candidates)
+    """
+
+    POLICIES = ('max_available', 'power_of_two', 'weighted_random', 'pack')
+
+    def __init__(self, capacity_of=None, rng: random.Random = None):
+        self.capacity_of = capacity_of or (lambda server: server.available_capacity)
+        self.rng: random.Random = rng or random.Random()
+
+        self.draining: set = set()
+
+        self._heap: list = [] # entries are (-capacity, entry id, server); stale entries are dropped lazily
+        self._min_heap: list = None # entries are (capacity, entry id, server) of the servers with capacity left (None until the pack policy is used)
+        self._entry_ids: dict = {} # server -> id of its only valid heap entry
+        self._counter = count()
+
+        self._slots: list = [] # servers stored densely so that they can be sampled uniformly
+        self._positions: dict = {} # server -> index in self._slots
+        self._weights: list = [] # weight (clamped capacity) of the server in each slot
+        self._tree: list = [0] # 1-indexed Fenwick tree over self._weights
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, server) -> bool:
+        return server in self._positions
+
+    def servers(self) -> list:
+        """Returns a list of the indexed servers (in no particular order)"""
+        return list(self._slots)
+
+    def add(self, server) -> None:
+        """Adds the server to the index; adding an indexed server only refreshes its capacity"""
+        if server in self._positions:
+            self.update(server)
+            return
+        self._positions[server] = len(self._slots)
+        self._slots.append(server)
+        self._weights.append(0)
+        if len(self._slots) >= len(self._tree):
+            self._rebuild_tree()
+        self.update(server)
+
+    def remove(self, server) -> None:
+        """Removes the server from the index; does nothing if it isn't indexed"""
+        position = self._positions.pop(server, None)
+        if position is None:
+            return
+        # Invalidate the heap entries; they are dropped when they surface
+        del self._entry_ids[server]
+        self.draining.discard(server)
+
+        # Move the last server into the freed slot to keep the slots dense
+        last_position = len(self._slots) - 1
+        last_server = self._slots.pop()
+        last_weight = self._weights.pop()
+        self._fenwick_add(last_position + 1, -last_weight)
+        if position != last_position:
+            self._fenwick_add(position + 1, last_weight - self._weights[position])
+            self._slots[position] = last_server
+            self._weights[position] = last_weight
+            self._positions[last_server] = position
+
+    def update(self, server) -> None:
+        """Refreshes the indexed capacity of the server; must be called after its capacity changes"""
+        position = self._positions.get(server)
+        if position is None:
+            return
+        capacity = self.capacity_of(server)
+        self._push(server, capacity)
+
+        weight = max(capacity, 0)
+        self._fenwick_add(position + 1, weight - self._weights[position])
+        self._weights[position] = weight
+
+    def max_server(self):
+        """Returns the server with the max available capacity; raises IndexError if the index is empty"""
+        while self._heap:
+            neg_capacity, entry_id, server = self._heap[0]
+            if self._entry_ids.get(server) != entry_id:
+                heapq.heappop(self._heap) # stale entry
+            elif -neg_capacity != self.capacity_of(server):
+                # capacity changed without an update (e.g. expired reservations); re-key the entry
+                heapq.heappop(self._heap)
+                self._push(server, self.capacity_of(server))
+            else:
+                return server
+        raise IndexError("No server available in capacity index")
+
+    def select(self, policy: str = 'max_available'):
+        """Returns a server chosen as per the given policy; raises IndexError if the index is empty"""
+        if policy == 'max_available':
+            return self.max_server()
+        elif policy == 'power_of_two':
+            return self._select_power_of_two()
+        elif policy == 'weighted_random':
+            return self._select_weighted_random()
+        elif policy == 'pack':
+            return self._select_pack()
+        raise ValueError("Unknown selection policy: " + str(policy))
+
+    def _select_power_of_two(self):
+        n = len(self._slots)
+        if n == 0:
+            raise IndexError("No server available in capacity index")
+        first = self._slots[self.rng.randrange(n)]
+        second = self._slots[self.rng.randrange(n)]
+        return first if self.capacity_of(first) >= self.capacity_of(second) else second
+
+    def _select_weighted_random(self):
+        total = self._fenwick_prefix(len(self._slots))
+        if total <= 0:
+            # No server has any capacity left, so weights are meaningless
+            return self.max_server()
+        return self._slots[self._fenwick_search(self.rng.randrange(total))]
+
+    def _select_pack(self):
+        if self._min_heap is None:
+            self._min_heap = []
+            for server in self._slots:
+                self._push(server, self.capacity_of(server))
+        draining: list = [] # entries of the draining servers, put back once a server is chosen
+        chosen = None
+        while self._min_heap:
+            capacity, entry_id, server = self._min_heap[0]
+            if self._entry_ids.get(server) != entry_id:
+                heapq.heappop(self._min_heap) # stale entry
+            elif capacity != self.capacity_of(server):
+                # capacity changed without an update (e.g. expired reservations); re-key the entry
+                heapq.heappop(self._min_heap)
+                self._push(server, self.capacity_of(server))
+            elif server in self.draining:
+                draining.append(heapq.heappop(self._min_heap))
+            else:
+                chosen = server
+                break
+        for entry in draining:
+            heapq.heappush(self._min_heap, entry)
+        if chosen is None:
+            return self.max_server()
+        return chosen
+
+    def _push(self, server, capacity: int) -> None:
+        entry_id = next(self._counter)
+        self._entry_ids[server] = entry_id
+        heapq.heappush(self._heap, (-capacity, entry_id, server))
+        if self._min_heap is not None and capacity > 0:
+            heapq.heappush(self._min_heap, (capacity, entry_id, server))
+        if len(self._heap) > 2 * len(self._slots) + 64:
+            self._compact_heap()
+
+    def _compact_heap(self) -> None:
+        """Drops the stale entries so that the heaps don't grow unbounded with updates"""
+        self._heap = [entry for entry in self._heap if self._entry_ids.get(entry[2]) == entry[1]]
+        heapq.heapify(self._heap)
+        if self._min_heap is not None:
+            self._min_heap = [entry for entry in self._min_heap if self._entry_ids.get(entry[2]) == entry[1]]
+            heapq.heapify(self._min_heap)
+
+    def _rebuild_tree(self) -> None:
+        """Doubles the size of the Fenwick tree and rebuilds it from the weights in O(n)"""
+        size = 2 * max(len(self._tree), len(self._slots) + 1)
+        tree = [0] * size
+        for i, weight in enumerate(self._weights, start=1):
+            tree[i] = weight
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _fenwick_add(self, i: int, delta: int) -> None:
+        if delta == 0:
+            return
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _fenwick_prefix(self, i: int) -> int:
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _fenwick_search(self, target: int) -> int:
+        """Returns the slot index of the server whose cumulative weight range contains target"""
+        position = 0
+        step = 1 << (len(self._tree).bit_length() - 1)
+        while step > 0:
+            next_position = position + step
+            if next_position < len(self._tree) and self._tree[next_position] <= target:
+                position = next_position
+                target -= self._tree[position]
+            step >>= 1
+        return position
@@ -0,0 +1,204 @@
+"""This module has the classes (DemandHistory and DemandForecast) which record the assignment rate and the fleet capacity over time and forecast the demand one provisioning lead time ahead"""
+
+from array import array
+from math import ceil
+import os
+import struct
+from time import time
+from django.conf import settings
+
+SECONDS_PER_DAY = 86400
+
+class DemandHistory():
+    """
+    Ring buffer of days days of samples, one per bucket of bucket_width seconds of wall clock time (assignments made, and fleet and available capacity at its end), persisted to a compact binary file.
+
+    Attributes:
+    * path: path of the history file
+    * bucket_width: width (in seconds) of a bucket
+    * slots: number of samples held
+    * buckets: array of the bucket number of each sample (-1 for an empty slot)
+    * assignments: array of the number of assignments of each sample
+    * fleet_capacity: array of the capacity of the available servers (SERVER_CAPACITY each) of each sample
+    * available_capacity: array of the total available capacity of each sample
+    """
+
+    # Header: magic, format version, bucket width, slots
+    FILE_HEADER = struct.Struct('<4sIII')
+    MAGIC = b'PLCD'
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: str = None, bucket_width: int = None, days: int = 7):
+        self.path: str = path or settings.FORECAST_PATH
+        self.bucket_width: int = bucket_width or settings.FORECAST_BUCKET
+        self.slots: int = ceil(days * SECONDS_PER_DAY / self.bucket_width)
+        self.buckets = array('q', [-1]) * self.slots
+        self.assignments = array('d', [0.0]) * self.slots
+        self.fleet_capacity = array('d', [0.0]) * self.slots
+        self.available_capacity = array('d', [0.0]) * self.slots
+
+    def add(self, bucket: int, assignments: float, fleet_capacity: float, available_capacity: float) -> None:
+        """Stores the sample of a bucket, overwriting the sample slots buckets older"""
+        i: int = bucket % self.slots
+        self.buckets[i] = bucket
+        self.assignments[i] = assignments
+        self.fleet_capacity[i] = fleet_capacity
+        self.available_capacity[i] = available_capacity
+
+    def samples(self) -> list:
+        """Returns the list of (bucket, assignments, fleet capacity, available capacity) samples held, oldest first"""
+        return sorted(
+            (self.buckets[i], self.assignments[i], self.fleet_capacity[i], self.available_capacity[i])
+            for i in range(self.slots) if self.buckets[i] >= 0
+        )
+
+    def save(self) -> bool:
+        """Writes the buffer to the history file. Returns True if successful and False otherwise"""
+        temporary_path: str = self.path + ".tmp"
+        try:
+            with open(temporary_path, 'wb') as f:
+                f.write(self.FILE_HEADER.pack(self.MAGIC, self.FORMAT_VERSION, self.bucket_width, self.slots))
+                for values in (self.buckets, self.assignments, self.fleet_capacity, self.available_capacity):
+                    values.tofile(f)
+            os.replace(temporary_path, self.path)
+            return True
+        except Exception as e:
+            print("Unable to save the demand history due to the following exception")
+            print(e)
+            return False
+
+    def load(self) -> bool:
+        """
+        Reads the buffer from the history file.
+        Returns True if successful and False if there is no history file, or if it can't be read or was written with another bucket width or size.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, bucket_width, slots = self.FILE_HEADER.unpack(f.read(self.FILE_HEADER.size))
+                if (magic, version, bucket_width, slots) != (self.MAGIC, self.FORMAT_VERSION, self.bucket_width, self.slots):
+                    print("Ignoring demand history with another format, bucket width or size")
+                    return False
+                arrays: list = [array(values.typecode) for values in (self.buckets, self.assignments, self.fleet_capacity, self.available_capacity)]
+                for values in arrays:
+                    values.fromfile(f, slots)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print("Unable to read the demand history due to the following exception")
+            print(e)
+            return False
+        self.buckets, self.assignments, self.fleet_capacity, self.available_capacity = arrays
+        return True
+
+    @classmethod
+    def open(cls, path: str):
+        """Returns the DemandHistory persisted to the given file whatever its bucket width and size (e.g. to replay it), or None if it can't be read"""
+        try:
+            with open(path, 'rb') as f:
+                magic, version, bucket_width, slots = cls.FILE_HEADER.unpack(f.read(cls.FILE_HEADER.size))
+        except Exception as e:
+            print("Unable to read the demand history due to the following exception")
+            print(e)
+            return None
+        history = cls(path, bucket_width, 1)
+        history.slots = slots
+        return history if history.load() else None
+
+class DemandForecast():
+    """
+    Forecasts how much capacity the clients will take up within a provisioning lead time: the assignments forecast by additive Holt-Winters smoothing (with daily seasonality)
+    less the departures of the clients holding capacity, whose mean session duration follows from Little's law. The model is rebuilt from the DemandHistory on startup.
+
+    Attributes:
+    * history: DemandHistory of the closed buckets
+    * period: number of buckets in a day
+    * level: smoothed assignment rate, without the seasonal offset (None until the first bucket is closed)
+    * trend: smoothed change of the level per bucket
+    * seasonal: list of the seasonal offsets of the assignment rate per bucket of the day
+    * session_duration: mean time (in seconds) a client holds capacity on a server (None until it can be estimated)
+    * last_rate: assignment rate of the last closed bucket
+    """
+
+    # Smoothing weights of the latest bucket
+    LEVEL_WEIGHT = 0.3
+    TREND_WEIGHT = 0.05
+    SEASON_WEIGHT = 0.2
+    SESSION_WEIGHT = 0.01
+
+    def __init__(self, history: DemandHistory = None):
+        self.history: DemandHistory = history or DemandHistory()
+        self.period: int = ceil(SECONDS_PER_DAY / self.history.bucket_width)
+        self.level: float = None
+        self.trend: float = 0.0
+        self.seasonal: list = [0.0] * self.period
+        self.session_duration: float = None
+        self.last_rate: float = None
+        self._last_bucket: int = None # last bucket fed to the model
+        self._mean_rate: float = None # long run average of the assignment rate
+        self._mean_held: float = None # long run average of the held capacity
+        self._bucket: int = None # bucket being accumulated
+        self._sample: list = None # [assignments, fleet capacity, available capacity] of the bucket being accumulated
+
+        if self.history.load():
+            for sample in self.history.samples():
+                self._fit(*sample)
+
+    def record(self, assignments: int, fleet_capacity: int, available_capacity: int, now: float = None) -> None:
+        """Adds the assignments made since the last call and the current capacities to the current bucket; the previous bucket is closed if it is over"""
+        bucket: int = int((time() if now is None else now) // self.history.bucket_width)
+        if self._bucket is not None and bucket != self._bucket:
+            self.history.add(self._bucket, *self._sample)
+            self._fit(self._bucket, *self._sample)
+            self.history.save()
+            self._bucket = None
+        if self._bucket is None:
+            self._bucket = bucket
+            self._sample = [0, 0, 0]
+        self._sample[0] += assignments
+        self._sample[1:] = fleet_capacity, available_capacity
+
+    def _fit(self, bucket: int, assignments: float, fleet_capacity: float, available_capacity: float) -> None:
+        """Feeds the sample of a closed bucket to the model"""
+        rate: float = assignments / self.history.bucket_width
+        season: int = bucket % self.period
+        if self.level is None:
+            self.level = rate
+        else:
+            # Buckets missed while the manager app was down are skipped over along the trend
+            steps: int = max(bucket - self._last_bucket, 1)
+            previous_level: float = self.level
+            self.level = self.LEVEL_WEIGHT * (rate - self.seasonal[season]) + (1 - self.LEVEL_WEIGHT) * (previous_level + steps * self.trend)
+            self.trend = self.TREND_WEIGHT * (self.level - previous_level) / steps + (1 - self.TREND_WEIGHT) * self.trend
+            self.seasonal[season] = self.SEASON_WEIGHT * (rate - self.level) + (1 - self.SEASON_WEIGHT) * self.seasonal[season]
+        self._last_bucket = bucket
+        self.last_rate = rate
+
+        # Little's law holds for the long run averages, while the held capacity lags the rate within the day
+        held_capacity: float = max(fleet_capacity - available_capacity, 0.0)
+        if self._mean_rate is None:
+            self._mean_rate, self._mean_held = rate, held_capacity
+        else:
+            self._mean_rate += self.SESSION_WEIGHT * (rate - self._mean_rate)
+            self._mean_held += self.SESSION_WEIGHT * (held_capacity - self._mean_held)
+        if self._mean_rate > 0 and self._mean_held > 0:
+            self.session_duration = self._mean_held / self._mean_rate
+
+    def forecast_rate(self, bucket: int) -> float:
+        """Returns the forecast assignment rate (clients per second) of a bucket (from the last closed one on)"""
+        steps: int = bucket - self._last_bucket
+        return self.level + steps * self.trend + self.seasonal[bucket % self.period]
+
+    def predicted_growth(self, lead_time: float, held_capacity: int, now: float = None) -> int:
+        """
+        Returns how much more capacity the clients are expected to take up lead_time seconds from now than the held_capacity they take up now
+        (negative if they are expected to take up less, and 0 until the model has enough history).
+        """
+        if self.level is None or self.session_duration is None:
+            return 0
+        bucket: int = int((time() if now is None else now) // self.history.bucket_width)
+        ahead: int = max(ceil(lead_time / self.history.bucket_width), 1)
+        # The model only contributes the change of the rate from the current bucket on, so that an error of its level doesn't bias the growth
+        # (the offsets of the current and the next buckets were all last updated a day ago, which isn't true of the last closed bucket)
+        change: float = sum(self.forecast_rate(bucket + k) for k in range(1, ahead + 1)) / ahead - self.forecast_rate(bucket)
+        arrival_rate: float = max(self.last_rate + change, 0.0)
+        return round(lead_time * (arrival_rate - max(held_capacity, 0) / self.session_duration))
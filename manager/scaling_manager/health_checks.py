@@ -0,0 +1,170 @@
+"""This module has the classes (HealthChecker and AsyncHealthChecker) which poll the health api of many gameservers concurrently"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+from time import perf_counter
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics
+
+class HealthChecker():
+    """
+    Polls the health api of server instances concurrently using a bounded pool of worker threads
+
+    Attributes:
+    * request_timeout: time (in seconds) allowed for a single health check request
+    * tick_deadline: time (in seconds) allowed for a sweep over all the given servers; servers which haven't responded by then are reported as failed
+    * session: requests session shared by the workers so that keep-alive connections to the gameservers are reused across sweeps
+    * executor: bounded pool of worker threads which carry out the requests
+    """
+
+    # Max number of per-host connection pools kept by the session; should be at least the fleet size for connections to be reused
+    POOL_CONNECTIONS = 1024
+    MAX_WORKERS = 64
+
+    def __init__(self, max_workers: int = None, request_timeout: float = None, tick_deadline: float = None):
+        max_workers = max_workers or self.MAX_WORKERS
+        self.request_timeout: float = request_timeout or settings.HEALTH_CHECK_TIMEOUT
+        self.tick_deadline: float = tick_deadline or settings.HEALTH_CHECK_TICK_DEADLINE
+
+        self.session = requests.Session()
+        # Only one request is made to a server at a time, so a single connection per host is enough
+        adapter = HTTPAdapter(pool_connections=self.POOL_CONNECTIONS, pool_maxsize=1, max_retries=0)
+        self.session.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='health-check')
+
+    def check(self, servers: list) -> dict:
+        """
+        Fetches the health state of all the given servers concurrently.
+        Returns a dict mapping each server to its health state (dict), or to None if the server didn't respond in time.
+        Note that the state is only fetched and not applied to the servers; it is left to the caller to apply the whole batch.
+        """
+        results: dict = {s: None for s in servers}
+        if len(servers) == 0:
+            return results
+
+        futures: dict = {
+            self.executor.submit(s.fetch_state, self.session, self.request_timeout): s
+            for s in servers
+        }
+        done, not_done = wait(futures, timeout=self.tick_deadline)
+
+        for future in done:
+            results[futures[future]] = future.result()
+
+        for future in not_done:
+            # Drop the requests which haven't started yet; the running ones are bounded by request_timeout
+            future.cancel()
+            print("Health check deadline exceeded for", futures[future].address)
+
+        return results
+
+class AsyncHealthChecker():
+    """
+    asyncio counterpart of HealthChecker; polls the health api of server instances concurrently without blocking the event loop.
+    It speaks just enough HTTP/1.1 for the health api, and keeps one keep-alive connection per server instance.
+
+    Attributes:
+    * request_timeout: time (in seconds) allowed for a single health check request
+    * tick_deadline: time (in seconds) allowed for a sweep over all the given servers; servers which haven't responded by then are reported as failed
+    * max_concurrency: max number of health check requests in flight
+    """
+
+    def __init__(self, max_concurrency: int = None, request_timeout: float = None, tick_deadline: float = None):
+        self.max_concurrency: int = max_concurrency or HealthChecker.MAX_WORKERS * 16
+        self.request_timeout: float = request_timeout or settings.HEALTH_CHECK_TIMEOUT
+        self.tick_deadline: float = tick_deadline or settings.HEALTH_CHECK_TICK_DEADLINE
+        self._semaphore: asyncio.Semaphore = None
+        self._connections: dict = {} # address -> (reader, writer) of an idle keep-alive connection
+
+    async def check(self, servers: list) -> dict:
+        """
+        Fetches the health state of all the given servers concurrently.
+        Returns a dict mapping each server to its health state (dict), or to None if the server didn't respond in time.
+        """
+        results: dict = {s: None for s in servers}
+        if len(servers) == 0:
+            return results
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        tasks: dict = {asyncio.ensure_future(self._fetch_state(s.address)): s for s in servers}
+        done, pending = await asyncio.wait(tasks, timeout=self.tick_deadline)
+
+        for task in done:
+            results[tasks[task]] = task.result()
+
+        for task in pending:
+            task.cancel()
+            print("Health check deadline exceeded for", tasks[task].address)
+
+        return results
+
+    async def _fetch_state(self, address: str) -> dict:
+        async with self._semaphore:
+            start: float = perf_counter()
+            try:
+                state_json: dict = await asyncio.wait_for(self._get_health(address), self.request_timeout)
+            except Exception as e:
+                print(address, e)
+                metrics.HEALTH_CHECK_FAILURES.inc()
+                return None
+            metrics.HEALTH_CHECK_RTT.observe(perf_counter() - start)
+            return state_json
+
+    async def _get_health(self, address: str) -> dict:
+        connection = self._connections.pop(address, None)
+        if connection is not None:
+            try:
+                return await self._request(address, connection)
+            except (ConnectionError, asyncio.IncompleteReadError, EOFError):
+                # The idle connection was closed by the server; retry on a new one
+                pass
+        host, port = address.rsplit(':', 1)
+        connection = await asyncio.open_connection(host, int(port))
+        return await self._request(address, connection)
+
+    async def _request(self, address: str, connection: tuple) -> dict:
+        """Makes a GET request for the health api over the given connection, which is kept for reuse if possible"""
+        reader, writer = connection
+        keep_alive: bool = False
+        try:
+            writer.write(b"GET /health/ HTTP/1.1\r\nHost: " + address.encode() + b"\r\nConnection: keep-alive\r\n\r\n")
+            await writer.drain()
+
+            status_line: bytes = await reader.readline()
+            if not status_line:
+                raise EOFError("Connection closed by " + address)
+            status: int = int(status_line.split()[1])
+
+            headers: dict = {}
+            while True:
+                line: bytes = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip().lower()
+
+            if 'content-length' in headers:
+                body: bytes = await reader.readexactly(int(headers['content-length']))
+                keep_alive = headers.get('connection') != 'close'
+            else:
+                body = await reader.read()
+
+            if status != 200:
+                raise Exception("Health api of " + address + " returned status " + str(status))
+            return json.loads(body)
+        finally:
+            if keep_alive:
+                self._connections[address] = connection
+            else:
+                writer.close()
+
+    def close(self) -> None:
+        """Closes all idle connections"""
+        for reader, writer in self._connections.values():
+            writer.close()
+        self._connections.clear()
@@ -0,0 +1,142 @@
+"""This module has the HealthScheduler class which decides when the health api of each server instance is polled next"""
+
+import heapq
+from itertools import count
+from time import monotonic
+from django.conf import settings
+
+class ScheduleEntry():
+    __slots__ = ('due', 'failures')
+
+    def __init__(self, due: float):
+        self.due: float = due
+        self.failures: int = 0
+
+class HealthScheduler():
+    """
+    Per-server schedule of health checks (a lazily updated min heap by due time): servers are checked more often as they fill up, drain (in standby) or are sent clients,
+    and a server whose check failed is rechecked with exponential backoff until it is dead. Note that the class isn't thread safe by itself.
+
+    Attributes:
+    * min_interval: time (in seconds) between checks of the hottest server instances, and first backoff after a failure
+    * max_interval: time (in seconds) between checks of idle server instances, and max backoff after failures
+    * dead_after: number of consecutive failed checks after which a server instance is dead
+    * server_capacity: capacity of an empty server instance, used to tell how full a server instance is
+    """
+
+    def __init__(self, min_interval: float = None, max_interval: float = None, dead_after: int = None, server_capacity: int = None):
+        self.min_interval: float = min_interval or settings.HEALTH_CHECK_MIN_INTERVAL
+        self.max_interval: float = max_interval or settings.HEALTH_CHECK_MAX_INTERVAL
+        self.dead_after: int = dead_after or settings.HEALTH_CHECK_DEAD_AFTER
+        self.server_capacity: int = server_capacity or settings.SERVER_CAPACITY
+        self._entries: dict = {} # server -> ScheduleEntry
+        self._heap: list = [] # (due, tie breaker, server)
+        self._counter = count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, server) -> bool:
+        return server in self._entries
+
+    def add(self, server, now: float = None) -> None:
+        """Schedules a new server instance to be checked right away"""
+        if server in self._entries:
+            return
+        now = monotonic() if now is None else now
+        self._entries[server] = ScheduleEntry(now)
+        self._push(server, now)
+
+    def remove(self, server) -> None:
+        self._entries.pop(server, None)
+
+    def sync(self, servers: list, now: float = None) -> None:
+        """Adds the given server instances which aren't scheduled yet and forgets the scheduled ones which aren't given"""
+        current: set = set(servers)
+        for server in [s for s in self._entries if s not in current]:
+            del self._entries[server]
+        for server in servers:
+            self.add(server, now)
+
+    def pop_due(self, now: float = None) -> list:
+        """
+        Returns the server instances whose check is due.
+        They aren't rescheduled until their result is recorded (see record); until then they aren't returned again.
+        """
+        now = monotonic() if now is None else now
+        due: list = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, _, server = heapq.heappop(self._heap)
+            entry: ScheduleEntry = self._entries.get(server)
+            if entry is None or entry.due != due_at:
+                continue # removed or rescheduled since
+            entry.due = float('inf')
+            due.append(server)
+        return due
+
+    def next_due(self) -> float:
+        """Returns the monotonic time at which the next check is due, or None if nothing is scheduled"""
+        while self._heap:
+            due_at, _, server = self._heap[0]
+            entry: ScheduleEntry = self._entries.get(server)
+            if entry is not None and entry.due == due_at:
+                return due_at
+            heapq.heappop(self._heap)
+        return None
+
+    def record(self, server, healthy: bool, standby: bool = False, now: float = None) -> int:
+        """
+        Records the result of a check of the server instance (or a heartbeat it pushed) and schedules its next check.
+        Returns the number of consecutive failed checks of the server instance (0 if it is healthy).
+        """
+        entry: ScheduleEntry = self._entries.get(server)
+        if entry is None:
+            return 0
+        now = monotonic() if now is None else now
+        entry.failures = 0 if healthy else entry.failures + 1
+        self._reschedule(server, entry, now + self.interval(server, entry.failures, standby))
+        return entry.failures
+
+    def expedite(self, server, now: float = None) -> None:
+        """Brings the next check of the server instance forward to within min_interval seconds (e.g. as it was just sent a client)"""
+        entry: ScheduleEntry = self._entries.get(server)
+        if entry is None:
+            return
+        due: float = (monotonic() if now is None else now) + self.min_interval
+        if due < entry.due:
+            self._reschedule(server, entry, due)
+
+    def failures(self, server) -> int:
+        """Returns the number of consecutive failed checks of the server instance"""
+        entry: ScheduleEntry = self._entries.get(server)
+        return 0 if entry is None else entry.failures
+
+    def suspect_count(self) -> int:
+        """Returns the number of server instances whose last check failed"""
+        return sum(1 for entry in self._entries.values() if entry.failures > 0)
+
+    def is_dead(self, server) -> bool:
+        """Returns True if the server instance failed dead_after consecutive checks and False otherwise"""
+        return self.failures(server) >= self.dead_after
+
+    def interval(self, server, failures: int = 0, standby: bool = False) -> float:
+        """Returns the time (in seconds) until the next check of the server instance"""
+        if failures > 0:
+            return min(self.min_interval * 2 ** (failures - 1), self.max_interval)
+        if server.reservations.outstanding() > 0:
+            return self.min_interval
+        free: float = min(max(server.available_capacity / self.server_capacity, 0.0), 1.0)
+        # Hotness is how full an available server instance is, or how close to drained a standby one is
+        hotness: float = free if standby else 1.0 - free
+        return self.max_interval - (self.max_interval - self.min_interval) * hotness
+
+    def _reschedule(self, server, entry: ScheduleEntry, due: float) -> None:
+        entry.due = due
+        self._push(server, due)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Drop the outdated heap items
+            self._heap = [item for item in self._heap if item[2] in self._entries and self._entries[item[2]].due == item[0]]
+            heapq.heapify(self._heap)
+
+    def _push(self, server, due: float) -> None:
+        heapq.heappush(self._heap, (due, next(self._counter), server))
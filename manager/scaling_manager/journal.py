@@ -0,0 +1,104 @@
+"""This module has the StateJournal class which persists the server lists of the ServerManagerThread to a local file, so that a restarted manager app can serve clients right away"""
+
+import json
+import os
+from time import time
+from django.conf import settings
+
+class StateJournal():
+    """
+    Compact json file holding the server lists as of the last update, replaced atomically on every update.
+
+    Attributes:
+    * path: path of the journal file
+    * max_age: time (in seconds) after which a journal is too old to be restored from
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: str = None, max_age: float = None):
+        self.path: str = path or settings.STATE_JOURNAL_PATH
+        self.max_age: float = max_age if max_age is not None else settings.STATE_JOURNAL_MAX_AGE
+
+    def save(self, available_servers: list, standby_servers: list) -> bool:
+        """Writes the given server lists to the journal. Returns True if successful and False otherwise"""
+        temporary_path: str = self.path + ".tmp"
+        try:
+            with open(temporary_path, 'w') as f:
+                f.write(self.dumps(available_servers, standby_servers))
+            os.replace(temporary_path, self.path)
+            return True
+        except Exception as e:
+            print("Unable to save the state journal due to the following exception")
+            print(e)
+            return False
+
+    @staticmethod
+    def to_record(server, standby: bool) -> dict:
+        """Returns the journal record of a Server object"""
+        return {
+            'task_arn': server.task_arn,
+            'ec2_id': server.ec2_id,
+            'address': server.address,
+            'status': server.status,
+            'standby': standby,
+            'reported_capacity': server.reported_capacity,
+            'ready_to_close': server.ready_to_close,
+            'heartbeat_seq': server.heartbeat_seq,
+        }
+
+    @staticmethod
+    def from_record(record: dict, server_class):
+        """Returns the Server object (of the given class) restored from a journal record; no api calls are made"""
+        server = server_class(record['task_arn'], record['ec2_id'], record['address'])
+        server.status = record['status']
+        server.reported_capacity = record['reported_capacity']
+        server.ready_to_close = record['ready_to_close']
+        # Heartbeats arriving after the restart must still be newer than the ones already applied
+        server.heartbeat_seq = record['heartbeat_seq']
+        return server
+
+    def load(self) -> list:
+        """
+        Returns the list of server records (dicts) in the journal.
+        Returns None if there is no journal, or if it can't be read or is older than max_age.
+        """
+        try:
+            with open(self.path) as f:
+                text: str = f.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Unable to read the state journal due to the following exception")
+            print(e)
+            return None
+        return self.loads(text, self.max_age)
+
+    @classmethod
+    def dumps(cls, available_servers: list, standby_servers: list) -> str:
+        """Returns the given server lists in the journal format (also used to replicate them to the follower replicas)"""
+        records: list = [cls.to_record(s, False) for s in available_servers] + [cls.to_record(s, True) for s in standby_servers]
+        journal: dict = {'version': cls.FORMAT_VERSION, 'saved_at': time(), 'servers': records}
+        return json.dumps(journal, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, text: str, max_age: float) -> list:
+        """Returns the list of server records in the journal format text, or None if it can't be parsed or is older than max_age"""
+        try:
+            journal: dict = json.loads(text)
+            if journal.get('version') != cls.FORMAT_VERSION:
+                print("Ignoring state journal with unknown version", journal.get('version'))
+                return None
+            age: float = time() - journal['saved_at']
+            servers: list = journal['servers']
+            if not isinstance(servers, list):
+                raise TypeError("Invalid server records " + str(servers))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print("Unable to parse the state journal due to the following exception")
+            print(e)
+            return None
+
+        if age > max_age:
+            print("Ignoring state journal saved", int(age), "seconds ago")
+            return None
+        return servers
@@ -0,0 +1,55 @@
+from contextlib import redirect_stdout
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand
+from scaling_manager.benchmark.scenarios import run_benchmarks
+
+class Command(BaseCommand):
+    help = "Benchmarks the manager app against a fake ECS/EC2 and a fleet of local fake gameservers (no AWS access needed) and emits the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="fleet sizes to benchmark")
+        parser.add_argument('--api-latency', type=float, default=0.005, help="seconds every fake AWS api call takes")
+        parser.add_argument('--launch-delay', type=float, default=1.0, help="seconds a fake EC2 instance takes to boot")
+        parser.add_argument('--duration', type=float, default=1.0, help="seconds each throughput measurement runs for")
+        parser.add_argument('--output', type=str, default=None, help="file to write the JSON results to (stdout by default)")
+
+    def handle(self, *args, **options):
+        results = {
+            'meta': {
+                'commit': self.get_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'sizes': options['sizes'],
+                'api_latency': options['api_latency'],
+                'launch_delay': options['launch_delay'],
+            },
+            'results': None,
+        }
+        # The manager logs with print; keep stdout for the JSON results
+        with redirect_stdout(sys.stderr):
+            results['results'] = run_benchmarks(
+                options['sizes'],
+                api_latency=options['api_latency'],
+                launch_delay=options['launch_delay'],
+                duration=options['duration'],
+            )
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def get_commit() -> str:
+        """Returns the git commit being benchmarked (None if it can't be found)"""
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except Exception:
+            return None
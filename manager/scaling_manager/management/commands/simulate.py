@@ -0,0 +1,79 @@
+from ast import literal_eval
+from contextlib import redirect_stdout
+import json
+import os
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from scaling_manager.benchmark.simulator import DemandTrace, run_simulations
+
+class Command(BaseCommand):
+    help = (
+        "Simulates scaling policies (sets of settings such as UPSCALE_MARGIN, DOWNSCALE_MARGIN and THREAD_SLEEP_TIME) against a demand trace under a virtual clock "
+        "and emits a report per policy as JSON (no AWS access needed)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--policy', action='append', default=[], metavar='SETTING=VALUE[,SETTING=VALUE...]',
+                            help="settings overrides making up a policy; repeat to compare policies (the current settings by default)")
+        parser.add_argument('--trace', type=str, default=None,
+                            help="recorded demand trace: a demand history file (FORECAST_PATH) or a csv file of 'seconds,rate' rows (a synthetic day by default)")
+        parser.add_argument('--peak-rate', type=float, default=5.0, help="clients per second at the peak of the synthetic day")
+        parser.add_argument('--base-rate', type=float, default=0.5, help="clients per second off peak in the synthetic day")
+        parser.add_argument('--peak-hour', type=float, default=20.0, help="hour of the peak of the synthetic day")
+        parser.add_argument('--days', type=float, default=3.0, help="days of traffic simulated")
+        parser.add_argument('--initial-servers', type=int, default=1, help="gameservers running at the start")
+        parser.add_argument('--session-duration', type=float, default=1200.0, help="mean seconds a client stays connected to a gameserver")
+        parser.add_argument('--launch-delay', type=float, default=180.0, help="mean seconds a launch takes")
+        parser.add_argument('--launch-jitter', type=float, default=0.2, help="max deviation of a launch from the launch delay, as a fraction of it")
+        parser.add_argument('--seed', type=int, default=0, help="seed of the random arrivals, sessions and launch delays (shared by all policies)")
+        parser.add_argument('--output', type=str, default=None, help="file to write the JSON results to (stdout by default)")
+        parser.add_argument('--verbose', action='store_true', help="print the log of the manager app to stderr")
+
+    def handle(self, *args, **options):
+        policies: dict = {p: self.parse_policy(p) for p in options['policy']} or {'current settings': {}}
+        try:
+            trace = DemandTrace.load(options['trace']) if options['trace'] else \
+                DemandTrace.daily(options['peak_rate'], options['base_rate'], options['peak_hour'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stderr if options['verbose'] else devnull):
+            results = run_simulations(
+                policies, trace, options['days'] * 86400,
+                initial_servers=options['initial_servers'],
+                session_duration=options['session_duration'],
+                launch_delay=options['launch_delay'],
+                launch_jitter=options['launch_jitter'],
+                seed=options['seed'],
+            )
+        output = json.dumps({
+            'meta': {
+                'trace': options['trace'] or 'synthetic',
+                'days': options['days'],
+                'session_duration': options['session_duration'],
+                'launch_delay': options['launch_delay'],
+                'seed': options['seed'],
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def parse_policy(policy: str) -> dict:
+        """Returns the settings overrides of a policy given as 'SETTING=VALUE,...'; values are Python literals (e.g. 20, 0.5, True) or else strings"""
+        overrides: dict = {}
+        for item in policy.split(','):
+            name, sep, value = item.partition('=')
+            name = name.strip()
+            if not sep or not hasattr(settings, name):
+                raise CommandError("Invalid policy item '" + item + "': expected SETTING=VALUE with an existing setting")
+            try:
+                overrides[name] = literal_eval(value.strip())
+            except (ValueError, SyntaxError):
+                overrides[name] = value.strip()
+        return overrides
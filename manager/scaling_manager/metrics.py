@@ -0,0 +1,306 @@
+"""This module has the metric classes (Counter, Gauge and Histogram) and the metrics of the manager app (kept per process), exposed in the Prometheus text format at /metrics/"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(k + '="' + _escape(v) + '"' for k, v in labels.items()) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    """
+    Base class of the metrics; a metric with label names holds one child per combination of label values (see labels)
+
+    Attributes:
+    * name: name of the metric
+    * documentation: help text of the metric
+    * labelnames: tuple of label names
+    """
+
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple = tuple(labelnames)
+        self._children: dict = {}
+        self._lock = Lock()
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def labels(self, *labelvalues):
+        """Returns the child metric for the given label values (created on first use)"""
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(self.name + " expects labels " + str(self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def family_name(self) -> str:
+        """Returns the name the metric is described under in the HELP and TYPE lines"""
+        return self.name
+
+    def samples(self) -> list:
+        """Returns the list of (name suffix, labels, value) samples of the metric"""
+        if self.labelnames:
+            children = list(self._children.items())
+        else:
+            children = [((), self)]
+        samples: list = []
+        for labelvalues, child in children:
+            labels: dict = dict(zip(self.labelnames, labelvalues))
+            samples += child._samples(labels)
+        return samples
+
+    def expose(self) -> str:
+        """Returns the metric in the Prometheus text format"""
+        lines: list = [
+            "# HELP " + self.family_name() + " " + self.documentation,
+            "# TYPE " + self.family_name() + " " + self.type_name,
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(self.name + suffix + _format_labels(labels) + " " + _format_value(value))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """Monotonically increasing count (e.g. number of scale events)"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.value: float = 0
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation, registry=_NO_REGISTRY)
+
+    def family_name(self) -> str:
+        # The samples are named with the _total suffix, so the family is too
+        return self.name + '_total'
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def _samples(self, labels: dict) -> list:
+        return [('_total', labels, self.value)]
+
+class Gauge(Metric):
+    """Value which can go up and down (e.g. number of available servers)"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.value: float = 0
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation, registry=_NO_REGISTRY)
+
+    def set(self, value: float) -> None:
+        # A single assignment is atomic, no lock needed
+        self.value = value
+
+    def _samples(self, labels: dict) -> list:
+        return [('', labels, self.value)]
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. durations in seconds) over fixed buckets"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets: tuple = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts: list = [0] * len(self.buckets)
+        self.sum: float = 0.0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets[:-1], registry=_NO_REGISTRY)
+
+    def observe(self, value: float) -> None:
+        i: int = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Returns a context manager observing the duration (in seconds) of its block"""
+        return Timer(self)
+
+    def _samples(self, labels: dict) -> list:
+        with self._lock:
+            counts: list = list(self.counts)
+            total: float = self.sum
+        samples: list = []
+        cumulative: int = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, cumulative))
+        return samples
+
+class Timer():
+    """Context manager observing the duration of its block in a Histogram"""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram: Histogram = histogram
+
+    def __enter__(self):
+        self.start: float = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start)
+        return False
+
+class Registry():
+    """Collection of metrics exposed together"""
+
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric: Metric) -> None:
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        """Returns all metrics in the Prometheus text format"""
+        return "\n".join(m.expose() for m in self.metrics) + "\n"
+
+class _NoRegistry():
+    """Registry of the child metrics, which are exposed through their parent"""
+
+    def register(self, metric: Metric) -> None:
+        pass
+
+REGISTRY = Registry()
+_NO_REGISTRY = _NoRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics of the manager app
+
+TICK_DURATION = Histogram(
+    'manager_tick_duration_seconds',
+    "Duration of a routine update of the server management",
+)
+TICK_PHASE_DURATION = Histogram(
+    'manager_tick_phase_duration_seconds',
+    "Duration of each phase of a routine update (health_sweep, scaling_decision, standby_reaping)",
+    ['phase'],
+)
+HEALTH_SWEEP_DURATION = TICK_PHASE_DURATION.labels('health_sweep')
+SCALING_DECISION_DURATION = TICK_PHASE_DURATION.labels('scaling_decision')
+STANDBY_REAPING_DURATION = TICK_PHASE_DURATION.labels('standby_reaping')
+HEALTH_CHECK_RTT = Histogram(
+    'manager_health_check_rtt_seconds',
+    "Round trip time of a health api request to a server instance",
+)
+HEALTH_CHECK_FAILURES = Counter(
+    'manager_health_check_failures',
+    "Health api requests which failed or timed out",
+)
+AWS_API_LATENCY = Histogram(
+    'manager_aws_api_latency_seconds',
+    "Latency of AWS api calls by operation",
+    ['operation'],
+)
+AWS_API_THROTTLES = Counter(
+    'manager_aws_api_throttles',
+    "AWS api calls rejected due to throttling (and retried) by operation",
+    ['operation'],
+)
+SELECTION_LATENCY = Histogram(
+    'manager_selection_latency_seconds',
+    "Time taken to select (and reserve) a gameserver for a client in available_gameserver",
+    buckets=FAST_BUCKETS,
+)
+
+AVAILABLE_SERVERS = Gauge('manager_available_servers', "Number of available servers by pool", ['pool'])
+STANDBY_SERVERS = Gauge('manager_standby_servers', "Number of servers in standby by pool", ['pool'])
+PROVISIONING_SERVERS = Gauge('manager_provisioning_servers', "Number of server instances being launched by pool", ['pool'])
+WARM_POOL_SIZE = Gauge('manager_warm_pool_size', "Number of instances ready in the warm pool by pool", ['pool'])
+SUSPECT_SERVERS = Gauge('manager_suspect_servers', "Number of servers whose last health check failed by pool", ['pool'])
+TOTAL_AVAILABLE_CAPACITY = Gauge('manager_total_available_capacity', "Sum of the available capacity of the available servers by pool", ['pool'])
+FORECAST_GROWTH = Gauge('manager_forecast_growth', "Capacity the clients are forecast to take up within a provisioning lead time by pool (PREDICTIVE_SCALING)", ['pool'])
+REPLICA_LEADER = Gauge('manager_replica_leader', "1 if this replica is the leader running the scaling of the pool and 0 if it is a follower (REPLICA_MODE)", ['pool'])
+ADMISSION_QUEUE_DEPTH = Gauge('manager_admission_queue_depth', "Number of clients waiting for gameserver capacity")
+
+ASSIGNMENTS = Counter('manager_assignments', "Clients assigned a gameserver (recorded by the owner process with SHARED_TABLE)")
+SCALE_EVENTS = Counter(
+    'manager_scale_events',
+    "Upscale and downscale decisions carried out",
+    ['direction'],
+)
+BACKUP_GAMESERVER_FALLBACKS = Counter(
+    'manager_backup_gameserver_fallbacks',
+    "Clients sent to the backup gameserver as no server was available",
+)
+ADMISSIONS = Counter(
+    'manager_admissions',
+    "Clients admitted right away (immediate) or after waiting (waited), and clients turned away as the wait queue was full (rejected) or their wait was over (timed_out)",
+    ['result'],
+)
+ADMISSION_WAIT = Histogram(
+    'manager_admission_wait_seconds',
+    "Time clients spent in the admission wait queue",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+WARM_POOL_TAKES = Counter(
+    'manager_warm_pool_takes',
+    "Launches which took an instance from the warm pool (hit) or had to boot a fresh one (miss)",
+    ['result'],
+)
+AFFINITY_ROUTES = Counter(
+    'manager_affinity_routes',
+    "Clients of a game sent to the server hosting it (hosting), picked by the hash ring (ring) or by the selection policy as the ring had no room (fallback)",
+    ['result'],
+)
+POOL_ROUTES = Counter(
+    'manager_pool_routes',
+    "Clients sent to the nearest pool (nearest) or, as the pools nearer to them were saturated, to a farther one (spillover), by pool",
+    ['pool', 'result'],
+)
+LEADERSHIP_CHANGES = Counter(
+    'manager_leadership_changes',
+    "Times this replica took over as the leader of a pool (elected) or stepped down to follower (demoted)",
+    ['pool', 'result'],
+)
+HEARTBEATS = Counter(
+    'manager_heartbeats',
+    "Heartbeats pushed by gameservers by result (applied, stale, unknown, invalid)",
+    ['result'],
+)
+UNRESPONSIVE_SERVER_REMOVALS = Counter(
+    'manager_unresponsive_server_removals',
+    "Servers removed as they didn't respond to health checks",
+)
+
+def aws_call(operation: str) -> Timer:
+    """Returns a context manager observing the latency of an AWS api call in AWS_API_LATENCY"""
+    return Timer(AWS_API_LATENCY.labels(operation))
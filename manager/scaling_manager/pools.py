@@ -0,0 +1,126 @@
+"""This module has the Pool class describing a pool of gameservers (region, cluster, launch template and margins) and the functions ranking the pools for a client by locality"""
+
+import os
+from threading import Lock
+from django.conf import settings
+from .aws_client import AWSClient, get_ec2_client, get_ecs_client
+
+DEFAULT_POOL_NAME = 'default'
+POOL_KEYS = ('region', 'cluster', 'launch_template', 'task_definition', 'upscale_margin', 'downscale_margin', 'aliases', 'spillover')
+
+class Pool():
+    """
+    Named pool of gameservers in one AWS region and ECS cluster, managed by its own ServerManagerThread.
+    Settings a pool doesn't set are taken from the global ones (AWS_REGION, ECS_CLUSTER, ECS_INSTANCE_LAUNCH_TEMPLATE, SERVER_TASK_DEFINITION, UPSCALE_MARGIN and DOWNSCALE_MARGIN).
+
+    Attributes:
+    * name: name of the pool
+    * region: AWS region of the pool
+    * cluster: ECS cluster the gameserver tasks run in (None for the default cluster)
+    * launch_template: EC2 launch template of the ECS instances; its user data must register the instances to the cluster
+    * task_definition: task definition used to launch the gameserver tasks
+    * upscale_margin: min extra capacity maintained in the pool
+    * downscale_margin: max extra capacity maintained in the pool
+    * aliases: list of client region hints (e.g. country or continent codes) the pool serves, on top of its name and region
+    * spillover: list of names of the pools clients hinted to this pool are sent to when it is saturated, nearest first
+    """
+
+    def __init__(self, name: str, region: str = None, cluster: str = None, launch_template: str = None, task_definition: str = None,
+                 upscale_margin: int = None, downscale_margin: int = None, aliases: list = (), spillover: list = ()):
+        self.name: str = name
+        self.region: str = region or settings.AWS_REGION
+        self.cluster: str = cluster or settings.ECS_CLUSTER or None
+        self.launch_template: str = launch_template or settings.ECS_INSTANCE_LAUNCH_TEMPLATE
+        self.task_definition: str = task_definition or settings.SERVER_TASK_DEFINITION
+        self.upscale_margin: int = settings.UPSCALE_MARGIN if upscale_margin is None else upscale_margin
+        self.downscale_margin: int = settings.DOWNSCALE_MARGIN if downscale_margin is None else downscale_margin
+        self.aliases: list = [a.lower() for a in aliases]
+        self.spillover: list = list(spillover)
+        assert (self.downscale_margin - self.upscale_margin) > settings.SERVER_CAPACITY, "Margins of pool " + name + " are too close"
+
+    def ecs_client(self) -> AWSClient:
+        return get_ecs_client(self.region)
+
+    def ec2_client(self) -> AWSClient:
+        return get_ec2_client(self.region)
+
+    def serves(self, hint: str) -> bool:
+        """Returns True if the client region hint (case insensitive) names the pool, its region or one of its aliases and False otherwise"""
+        hint = hint.lower()
+        return hint == self.name.lower() or hint == self.region.lower() or hint in self.aliases
+
+    def get_path(self, path: str) -> str:
+        """Returns the path of the pool's own copy of a local file (e.g. the state journal); the default pool uses the path as is"""
+        if self.name == DEFAULT_POOL_NAME:
+            return path
+        root, extension = os.path.splitext(path)
+        return root + "." + self.name + extension
+
+_pools: dict = None
+_pools_lock = Lock()
+
+def get_pools() -> dict:
+    """
+    Returns a dict mapping the name of every pool to its Pool, in the order the pools are declared in POOLS (the first one is the default pool of clients without a locality hint).
+    Without POOLS, there is a single pool named 'default' made of the global settings.
+    """
+    global _pools
+    with _pools_lock:
+        if _pools is None:
+            pools: dict = {}
+            for name, config in (settings.POOLS or {DEFAULT_POOL_NAME: {}}).items():
+                unknown: set = set(config) - set(POOL_KEYS)
+                if unknown:
+                    raise ValueError("Unknown settings " + ", ".join(sorted(unknown)) + " of pool " + name)
+                pools[name] = Pool(name, **config)
+            for pool in pools.values():
+                for name in pool.spillover:
+                    if name not in pools:
+                        raise ValueError("Pool " + pool.name + " spills over to unknown pool " + name)
+            _pools = pools
+        return _pools
+
+def reset_pools() -> None:
+    """Forgets the pools so that they are built anew from the settings on next use; meant for tests"""
+    global _pools
+    with _pools_lock:
+        _pools = None
+
+def get_default_pool() -> Pool:
+    return next(iter(get_pools().values()))
+
+def parse_rtts(value: str) -> dict:
+    """
+    Returns a dict mapping pool name to round trip time (in milliseconds) from the client's probes, given as 'name:rtt,name:rtt,...'.
+    Raises ValueError if the probes are malformed.
+    """
+    rtts: dict = {}
+    for item in value.split(','):
+        name, sep, rtt = item.partition(':')
+        if not sep:
+            raise ValueError("rtt must be given as pool:milliseconds pairs separated by commas")
+        milliseconds: float = float(rtt)
+        if not milliseconds >= 0: # also rejects nan
+            raise ValueError("rtt must be a non negative number of milliseconds")
+        rtts[name.strip()] = milliseconds
+    return rtts
+
+def rank_pools(region: str = None, rtts: dict = None) -> list:
+    """
+    Returns the list of pool names ordered from the nearest to the farthest pool for a client:
+    * by the round trip times the client probed (pools it didn't probe come after, in declared order), if it probed any pool;
+    * else the pools serving its region hint first, then the pools they spill over to, if any pool serves the hint;
+    * else in declared order.
+    """
+    pools: dict = get_pools()
+    names: list = list(pools)
+    probed: dict = {name: rtt for name, rtt in (rtts or {}).items() if name in pools}
+    if probed:
+        # sorted is stable, so pools with the same (or no) rtt keep their declared order
+        return sorted(names, key=lambda name: probed.get(name, float('inf')))
+    if region:
+        ranked: list = [name for name in names if pools[name].serves(region)]
+        for name in list(ranked):
+            ranked += [s for s in pools[name].spillover if s not in ranked]
+        return ranked + [name for name in names if name not in ranked]
+    return names
@@ -0,0 +1,213 @@
+"""This module has classes (Launch and Provisioner) to launch new server instances in the background without blocking the management thread"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock
+from time import monotonic, sleep
+from django.conf import settings
+from .aws_utils import *
+
+class Launch():
+    """
+    Tracks a server instance being launched
+
+    Attributes:
+    * launch_id: integer identifying the launch
+    * state: string from {'PROVISIONING', 'PENDING', 'RUNNING', 'FAILED'}
+        * PROVISIONING: the EC2 instance is being launched
+        * PENDING: the task has been started and is waiting to be RUNNING
+        * RUNNING: the server instance is ready to be added to the available servers
+        * FAILED: the launch couldn't be completed
+    * ec2_id: string storing ec2 id of the launched instance (None until it is launched)
+    * task_arn: string storing aws task arn of the server instance (None until the task is started)
+    * server: the Server object once the launch is RUNNING
+    * started_at: monotonic time (in seconds) at which the launch was requested
+    * finished_at: monotonic time (in seconds) at which the launch became RUNNING (None until then)
+    * warm: boolean flag specifying whether the EC2 instance was taken from the warm pool
+    """
+
+    IN_FLIGHT_STATES = ('PROVISIONING', 'PENDING')
+
+    def __init__(self, launch_id: int):
+        self.launch_id: int = launch_id
+        self.state: str = 'PROVISIONING'
+        self.ec2_id: str = None
+        self.task_arn: str = None
+        self.server = None
+        self.started_at: float = monotonic()
+        self.finished_at: float = None
+        self.warm: bool = False
+
+    def in_flight(self) -> bool:
+        return self.state in self.IN_FLIGHT_STATES
+
+class Provisioner():
+    """
+    Launches server instances on a pool of worker threads so that the (multi minute) AWS waiters don't block the management thread.
+    The management thread requests launches with launch() and picks up the ready server instances with collect() on every update.
+
+    Attributes:
+    * task_family: task definition used to launch the gameserver tasks
+    * server_class: class used to wrap a launched task (Server)
+    * warm_pool: WarmPool EC2 instances are taken from before booting fresh ones (None to always boot fresh ones)
+    * placement_mode: 'distinct' (one task per EC2 instance) or 'binpack' (tasks are packed onto registered instances)
+    * pool: Pool the server instances are launched in
+    * launches: list of Launch objects which haven't been collected yet
+    * placement_lock: lock held while a task is being placed until the instance it landed on is known; see ServerManagerThread.remove_server
+    * in_use: function telling whether a server instance runs on an EC2 instance (see ServerManagerThread.is_instance_in_use); such an instance is kept when a launch on it fails
+    * launch_duration: expected time (in seconds) a launch takes, as an exponentially weighted moving average of the completed launches (None until a launch completes)
+    """
+
+    # The ECS agent of an instance that was just booted (or started) may take a few seconds to connect, so the task placement is retried
+    TASK_PLACEMENT_ATTEMPTS = 5
+    TASK_PLACEMENT_RETRY_DELAY = 3.0
+    # Weight of the latest launch in launch_duration
+    LAUNCH_DURATION_WEIGHT = 0.3
+
+    def __init__(self, task_family: str, server_class, max_workers: int = None, warm_pool=None, placement_mode: str = None, pool: Pool = None, in_use=None):
+        self.task_family: str = task_family
+        self.server_class = server_class
+        self.warm_pool = warm_pool
+        self.placement_mode: str = placement_mode or settings.PLACEMENT_MODE
+        self.pool: Pool = pool or get_default_pool()
+        self.launches: list = []
+        self.placement_lock = Lock()
+        self.in_use = in_use or (lambda ec2_id: ec2_id in self.get_ec2_ids_in_use())
+        self.launch_duration: float = None
+        self._lock = Lock()
+        self._ids = count(1)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.PROVISIONING_WORKERS,
+            thread_name_prefix='provisioning'
+        )
+
+    def launch(self) -> Launch:
+        """Requests a new server instance and returns the Launch tracking it"""
+        launch = Launch(next(self._ids))
+        with self._lock:
+            self.launches.append(launch)
+        if self.warm_pool is not None:
+            self.warm_pool.record_launch()
+        self._executor.submit(self._run, launch)
+        return launch
+
+    def in_flight(self) -> int:
+        """Returns the number of launches which are yet to complete"""
+        with self._lock:
+            return sum(1 for launch in self.launches if launch.in_flight())
+
+    def collect(self) -> list:
+        """Returns the Server objects of launches which are RUNNING and forgets all completed launches"""
+        with self._lock:
+            completed: list = [launch for launch in self.launches if not launch.in_flight()]
+            self.launches = [launch for launch in self.launches if launch.in_flight()]
+            for launch in completed:
+                if launch.finished_at is not None:
+                    self._record_duration(launch.finished_at - launch.started_at)
+        return [launch.server for launch in completed if launch.state == 'RUNNING']
+
+    def get_eta(self, now: float = None) -> float:
+        """
+        Returns the time (in seconds) until the next launch in flight is expected to be RUNNING (0 if it is overdue), or None if no launch is in flight.
+        Until a launch has completed, launches are expected to take ADMISSION_RETRY_AFTER seconds.
+        """
+        now = monotonic() if now is None else now
+        duration: float = self.launch_duration if self.launch_duration is not None else settings.ADMISSION_RETRY_AFTER
+        with self._lock:
+            started: list = [launch.started_at for launch in self.launches if launch.in_flight()]
+        if not started:
+            return None
+        return max(min(started) + duration - now, 0.0)
+
+    def _record_duration(self, duration: float) -> None:
+        if self.launch_duration is None:
+            self.launch_duration = duration
+        else:
+            self.launch_duration += self.LAUNCH_DURATION_WEIGHT * (duration - self.launch_duration)
+
+    def get_task_arns_in_flight(self) -> set:
+        """Returns the task arns of the launches which haven't been collected yet"""
+        with self._lock:
+            return {launch.task_arn for launch in self.launches if launch.task_arn is not None}
+
+    def get_ec2_ids_in_use(self) -> set:
+        """Returns the ec2 ids of the instances the launches which haven't been collected yet have placed (or will place) a task on"""
+        with self._lock:
+            return {launch.ec2_id for launch in self.launches if launch.ec2_id is not None and launch.state != 'FAILED'}
+
+    def _place_task(self, launch: Launch) -> bool:
+        """
+        Starts the gameserver task on a registered instance which can fit it (binpack).
+        Returns True if the task is started and False if no registered instance can fit it.
+        """
+        with self.placement_lock:
+            # The idle instances of the warm pool are taken whole by a launch (see take)
+            warm_ec2_ids: set = self.warm_pool.get_ec2_ids() if self.warm_pool is not None else set()
+            task_description: dict = place_task(self.task_family, self.pool, warm_ec2_ids)
+            if task_description is None:
+                return False
+            launch.task_arn = task_description['taskArn']
+            launch.ec2_id = get_ec2_id(task_description, self.pool.ecs_client(), self.pool.cluster)
+        if self.warm_pool is not None and self.warm_pool.discard(launch.ec2_id):
+            print("Launch", launch.launch_id, "took warm pool instance", launch.ec2_id, "out of the pool")
+        return True
+
+    def _launch_task(self, ec2_id: str) -> str:
+        """Starts the gameserver task on the given instance and returns the task arn"""
+        for attempt in range(1, self.TASK_PLACEMENT_ATTEMPTS + 1):
+            try:
+                return launch_task(self.task_family, ec2_id, self.pool)
+            except Exception as e:
+                if attempt == self.TASK_PLACEMENT_ATTEMPTS:
+                    raise
+                print("Unable to place task on", ec2_id, "due to", e, "- retrying")
+                sleep(self.TASK_PLACEMENT_RETRY_DELAY)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Cancels the launches which haven't started yet; with wait set, blocks until the ones already started are done"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(self, launch: Launch) -> None:
+        """Carries out the launch (on a worker thread)"""
+        try:
+            if self.placement_mode == 'binpack' and self._place_task(launch):
+                print("Launch", launch.launch_id, "packed onto", launch.ec2_id)
+            else:
+                warm_instance: tuple = self.warm_pool.take() if self.warm_pool is not None else None
+                if warm_instance is None:
+                    # The ec2 id is known as soon as the instance is launched, so that it is terminated if the launch fails
+                    launch.ec2_id = run_ecs_instance(pool=self.pool)
+                    wait_for_instance(launch.ec2_id, self.pool)
+                else:
+                    launch.ec2_id, state = warm_instance
+                    launch.warm = True
+                    print("Launch", launch.launch_id, "takes warm pool instance", launch.ec2_id)
+                    if state == 'stopped':
+                        start_ec2(launch.ec2_id, self.pool)
+                launch.task_arn = self._launch_task(launch.ec2_id)
+            launch.state = 'PENDING'
+            server = self.server_class(launch.task_arn, pool=self.pool)
+            launch.server = server
+            launch.finished_at = monotonic()
+            launch.state = 'RUNNING'
+            print("Launch", launch.launch_id, "is running at", server.address)
+        except Exception as e:
+            print("Launch", launch.launch_id, "failed due to the following exception")
+            print(e)
+            launch.state = 'FAILED'
+            self._release(launch)
+
+    def _release(self, launch: Launch) -> None:
+        """Stops the task of a failed launch and terminates its EC2 instance, unless a server instance runs on it"""
+        try:
+            if launch.ec2_id is not None:
+                # No task may be placed on the instance while it is found empty and terminated (see ServerManagerThread.remove_server)
+                with self.placement_lock:
+                    if not self.in_use(launch.ec2_id):
+                        terminate_ec2(launch.ec2_id, self.pool) # along with the task
+                        return
+            if launch.task_arn is not None:
+                stop_task(launch.task_arn, "Launch failed", self.pool)
+        except Exception as e:
+            print("Unable to release the instance of launch", launch.launch_id, "due to the following exception")
+            print(e)
@@ -0,0 +1,242 @@
+"""This module has the lease backends (SQLiteLeaseBackend and FileLeaseBackend) and the LeaderElector used in REPLICA_MODE, where only the replica holding a pool's lease (the leader) scales it"""
+
+from abc import ABC, abstractmethod
+import atexit
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import socket
+import sqlite3
+from threading import Lock
+from time import monotonic, time
+from django.conf import settings
+
+class LeaseBackend(ABC):
+    """
+    Store of the leases (one per name, i.e. per pool, expiring at a wall clock time) and of the server tables the leaders replicate to the followers.
+    """
+
+    @abstractmethod
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        """Acquires the lease for holder for ttl seconds, or renews it if holder holds it. Returns True if holder holds the lease and False if another holder's lease hasn't expired"""
+
+    @abstractmethod
+    def release(self, name: str, holder: str) -> None:
+        """Gives up the lease if holder holds it, so that another replica can take over right away"""
+
+    @abstractmethod
+    def get_holder(self, name: str) -> str:
+        """Returns the holder of the lease, or None if the lease is free (or expired)"""
+
+    @abstractmethod
+    def publish(self, name: str, body: str) -> None:
+        """Stores the server table replicated by the leader"""
+
+    @abstractmethod
+    def fetch(self, name: str) -> str:
+        """Returns the server table last replicated by the leader, or None if there is none"""
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """
+    LeaseBackend storing the leases and replicated tables as rows of a SQLite database.
+
+    Attributes:
+    * path: path of the database file
+    """
+
+    def __init__(self, path: str = None):
+        self.path: str = path or settings.REPLICA_LEASE_PATH
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS replicas (name TEXT PRIMARY KEY, body TEXT NOT NULL)")
+
+    @contextmanager
+    def connect(self):
+        # A connection per call, as a connection can't be shared between threads; the timeout covers the transactions of the other replicas
+        connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        with self.connect() as connection:
+            # Takes the write lock up front, so that two replicas can't both find the lease expired
+            # (closing the connection rolls back a transaction which isn't committed)
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            now: float = time()
+            if row is not None and row[0] != holder and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)", (name, holder, now + ttl))
+            connection.execute("COMMIT")
+            return True
+
+    def release(self, name: str, holder: str) -> None:
+        with self.connect() as connection:
+            connection.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def get_holder(self, name: str) -> str:
+        with self.connect() as connection:
+            row = connection.execute("SELECT holder FROM leases WHERE name = ? AND expires_at > ?", (name, time())).fetchone()
+        return row[0] if row is not None else None
+
+    def publish(self, name: str, body: str) -> None:
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO replicas VALUES (?, ?)", (name, body))
+
+    def fetch(self, name: str) -> str:
+        with self.connect() as connection:
+            row = connection.execute("SELECT body FROM replicas WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    LeaseBackend storing the leases in a json file, updated under an exclusive file lock, and each replicated table in a file of its own.
+    Note: The backend uses fcntl locks and is meant for Linux/Unix hosts only.
+
+    Attributes:
+    * path: path of the lease file; the lock file and replicated tables are stored next to it
+    """
+
+    def __init__(self, path: str = None):
+        self.path: str = path or settings.REPLICA_LEASE_PATH
+        # fcntl locks are held per process, so the threads of a process are excluded by a thread lock
+        self._lock = Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock, open(self.path + ".lock", 'a+b') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_leases(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write(self, path: str, body: str) -> None:
+        # Replaced atomically, so that readers never see a partially written file
+        temporary_path: str = path + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(body)
+        os.replace(temporary_path, path)
+
+    def get_replica_path(self, name: str) -> str:
+        return self.path + "." + name + ".json"
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        with self.locked():
+            leases: dict = self.read_leases()
+            lease: dict = leases.get(name)
+            now: float = time()
+            if lease is not None and lease['holder'] != holder and lease['expires_at'] > now:
+                return False
+            leases[name] = {'holder': holder, 'expires_at': now + ttl}
+            self.write(self.path, json.dumps(leases))
+            return True
+
+    def release(self, name: str, holder: str) -> None:
+        with self.locked():
+            leases: dict = self.read_leases()
+            if name in leases and leases[name]['holder'] == holder:
+                del leases[name]
+                self.write(self.path, json.dumps(leases))
+
+    def get_holder(self, name: str) -> str:
+        with self.locked():
+            lease: dict = self.read_leases().get(name)
+        return lease['holder'] if lease is not None and lease['expires_at'] > time() else None
+
+    def publish(self, name: str, body: str) -> None:
+        self.write(self.get_replica_path(name), body)
+
+    def fetch(self, name: str) -> str:
+        try:
+            with open(self.get_replica_path(name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+LEASE_BACKENDS: dict = {
+    'sqlite': SQLiteLeaseBackend,
+    'file': FileLeaseBackend,
+}
+
+def get_lease_backend() -> LeaseBackend:
+    """Returns the lease backend set by REPLICA_LEASE_BACKEND"""
+    return LEASE_BACKENDS[settings.REPLICA_LEASE_BACKEND]()
+
+def get_replica_id() -> str:
+    """Returns the name of this replica in the leases (REPLICA_ID, or hostname:pid by default)"""
+    return settings.REPLICA_ID or socket.gethostname() + ":" + str(os.getpid())
+
+class LeaderElector():
+    """
+    Acquires and renews (RENEWALS_PER_TTL times per ttl) the lease of a name (a pool) on a LeaseBackend for this replica.
+    A leader only acts as such until its lease expires by its own monotonic clock, less CLOCK_DRIFT of the ttl, so that two replicas never act as the leader at once.
+
+    Attributes:
+    * backend: LeaseBackend holding the lease
+    * name: name of the lease
+    * holder: name of this replica in the lease
+    * ttl: time (in seconds) a lease lasts unless renewed
+    * leader: True if this replica held the lease at the last renewal and False otherwise
+    * valid_until: monotonic time until which this replica may act as the leader
+    * next_renewal: monotonic time at which the lease is next renewed (or attempted to be acquired)
+    """
+
+    RENEWALS_PER_TTL = 3
+    CLOCK_DRIFT = 0.1
+
+    def __init__(self, backend: LeaseBackend, name: str, holder: str = None, ttl: float = None):
+        self.backend: LeaseBackend = backend
+        self.name: str = name
+        self.holder: str = holder or get_replica_id()
+        self.ttl: float = ttl or settings.REPLICA_LEASE_TTL
+        self.leader: bool = False
+        self.valid_until: float = 0.0
+        self.next_renewal: float = 0.0
+        # A replica shutting down hands the lease over right away instead of letting it expire
+        atexit.register(self.release)
+
+    def is_leader(self, now: float = None) -> bool:
+        """Returns True if this replica holds a lease which hasn't expired and False otherwise"""
+        now = monotonic() if now is None else now
+        return self.leader and now < self.valid_until
+
+    def tick(self, now: float = None) -> bool:
+        """
+        Renews (or attempts to acquire) the lease if it is due.
+        Returns True if this replica is the leader and False otherwise.
+        """
+        now = monotonic() if now is None else now
+        if now >= self.next_renewal:
+            self.next_renewal = now + self.ttl / self.RENEWALS_PER_TTL
+            try:
+                self.leader = self.backend.acquire(self.name, self.holder, self.ttl)
+                if self.leader:
+                    # Counted from before the renewal, as the lease may have been written at any time since
+                    self.valid_until = now + self.ttl * (1 - self.CLOCK_DRIFT)
+            except Exception as e:
+                # The lease may still be held until valid_until; it is renewed again at the next tick
+                print("Unable to renew the lease of", self.name, "due to the following exception")
+                print(e)
+        return self.is_leader(now)
+
+    def release(self) -> None:
+        """Gives up the lease if this replica holds it"""
+        if not self.leader:
+            return
+        self.leader = False
+        try:
+            self.backend.release(self.name, self.holder)
+        except Exception as e:
+            print("Unable to release the lease of", self.name, "due to the following exception")
+            print(e)
@@ -0,0 +1,47 @@
+"""This module has the ReservationLedger class which tracks the clients sent to a server instance that its health reports don't reflect yet"""
+
+from collections import deque
+from time import monotonic
+from django.conf import settings
+
+class ReservationLedger():
+    """
+    Clients sent to a server instance (reservations), held until a health report reflects them (settle) or for ttl seconds.
+    Note that the class isn't thread safe by itself.
+    """
+
+    def __init__(self, ttl: float = None):
+        self.ttl: float = settings.RESERVATION_TTL if ttl is None else ttl
+        self._reservations = deque()
+        self._count: int = 0
+
+    def reserve(self, count: int = 1, now: float = None) -> None:
+        """Records count new reservations"""
+        now = monotonic() if now is None else now
+        self._reservations.append([now + self.ttl, count])
+        self._count += count
+
+    def settle(self, count: int) -> None:
+        """Clears up to count oldest reservations, as they are now reflected by the health report"""
+        while count > 0 and self._reservations:
+            oldest = self._reservations[0]
+            cleared = min(count, oldest[1])
+            oldest[1] -= cleared
+            self._count -= cleared
+            count -= cleared
+            if oldest[1] == 0:
+                self._reservations.popleft()
+
+    def outstanding(self, now: float = None) -> int:
+        """Returns the number of unexpired reservations"""
+        if self._count == 0:
+            return 0
+        now = monotonic() if now is None else now
+        while self._reservations and self._reservations[0][0] <= now:
+            self._count -= self._reservations.popleft()[1]
+        return self._count
+
+    def clear(self) -> None:
+        """Drops all reservations"""
+        self._reservations.clear()
+        self._count = 0
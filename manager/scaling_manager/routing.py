@@ -0,0 +1,138 @@
+"""This module has the PoolRouter class which assigns clients gameservers across several pools (see pools), nearest pool first"""
+
+from . import metrics
+from .pools import rank_pools
+from .server_classes import Server, ServerManagerThread
+from .snapshot import FleetSnapshot, merge_snapshots
+
+# Last merged snapshot as (merged snapshots, snapshot), so that the bodies are only serialized again once a pool publishes a new snapshot
+_merged_snapshot: tuple = (None, None)
+
+class PoolRouter():
+    """
+    Assigns a client a gameserver of the nearest pool with capacity left (or of the pool hosting its game), with the methods the views call on a ServerManagerThread.
+    Only if every pool is saturated is a server of the nearest pool oversubscribed.
+
+    Attributes:
+    * managers: list of the ServerManagerThreads of the pools, nearest first
+    """
+
+    def __init__(self, managers: list):
+        self.managers: list = managers
+
+    def rank(self, game_id: str = None) -> list:
+        """Returns the managers nearest first, with the manager of the pool hosting the game (if any) moved to the front"""
+        if game_id is not None:
+            for i, manager in enumerate(self.managers):
+                with manager.lock:
+                    if manager.affinity.hosts(game_id):
+                        return [manager] + self.managers[:i] + self.managers[i + 1:]
+        return self.managers
+
+    @staticmethod
+    def record_route(manager: ServerManagerThread, ranked: list) -> None:
+        metrics.POOL_ROUTES.labels(manager.pool.name, 'nearest' if manager is ranked[0] else 'spillover').inc()
+
+    def get_available_server(self, game_id: str = None, require_capacity: bool = False) -> Server:
+        """
+        Returns an available server of the nearest pool which has capacity left (see ServerManagerThread.get_available_server).
+        If no pool has any, a server of the nearest pool with available servers is returned, or None with require_capacity set.
+        Raises IndexError if there is no available server in any pool (unless require_capacity is set)
+        """
+        ranked: list = self.rank(game_id)
+        for manager in ranked:
+            server: Server = manager.get_available_server(game_id, require_capacity=True)
+            if server is not None:
+                self.record_route(manager, ranked)
+                return server
+        if require_capacity:
+            return None
+        for manager in ranked:
+            if manager.available_servers:
+                self.record_route(manager, ranked)
+                return manager.get_available_server(game_id)
+        raise IndexError("No available server in any pool")
+
+    def reserve_server(self, game_id: str = None) -> Server:
+        """Returns an available server with capacity reserved for the client, or None if no pool has capacity left"""
+        return self.get_available_server(game_id, require_capacity=True)
+
+    def try_admit(self, game_id: str, ranked: list) -> Server:
+        """Returns a server with capacity reserved for the client from the nearest pool which has capacity left and no waiting clients (they come first), or None if there is none"""
+        for manager in ranked:
+            with manager.lock:
+                if len(manager.admission) > 0:
+                    continue
+                server: Server = manager.reserve_server(game_id)
+            if server is not None:
+                self.record_route(manager, ranked)
+                return server
+        return None
+
+    def get_admitting_manager(self, ranked: list) -> ServerManagerThread:
+        """Returns the manager of the nearest pool which has available servers or launches in flight, whose wait queue a client waits in; raises IndexError if there is none"""
+        for manager in ranked:
+            try:
+                manager.check_admissible()
+                return manager
+            except IndexError:
+                continue
+        raise IndexError("No available server and no launch in flight in any pool")
+
+    def admit(self, game_id: str = None, wait: float = 0.0) -> Server:
+        """
+        Returns a server with capacity reserved for the client from the nearest pool which has capacity left, or else waits up to wait seconds in the wait queue of the nearest pool (see ServerManagerThread.admit)
+        Raises Saturated if the client isn't admitted, and IndexError if no pool has available servers or launches in flight
+        """
+        ranked: list = self.rank(game_id)
+        server: Server = self.try_admit(game_id, ranked)
+        if server is not None:
+            return server
+        return self.get_admitting_manager(ranked).admit(game_id, wait)
+
+    async def admit_async(self, game_id: str = None, wait: float = 0.0) -> Server:
+        """asyncio counterpart of admit"""
+        ranked: list = self.rank(game_id)
+        server: Server = self.try_admit(game_id, ranked)
+        if server is not None:
+            return server
+        return await self.get_admitting_manager(ranked).admit_async(game_id, wait)
+
+    def reserve_groups(self, group_sizes: list) -> list:
+        """Reserves capacity for a batch of groups of clients in the nearest pool, and for the groups which don't fit there in the next nearest pools (see ServerManagerThread.reserve_groups)"""
+        assigned: list = [None] * len(group_sizes)
+        for manager in self.managers:
+            pending: list = [i for i, server in enumerate(assigned) if server is None]
+            if not pending:
+                break
+            for i, server in zip(pending, manager.reserve_groups([group_sizes[i] for i in pending])):
+                assigned[i] = server
+        return assigned
+
+    def get_snapshot(self) -> FleetSnapshot:
+        """Returns the snapshot of the available servers of every pool, nearest first, merged from their latest published snapshots (see merge_snapshots)"""
+        global _merged_snapshot
+        snapshots: list = [manager.get_snapshot() for manager in self.managers]
+        if len(snapshots) == 1:
+            return snapshots[0]
+        # Published snapshots are immutable, so the merged one holds as long as the same ones are merged (in the same order)
+        key: tuple = tuple(snapshots)
+        cached_key, merged = _merged_snapshot
+        if cached_key != key:
+            merged = merge_snapshots(snapshots)
+            # Swapped in a single assignment, so concurrent requests read either the old or the new entry
+            _merged_snapshot = (key, merged)
+        return merged
+
+    def ingest_heartbeat(self, task_arn: str, seq: int, state_json: dict) -> bool:
+        """Applies a heartbeat pushed by a server instance of any pool (see ServerManagerThread.ingest_heartbeat); raises KeyError if no pool knows the server instance"""
+        for manager in self.managers:
+            try:
+                return manager.ingest_heartbeat(task_arn, seq, state_json)
+            except KeyError:
+                continue
+        raise KeyError(task_arn)
+
+def get_pool_router(region: str = None, rtts: dict = None) -> PoolRouter:
+    """Returns the PoolRouter over the pools ranked for a client with the given region hint and round trip times (see rank_pools)"""
+    return PoolRouter([ServerManagerThread.get_instance(name) for name in rank_pools(region, rtts)])
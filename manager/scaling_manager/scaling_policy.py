@@ -0,0 +1,79 @@
+"""This module has the ScalingPolicy class which decides how many server instances to add or remove on every update"""
+
+from math import ceil
+from time import monotonic
+from django.conf import settings
+
+class ScalingPolicy():
+    """
+    Sizes scale-out and scale-in steps to the capacity deficit or excess, up to max_scale_out_burst and max_scale_in_step server instances (never the last one).
+    A scale-in needs scale_in_stable_ticks consecutive updates above the downscale margin, and the steps are spaced by the cooldowns.
+    The forecast growth (see DemandForecast) is added to the upscale margin, up to a server capacity below the downscale margin.
+    """
+
+    def __init__(self, upscale_margin: int = None, downscale_margin: int = None, server_capacity: int = None):
+        self.upscale_margin: int = settings.UPSCALE_MARGIN if upscale_margin is None else upscale_margin
+        self.downscale_margin: int = settings.DOWNSCALE_MARGIN if downscale_margin is None else downscale_margin
+        self.server_capacity: int = server_capacity or settings.SERVER_CAPACITY
+
+        self.max_scale_out_burst: int = settings.SCALE_OUT_MAX_BURST
+        self.max_scale_in_step: int = settings.SCALE_IN_MAX_STEP
+        self.scale_out_cooldown: float = settings.SCALE_OUT_COOLDOWN
+        self.scale_in_cooldown: float = settings.SCALE_IN_COOLDOWN
+        self.scale_in_stable_ticks: int = settings.SCALE_IN_STABLE_TICKS
+
+        self.last_scale_out: float = None
+        self.last_scale_in: float = None
+        self.excess_ticks: int = 0 # number of consecutive updates with capacity above the downscale margin
+
+    def decide(self, available_capacity: int, in_flight_capacity: int, available_server_count: int, now: float = None, forecast_growth: int = 0) -> int:
+        """
+        Returns the number of server instances to add (positive) or remove (negative), or 0 to leave the fleet as it is.
+        forecast_growth is the capacity the clients are forecast to take up within a provisioning lead time (0 without a forecast).
+        The decision is assumed to be carried out, i.e. cooldowns start from this call.
+        """
+        now = monotonic() if now is None else now
+        projected_capacity: int = available_capacity + in_flight_capacity
+        target_capacity: int = self.get_target_capacity(forecast_growth)
+
+        if projected_capacity < target_capacity:
+            self.excess_ticks = 0
+            if self._cooling_down(self.last_scale_out, self.scale_out_cooldown, now):
+                return 0
+            deficit: int = target_capacity - projected_capacity
+            count: int = min(ceil(deficit / self.server_capacity), self.max_scale_out_burst)
+            self.last_scale_out = now
+            return count
+
+        if available_capacity > self.downscale_margin and in_flight_capacity == 0:
+            self.excess_ticks += 1
+            if self.excess_ticks < self.scale_in_stable_ticks:
+                return 0
+            if self._cooling_down(self.last_scale_in, self.scale_in_cooldown, now) or \
+                    self._cooling_down(self.last_scale_out, self.scale_in_cooldown, now):
+                return 0
+            count: int = self.get_scale_in_count(available_capacity, available_server_count)
+            if count <= 0:
+                return 0
+            self.last_scale_in = now
+            self.excess_ticks = 0
+            return -count
+
+        self.excess_ticks = 0
+        return 0
+
+    def get_target_capacity(self, forecast_growth: int = 0) -> int:
+        """Returns the available capacity (including in-flight launches) to be maintained: the upscale margin plus the forecast growth, within the margins (see class docstring)"""
+        ceiling: int = max(self.downscale_margin - self.server_capacity, self.upscale_margin)
+        return min(self.upscale_margin + max(forecast_growth, 0), ceiling)
+
+    def get_scale_in_count(self, available_capacity: int, available_server_count: int) -> int:
+        """Returns the number of server instances a scale-in would remove at the given available capacity (0 if it isn't above the downscale margin)"""
+        excess: int = available_capacity - self.downscale_margin
+        if excess <= 0:
+            return 0
+        return max(min(max(1, excess // self.server_capacity), self.max_scale_in_step, available_server_count - 1), 0)
+
+    @staticmethod
+    def _cooling_down(last: float, cooldown: float, now: float) -> bool:
+        return last is not None and (now - last) < cooldown
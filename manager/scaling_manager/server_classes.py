@@ -1,10 +1,28 @@
 """This module has classes (Server and ServerManager) for management and autoscaling of Gameservers on AWS"""
 
-from time import sleep
+import heapq
+import math
+from time import monotonic, perf_counter, sleep
 from django.conf import settings
 import requests
-from threading import Thread
+from threading import Thread, RLock
 from .aws_utils import *
+from .health_checks import HealthChecker
+from .health_scheduler import HealthScheduler
+from .affinity import GameAffinity
+from .shared_table import task_key
+from .capacity_index import CapacityIndex
+from .provisioning import Provisioner
+from .scaling_policy import ScalingPolicy
+from .reservations import ReservationLedger
+from .snapshot import FleetSnapshot
+from .warm_pool import WarmPool
+from .journal import StateJournal
+from .replication import LeaderElector, get_lease_backend
+from .pools import Pool, get_default_pool, get_pools, reset_pools
+from .admission import AdmissionQueue, get_retry_after
+from .forecast import DemandForecast, DemandHistory
+from . import metrics
 
 class Server():
     """
@@ -14,27 +32,54 @@ class Server():
     * task_arn: string storing aws task arn of the server instance
     * address: string storing socket address of the server instance
     * status: string from {'RUNNING', 'PENDING', 'STOPPED'}
-    * available_capacity: integer measure of capacity of the server instance to handle future connections; note that this is weakly consistent and not real time
+    * reported_capacity: integer capacity of the server instance to handle future connections as last reported by its health api; note that this is weakly consistent and not real time
+    * reservations: ReservationLedger of clients sent to the server instance which the health api doesn't reflect yet
+    * available_capacity: (read only) reported capacity minus unexpired reservations
     * ready_to_close: boolean flag specifying whether the server instance can be terminated
+    * heartbeat_seq: sequence number of the last heartbeat pushed by the server instance (None if it doesn't push heartbeats)
+    * last_heartbeat: monotonic time (in seconds) at which the last heartbeat was received
+    * last_assigned_at: monotonic time (in seconds) at which a client was last sent to the server instance (None if none was)
     """
 
-    def __init__(self, task_arn: str):
-        """Waits for the task to transition to RUNNING state and then retrieves and stores relevant details about it."""
+    def __init__(self, task_arn: str, ec2_id: str = None, address: str = None, pool: Pool = None):
+        """
+        Waits for the task (in the given pool, the default pool by default) to transition to RUNNING state and then retrieves and stores relevant details about it.
+        If the ec2 id and address of the running task are already known (e.g. from discover_servers), no api calls are made.
+        """
         self.task_arn: str = task_arn
-        running_task_waiter(task_arn, settings.ECS_CLIENT)
         self.status: str = 'RUNNING'
-        
-        task_description = get_task_description(task_arn, settings.ECS_CLIENT)
 
-        self.ec2_id: str = get_ec2_id(task_description, settings.ECS_CLIENT)
+        if ec2_id is None or address is None:
+            pool = pool or get_default_pool()
+            running_task_waiter(task_arn, pool.ecs_client(), pool.cluster)
+
+            task_description = get_task_description(task_arn, pool.ecs_client(), pool.cluster)
+
+            ec2_id = get_ec2_id(task_description, pool.ecs_client(), pool.cluster)
+
+            port: str = get_exposed_port(task_description)
+            ip: str = get_ip(ec2_id, pool.ec2_client())
+            address = ip + ":" + port
 
-        port: str = get_exposed_port(task_description)
-        ip: str = get_ip(self.ec2_id, settings.EC2_CLIENT)
-        self.address: str = ip + ":" + port
+        self.ec2_id: str = ec2_id
+        self.address: str = address
 
-        self.available_capacity: int = 0
+        self.reported_capacity: int = 0
+        self.reservations = ReservationLedger()
         self.ready_to_close: bool = False
+        self.heartbeat_seq: int = None
+        self.last_heartbeat: float = None
+        self.last_assigned_at: float = None
         # self.update_state()
+
+    @property
+    def available_capacity(self) -> int:
+        return self.reported_capacity - self.reservations.outstanding()
+
+    def reserve(self, count: int = 1) -> None:
+        """Reserves capacity for count clients sent to the server instance"""
+        self.last_assigned_at = monotonic()
+        self.reservations.reserve(count, self.last_assigned_at)
         
     def update_state(self) -> bool:
         """
@@ -42,183 +87,894 @@ class Server():
         Note that the api call may fail even after the task is running condition as it takes sometime for django to setup
         Returns True if the api call is successful and False otherwise.
         """
+        return self.apply_state(self.fetch_state())
+
+    def fetch_state(self, session=requests, timeout: float = None) -> dict:
+        """
+        Makes api request to the health api of the server instance without updating any attribute.
+        Returns the state json (dict) if the api call is successful and None otherwise.
+        """
         url = "http://"+self.address+"/health/"
-        try: 
-            state_json: dict = requests.get(url).json()
-            self.ready_to_close = state_json['ready_to_close']
-            self.available_capacity = state_json['available_capacity']
-            return True
+        start: float = perf_counter()
+        try:
+            state_json: dict = session.get(url, timeout=timeout or settings.HEALTH_CHECK_TIMEOUT).json()
+        except Exception as e:
+            print(e)
+            metrics.HEALTH_CHECK_FAILURES.inc()
+            return None
+        metrics.HEALTH_CHECK_RTT.observe(perf_counter() - start)
+        return state_json
+
+    def apply_state(self, state_json: dict) -> bool:
+        """
+        Updates available capacity and ready to close flag from the state json returned by the health api.
+        A drop in the reported capacity is taken to reflect the clients sent to the server instance, so as many reservations are cleared.
+        Returns True if the state is valid and False otherwise.
+        """
+        if state_json is None:
+            return False
+        try:
+            ready_to_close: bool = state_json['ready_to_close']
+            available_capacity: int = state_json['available_capacity']
+            if not (isinstance(available_capacity, int) and not isinstance(available_capacity, bool) and isinstance(ready_to_close, bool)):
+                raise ValueError("Invalid health state " + str(state_json))
         except Exception as e:
             print(e)
             return False
+        self.ready_to_close = ready_to_close
+        self.reservations.settle(self.reported_capacity - available_capacity)
+        self.reported_capacity = available_capacity
+        return True
+
+    def apply_heartbeat(self, seq: int, state_json: dict, received_at: float = None) -> bool:
+        """
+        Updates the state from a heartbeat pushed by the server instance (same format as the health api, see apply_state).
+        Heartbeats can arrive out of order, so one with a sequence number not greater than the last one applied is ignored.
+        Returns True if the heartbeat is applied and False otherwise.
+        """
+        if self.heartbeat_seq is not None and seq <= self.heartbeat_seq:
+            return False
+        if not self.apply_state(state_json):
+            return False
+        self.heartbeat_seq = seq
+        self.last_heartbeat = received_at if received_at is not None else monotonic()
+        return True
+
+    def pushes_heartbeats(self) -> bool:
+        """Returns True if the server instance pushes heartbeats (so it isn't polled) and False otherwise"""
+        return self.last_heartbeat is not None
+
+    def has_fresh_heartbeat(self, now: float = None) -> bool:
+        """Returns True if a heartbeat was received within HEARTBEAT_TIMEOUT and False otherwise"""
+        if self.last_heartbeat is None:
+            return False
+        return (now if now is not None else monotonic()) - self.last_heartbeat <= settings.HEARTBEAT_TIMEOUT
 
 class ServerManagerThread(Thread):
     """
     ServerManagerThread is subclass of thread. The thread routinely updates the state of each server instance and based on this information, it upscales/downscales server instances. (Check README and code for implementation details)
     
     Attributes:
+    * pool: Pool (region, cluster, launch template and margins) of the server instances managed by the thread
     * available_servers: list of servers available for connection
     * standby_servers: list of servers kept in standby as part of downscaling; they will be terminated when the 'ready_to_close' flag is True.
     * total_available_capacity: integer sum of available capacity of all servers
-    * upscale_margin: min extra capacity maintained; one server instance is provisioned if total_available_capacity < upscale_margin
-    * downscale_margin: max extra capacity maintained, one server instance is deprovisioned if total_available_capacity > downscale_margin
+    * upscale_margin: min extra capacity maintained; server instances are provisioned if total_available_capacity < upscale_margin
+    * downscale_margin: max extra capacity maintained, server instances are deprovisioned if total_available_capacity > downscale_margin
+    * scaling_policy: ScalingPolicy deciding how many server instances to provision or deprovision on every update
+    * demand_forecast: DemandForecast of the capacity the clients will take up within a provisioning lead time, which the scaling policy launches ahead of (None unless PREDICTIVE_SCALING is set)
+    * assignment_count: number of clients assigned a server since the last update
     * thread_sleep_time: time interval (in seconds) before the thread carries out routine updates
+    * health_checker: HealthChecker used to poll server instances concurrently
+    * health_scheduler: HealthScheduler deciding which server instances are due for a health check; hot ones are checked more often than idle ones
+    * capacity_index: CapacityIndex over available_servers used to select a server for a client in O(log n)
+    * affinity: GameAffinity routing the clients of the same game (or room) to the same available server
+    * selection_policy: name of the CapacityIndex policy used to select a server for a client
+    * provisioner: Provisioner launching new server instances in the background; capacity of in-flight launches counts towards upscaling
+    * warm_pool: WarmPool of EC2 instances registered to the cluster ahead of scale-outs (disabled unless WARM_POOL_MAX_SIZE is set)
+    * journal: StateJournal the server lists are saved to on every update, and restored from on startup (None if STATE_JOURNAL is off)
+    * reconciliation: thread reconciling the servers restored from the journal (or replicated by the previous leader) with AWS (None if they weren't restored)
+    * elector: LeaderElector of the pool's lease in REPLICA_MODE (None otherwise); only the leader scales and makes AWS mutations, followers serve clients from the server lists it replicates
+    * leading: True if this replica was the leader at the last lease renewal and False otherwise
+    * snapshot: FleetSnapshot of the available servers, published once per update; request handlers read it instead of the mutable lists
+    * shared_table: SharedServerTable the snapshot is also published to when the manager app runs as several worker processes (None otherwise)
+    * published_at: monotonic time at which the snapshot was last published
+    * servers_by_task_arn: dict mapping task arn to each server instance (available or standby), used to look up the sender of a heartbeat
+    * admission: AdmissionQueue of clients waiting for capacity when no available server has any left (used with ADMISSION_CONTROL)
+    * lock: re-entrant lock guarding available_servers, standby_servers, capacity_index, affinity, health_scheduler and admission, which are shared between the request handling threads and this thread
 
-    This is a singleton class, meaning only one instance of Health can be created during the scope of the proram.
+    This is a singleton class per pool, meaning only one instance can be created for each pool during the scope of the proram.
     """
-    __shared_instance = None
+    __shared_instances: dict = {} # pool name -> instance
     
-    def __init__(self):
-        if self.__shared_instance == None:
+    def __init__(self, pool: Pool = None):
+        pool = pool or get_default_pool()
+        if pool.name not in ServerManagerThread.__shared_instances:
             Thread.__init__(self)
-            ServerManagerThread.__shared_instance = self
+            ServerManagerThread.__shared_instances[pool.name] = self
             self.setDaemon(True)
             
-            self.task_family = settings.SERVER_TASK_DEFINITION
-
-            try:
-                task_arns: list = get_tasks(self.task_family)
-                self.available_servers: list = [Server(arn) for arn in task_arns]
-            except Exception as e:
-                print("Unable to get active tasks in the cluster due to the following exception")
-                print(e)
-                self.available_servers: list = []
+            self.pool: Pool = pool
+            self.task_family = pool.task_definition
+            self.journal = StateJournal(pool.get_path(settings.STATE_JOURNAL_PATH)) if settings.STATE_JOURNAL else None
+            self.elector = LeaderElector(get_lease_backend(), pool.name) if settings.REPLICA_MODE else None
+            self.leading: bool = False
 
+            self.available_servers: list = []
             self.standby_servers: list = []
+            # Restoring from the journal takes milliseconds, while discovering the running servers takes several AWS api calls (and waiters)
+            # In REPLICA_MODE, the server lists replicated by the leader are fresher than the local journal
+            records: list = self.fetch_replica() if self.elector is not None else None
+            if records is None and self.journal is not None:
+                records = self.journal.load()
+            if records is not None:
+                for record in records:
+                    server = StateJournal.from_record(record, Server)
+                    if record['standby']:
+                        self.standby_servers.append(server)
+                    else:
+                        self.available_servers.append(server)
+                print("Restored", len(records), "servers from the state journal")
+            else:
+                try:
+                    task_arns: list = get_tasks(self.task_family, pool)
+                    self.available_servers = [
+                        Server(d['task_arn'], d['ec2_id'], d['address'])
+                        for d in discover_servers(task_arns, pool.ecs_client(), pool.ec2_client(), pool.cluster)
+                    ]
+                except Exception as e:
+                    print("Unable to get active tasks in the cluster due to the following exception")
+                    print(e)
+
+            self.lock = RLock()
+            self.selection_policy: str = settings.SELECTION_POLICY
+            self.capacity_index = CapacityIndex()
+            self.affinity = GameAffinity()
+            self.servers_by_task_arn: dict = {}
+            for s in self.available_servers:
+                self.capacity_index.add(s)
+                self.affinity.add_server(s, task_key(s.task_arn))
+                self.servers_by_task_arn[s.task_arn] = s
+            for s in self.standby_servers:
+                self.servers_by_task_arn[s.task_arn] = s
 
             self.total_available_capacity: int = 0
             for s in self.available_servers:
                 self.total_available_capacity += s.available_capacity
 
-            self.upscale_margin: int = settings.UPSCALE_MARGIN
-            self.downscale_margin: int = settings.DOWNSCALE_MARGIN
+            self.upscale_margin: int = pool.upscale_margin
+            self.downscale_margin: int = pool.downscale_margin
             self.thread_sleep_time: int = settings.THREAD_SLEEP_TIME
+            self.shared_table = None
+            self.published_at: float = None
+            self.snapshot = FleetSnapshot(0, ())
+            self.publish_snapshot()
+            self.scaling_policy = ScalingPolicy(self.upscale_margin, self.downscale_margin)
+            self.demand_forecast = DemandForecast(DemandHistory(pool.get_path(settings.FORECAST_PATH))) if settings.PREDICTIVE_SCALING else None
+            self.assignment_count: int = 0
+            self.health_checker = HealthChecker()
+            self.health_scheduler = HealthScheduler()
+            self.warm_pool = WarmPool(pool=pool)
+            self.provisioner = Provisioner(
+                self.task_family, Server, warm_pool=self.warm_pool if self.warm_pool.enabled() else None, pool=pool, in_use=self.is_instance_in_use
+            )
+            self.admission = AdmissionQueue(self.lock, self.reserve_server, self.get_retry_after)
+
+            self.reconciliation: Thread = None
+            # In REPLICA_MODE, the servers are reconciled with AWS once elected (see take_over)
+            if records is not None and self.elector is None:
+                # Clients are served from the restored lists while they are checked against AWS in the background
+                self.reconciliation = Thread(target=self.reconcile, name='reconciliation', daemon=True)
+                self.reconciliation.start()
+            elif self.elector is None:
+                self.warm_pool.discover([s.ec2_id for s in self.available_servers])
         
         else:
             raise Exception("ServerManagerThread is Singleton class!")
     
     @staticmethod
-    def get_instance():
-        """Returns the singleton shared instance of this class"""
-        if ServerManagerThread.__shared_instance == None:
-            ServerManagerThread()
+    def get_instance(pool_name: str = None):
+        """Returns the singleton shared instance of this class for the given pool (the default pool by default)"""
+        pool: Pool = get_pools()[pool_name] if pool_name is not None else get_default_pool()
+        if pool.name not in ServerManagerThread.__shared_instances:
+            ServerManagerThread(pool)
         
-        return ServerManagerThread.__shared_instance
+        return ServerManagerThread.__shared_instances[pool.name]
+
+    @staticmethod
+    def get_instances() -> list:
+        """Returns the shared instances of every pool, in the order the pools are declared"""
+        return [ServerManagerThread.get_instance(name) for name in get_pools()]
+
+    @staticmethod
+    def reset_instance() -> None:
+        """Forgets the shared instances (without stopping them) and the pools, so that fresh ones are created from the settings by get_instance; meant for tests and benchmarks"""
+        ServerManagerThread.__shared_instances = {}
+        reset_pools()
 
     def add_server(self) -> bool:
         """
-        Attempts to add a new server instance
-        Returns True if successful and False otheriwse
+        Requests a new server instance to be launched in the background; it is added to the available servers once it is RUNNING (see collect_launched_servers)
+        Returns True if the launch is requested successfully and False otheriwse
+        """
+        try:
+            launch = self.provisioner.launch()
+            print("Requested launch", launch.launch_id)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def collect_launched_servers(self) -> list:
+        """Adds the server instances launched since the last update to the available servers and returns them"""
+        collected: list = []
+        # Under the lock, so that a launched server instance is always known either to the provisioner or to this class (see is_instance_in_use)
+        with self.lock:
+            for server in self.provisioner.collect():
+                if server.task_arn in self.servers_by_task_arn:
+                    continue # already picked up by reconcile
+                self.add_available_server(server)
+                collected.append(server)
+        return collected
+
+    def get_next_collection_time(self) -> float:
+        """
+        Returns the monotonic time at which launches should next be collected between updates, or None if that can wait for the next update.
+        With ADMISSION_CONTROL, clients may be waiting for the launches in flight, so they are collected (and checked, which reports their capacity) as soon as they are running.
+        """
+        if settings.ADMISSION_CONTROL and self.provisioner.in_flight() > 0:
+            return monotonic() + settings.ADMISSION_POLL_INTERVAL
+        return None
+
+    def check_launched_servers(self) -> None:
+        """Collects the launches which completed since the last update; they are due for a health check right away (see check_servers)"""
+        if self.collect_launched_servers():
+            self.publish_snapshot()
+
+    def reconcile(self) -> None:
         """
+        Reconciles the server lists restored from the journal with the tasks actually running on AWS:
+        servers whose tasks are no longer running are dropped, and running tasks the journal doesn't know of (e.g. launched after it was last saved) are added as available servers.
+        """
+        try:
+            task_arns: list = get_tasks(self.task_family, self.pool)
+        except Exception as e:
+            print("Unable to reconcile the restored servers due to the following exception")
+            print(e)
+            return
+        running: set = set(task_arns)
+
+        with self.lock:
+            gone: list = [s for arn, s in self.servers_by_task_arn.items() if arn not in running]
+            for s in gone:
+                if s in self.available_servers:
+                    self.remove_available_server(s)
+                elif s in self.standby_servers:
+                    self.standby_servers.remove(s)
+                self.servers_by_task_arn.pop(s.task_arn, None)
+            in_flight: set = self.provisioner.get_task_arns_in_flight() # collected as launches, not discovered
+            unknown: list = [arn for arn in task_arns if arn not in self.servers_by_task_arn and arn not in in_flight]
+
+        added: int = 0
         try:
-            launch_ecs_instance()
-            task = launch_task(self.task_family)
-            self.available_servers.append(Server(task))
+            for d in discover_servers(unknown, self.pool.ecs_client(), self.pool.ec2_client(), self.pool.cluster) if unknown else []:
+                with self.lock:
+                    if d['task_arn'] in self.servers_by_task_arn:
+                        continue
+                    self.add_available_server(Server(d['task_arn'], d['ec2_id'], d['address']))
+                    added += 1
+        except Exception as e:
+            print("Unable to discover the unknown tasks due to the following exception")
+            print(e)
+
+        with self.lock:
+            busy_ec2_ids: list = [s.ec2_id for s in self.servers_by_task_arn.values()]
+        self.warm_pool.discover(busy_ec2_ids)
+        self.publish_snapshot()
+        print("Reconciled restored servers:", len(gone), "dropped,", added, "added")
+
+    def is_leader(self) -> bool:
+        """Returns True if this replica runs the scaling of the pool (always the case without REPLICA_MODE) and False if it is a follower"""
+        return self.elector is None or self.elector.is_leader()
+
+    def renew_lease(self) -> bool:
+        """
+        Renews (or attempts to acquire) the lease of the pool if it is due, taking over as the leader or stepping down to follower if the lease changed hands.
+        Returns True if this replica is the leader and False otherwise.
+        """
+        if self.elector is None:
             return True
+        leader: bool = self.elector.tick()
+        if leader and not self.leading:
+            self.take_over()
+        elif not leader and self.leading:
+            self.step_down()
+        self.leading = leader
+        return leader
+
+    def take_over(self) -> None:
+        """Takes over the scaling of the pool as its elected leader"""
+        print("Elected leader of pool", self.pool.name)
+        metrics.LEADERSHIP_CHANGES.labels(self.pool.name, 'elected').inc()
+        self.sync_replica()
+        # The replicated lists miss the launches the previous leader had in flight; reconciling them with AWS picks them up
+        self.reconciliation = Thread(target=self.reconcile, name='reconciliation', daemon=True)
+        self.reconciliation.start()
+
+    def step_down(self) -> None:
+        """Steps down to follower as the lease of the pool was lost; launches in flight complete and are picked up by the new leader"""
+        print("Lost the lease of pool", self.pool.name, "stepping down to follower")
+        metrics.LEADERSHIP_CHANGES.labels(self.pool.name, 'demoted').inc()
+
+    def fetch_replica(self) -> list:
+        """Returns the list of server records last replicated by the leader, or None if there are none (or they are older than STATE_JOURNAL_MAX_AGE)"""
+        try:
+            body: str = self.elector.backend.fetch(self.pool.name)
         except Exception as e:
+            print("Unable to fetch the replicated server lists due to the following exception")
             print(e)
+            return None
+        return StateJournal.loads(body, settings.STATE_JOURNAL_MAX_AGE) if body is not None else None
+
+    def publish_replica(self) -> None:
+        """Replicates the server lists to the followers if this replica is the leader in REPLICA_MODE"""
+        if self.elector is None or not self.is_leader():
+            return
+        with self.lock:
+            body: str = StateJournal.dumps(self.available_servers, self.standby_servers)
+        try:
+            self.elector.backend.publish(self.pool.name, body)
+        except Exception as e:
+            print("Unable to replicate the server lists due to the following exception")
+            print(e)
+
+    def sync_replica(self) -> bool:
+        """
+        Replaces the server lists with the ones last replicated by the leader; known server instances keep their reservations (settled by the replicated capacity, see apply_state).
+        Returns True if successful and False otherwise.
+        """
+        records: list = self.fetch_replica()
+        if records is None:
             return False
+        with self.lock:
+            available_servers: list = []
+            standby_servers: list = []
+            for record in records:
+                server: Server = self.servers_by_task_arn.get(record['task_arn'])
+                if server is None:
+                    server = StateJournal.from_record(record, Server)
+                else:
+                    server.apply_state({'available_capacity': record['reported_capacity'], 'ready_to_close': record['ready_to_close']})
+                    # Heartbeats the leader applied are stale here too
+                    if server.heartbeat_seq is None or (record['heartbeat_seq'] or 0) > server.heartbeat_seq:
+                        server.heartbeat_seq = record['heartbeat_seq']
+                (standby_servers if record['standby'] else available_servers).append(server)
+
+            replicated: set = set(available_servers)
+            for s in [s for s in self.available_servers if s not in replicated]:
+                self.remove_available_server(s)
+            for s in available_servers:
+                if s in self.capacity_index:
+                    self.capacity_index.update(s)
+                else:
+                    self.add_available_server(s)
+            self.standby_servers = standby_servers
+            self.servers_by_task_arn = {s.task_arn: s for s in available_servers + standby_servers}
+            self.total_available_capacity = sum(s.available_capacity for s in self.available_servers)
+            self.admission.release()
+        self.publish_snapshot()
+        return True
+
+    def tend_lease(self) -> bool:
+        """
+        Between updates in REPLICA_MODE: renews the lease when it is due and, as a follower, syncs the server lists replicated by the leader.
+        Returns True if the lease changed hands (so the update should be carried out right away) and False otherwise.
+        """
+        if self.elector is None or monotonic() < self.elector.next_renewal:
+            return False
+        leading: bool = self.leading
+        if self.renew_lease() != leading:
+            return True
+        if not self.leading:
+            self.sync_replica()
+        return False
+
+    def get_wake_up_times(self) -> tuple:
+        """
+        Returns the monotonic times (or None) at which the thread should wake up between updates: the next health check, launch collection, shared table publish and lease renewal.
+        Followers only wake up for the lease renewal, as the leader checks the servers.
+        """
+        lease_time: float = self.elector.next_renewal if self.elector is not None else None
+        if not self.is_leader():
+            return (lease_time,)
+        return (self.get_next_check_time(), self.get_next_collection_time(), self.get_next_publish_time(), lease_time)
+
+    def get_next_publish_time(self) -> float:
+        """
+        Returns the monotonic time at which the shared server table should next be published between updates, or None without a shared table.
+        The heartbeats recorded in the table are only applied on publish, so it is published as often as the hottest servers are checked.
+        """
+        if self.shared_table is None:
+            return None
+        return self.published_at + settings.HEALTH_CHECK_MIN_INTERVAL
+
+    def publish_shared_table(self) -> None:
+        """Publishes the snapshot between updates with a shared table, so that health checks and heartbeats reach the worker processes before the next update"""
+        if self.shared_table is not None:
+            self.publish_snapshot()
+
+    def get_in_flight_capacity(self) -> int:
+        """Returns the capacity expected from the launches which are yet to complete"""
+        return self.provisioner.in_flight() * settings.SERVER_CAPACITY
     
     def remove_server(self, redundant_server: Server) -> bool:
         """
         Attempts to remove the specified server instance terminating the EC2 instance (along with task)
+        With PLACEMENT_MODE 'binpack', only the task is stopped, and the EC2 instance is terminated once no other server instance runs on it.
         Returns True if successful and False otheriwse
         """
+        if not self.is_leader():
+            # The lease was lost since the server instance was dropped; the new leader reconciles it
+            print("Not the leader, leaving server", redundant_server.address, "running")
+            return False
         try:
-            terminate_ec2(redundant_server.ec2_id)
+            if self.provisioner.placement_mode != 'binpack':
+                terminate_ec2(redundant_server.ec2_id, self.pool)
+                return True
+
+            stop_task(redundant_server.task_arn, "Scaled in by the manager app", self.pool)
+            # No task may be placed on the instance while it is found empty and terminated
+            with self.provisioner.placement_lock:
+                if self.is_instance_in_use(redundant_server.ec2_id, redundant_server):
+                    print("Task", redundant_server.task_arn, "stopped")
+                else:
+                    terminate_ec2(redundant_server.ec2_id, self.pool)
             return True
         except Exception as e:
             print(e)
             return False
+
+    def is_instance_in_use(self, ec2_id: str, exclude: Server = None) -> bool:
+        """Returns True if a server instance (other than exclude) runs, or is being launched, on the specified EC2 instance and False otherwise"""
+        with self.lock:
+            for s in self.servers_by_task_arn.values():
+                if s.ec2_id == ec2_id and s is not exclude:
+                    return True
+            return ec2_id in self.provisioner.get_ec2_ids_in_use()
     
-    def get_available_server(self) -> Server:
-        """Return Server object of an available server instance"""
-        max_available_server_index = self.get_available_server_index()
-        self.available_servers[max_available_server_index].available_capacity -= 1
-        return self.available_servers[max_available_server_index]
-    
-    def get_available_server_index(self) -> int:
-        """Return the index (in self.available_servers list) of an available server instance"""
-        max_available_server_index = 0
-
-        for i in range(1, len(self.available_servers)):
-            server = self.available_servers[i]
-            if server.available_capacity > self.available_servers[max_available_server_index].available_capacity:
-                max_available_server_index = i
-        
-        return max_available_server_index
+    def add_available_server(self, server: Server) -> None:
+        """Adds the server instance to the list (and index) of available servers"""
+        with self.lock:
+            self.available_servers.append(server)
+            self.capacity_index.add(server)
+            self.affinity.add_server(server, task_key(server.task_arn))
+            self.servers_by_task_arn[server.task_arn] = server
+            # Waiting clients are admitted to the new server right away
+            self.admission.release()
+
+    def remove_available_server(self, server: Server) -> None:
+        """Removes the server instance from the list (and index) of available servers"""
+        with self.lock:
+            self.available_servers.remove(server)
+            self.capacity_index.remove(server)
+            self.affinity.remove_server(server, task_key(server.task_arn))
+
+    def upscale(self, count: int) -> None:
+        """Adds count server instances, preferring standby servers (available right away) over launching new ones"""
+        with self.lock:
+            reactivated: int = min(count, len(self.standby_servers))
+            for _ in range(reactivated):
+                # Move a standby server instance back as an available server
+                s = self.standby_servers.pop(0)
+                self.total_available_capacity += s.available_capacity
+                self.add_available_server(s)
+
+        # Launch new server instances for the rest; the launches progress in parallel
+        for _ in range(count - reactivated):
+            self.add_server()
+
+    def downscale(self, count: int) -> None:
+        """
+        Moves up to count server instances to standby, always keeping at least one available server.
+        The server instances with max available capacity are moved, or with the pack selection policy, the ones expected to drain first (see get_drain_candidates).
+        """
+        with self.lock:
+            count = min(count, len(self.available_servers) - 1)
+            candidates: list = self.get_drain_candidates(count) if self.selection_policy == 'pack' else None
+            for i in range(count):
+                s = candidates[i] if candidates is not None else self.capacity_index.max_server()
+                self.remove_available_server(s)
+                self.total_available_capacity -= s.available_capacity
+                self.standby_servers.append(s)
+
+    def get_drain_candidates(self, count: int) -> list:
+        """
+        Returns the count available server instances expected to drain first: the ones with the fewest clients, and of those, the ones sent a client longest ago
+        """
+        with self.lock:
+            return heapq.nsmallest(count, self.available_servers, key=lambda s: (
+                settings.SERVER_CAPACITY - s.available_capacity, s.last_assigned_at if s.last_assigned_at is not None else -math.inf
+            ))
+
+    def update_drain_candidates(self) -> None:
+        """
+        With the pack selection policy, marks the server instances the next scale-in would move to standby as draining, so that new clients and games are steered away from them
+        """
+        if self.selection_policy != 'pack':
+            return
+        with self.lock:
+            count: int = self.scaling_policy.get_scale_in_count(self.total_available_capacity, len(self.available_servers))
+            self.capacity_index.draining = set(self.get_drain_candidates(count))
+
+    def get_available_server(self, game_id: str = None, require_capacity: bool = False) -> Server:
+        """
+        Return Server object of an available server instance selected as per the selection policy
+        If a game (or room) id is given, the server already hosting the game (or the one picked by the affinity hash ring) is returned instead, see GameAffinity
+        With require_capacity set, no server is oversubscribed: None is returned if no available server has capacity left (the server already hosting the game is still returned)
+        Raises IndexError if there is no available server (unless require_capacity is set)
+        """
+        with self.lock:
+            server: Server = None
+            hosting: bool = False
+            if game_id is not None:
+                # New games are steered away from the servers being drained for scale-in (see update_drain_candidates)
+                server, hosting = self.affinity.lookup(game_id, exclude=self.capacity_index.draining)
+            route: str = 'hosting' if hosting else 'ring' if server is not None else 'fallback'
+            if server is None:
+                if require_capacity and len(self.capacity_index) == 0:
+                    return None
+                server = self.capacity_index.select(self.selection_policy)
+                if require_capacity and server.available_capacity <= 0:
+                    server = self.capacity_index.max_server()
+                    if server.available_capacity <= 0:
+                        return None
+            if game_id is not None:
+                metrics.AFFINITY_ROUTES.labels(route).inc()
+                self.affinity.assign(game_id, server)
+            # The capacity is held until the health api reflects the new client (or the reservation expires)
+            server.reserve()
+            self.assignment_count += 1
+            self.capacity_index.update(server)
+            # Capacity of a server which was just sent a client is worth checking soon
+            self.health_scheduler.expedite(server)
+            return server
     
+    def reserve_server(self, game_id: str = None) -> Server:
+        """Returns an available server with capacity reserved for the client, or None if no available server has capacity left (see get_available_server)"""
+        return self.get_available_server(game_id, require_capacity=True)
+
+    def admit(self, game_id: str = None, wait: float = 0.0) -> Server:
+        """
+        Returns an available server with capacity reserved for the client, waiting up to wait seconds for capacity to free up or for new servers to come online (see AdmissionQueue)
+        Raises Saturated if the client isn't admitted, and IndexError if there is no available server and no launch in flight (nothing to wait for)
+        """
+        self.check_admissible()
+        return self.admission.acquire(game_id, wait)
+
+    async def admit_async(self, game_id: str = None, wait: float = 0.0) -> Server:
+        """asyncio counterpart of admit"""
+        self.check_admissible()
+        return await self.admission.acquire_async(game_id, wait)
+
+    def check_admissible(self) -> None:
+        """Raises IndexError if there is no available server and no launch in flight"""
+        if not self.available_servers and self.provisioner.in_flight() == 0:
+            raise IndexError("No available server and no launch in flight")
+
+    def get_retry_after(self, queue_depth: int) -> int:
+        """Returns the time (in seconds) after which a client turned away with queue_depth clients waiting should retry (see admission.get_retry_after)"""
+        return get_retry_after(self.provisioner.get_eta(), self.provisioner.launch_duration, queue_depth)
+
+    def reserve_groups(self, group_sizes: list) -> list:
+        """
+        Reserves capacity for a batch of groups of clients, each of which must share a server, in one pass under the lock (so concurrent batches can't oversubscribe a server).
+        Groups are placed largest first on the server with the max available capacity, provided it fits the whole group.
+        Returns the list of servers assigned to the groups (in the given order), with None for the groups which don't fit on any server.
+        """
+        assigned: list = [None] * len(group_sizes)
+        with self.lock:
+            for i in sorted(range(len(group_sizes)), key=lambda i: -group_sizes[i]):
+                try:
+                    server: Server = self.capacity_index.max_server()
+                except IndexError:
+                    break
+                if server.available_capacity < group_sizes[i]:
+                    continue # smaller groups may still fit
+                server.reserve(group_sizes[i])
+                self.assignment_count += group_sizes[i]
+                self.capacity_index.update(server)
+                self.health_scheduler.expedite(server)
+                assigned[i] = server
+        return assigned
+
+    def publish_snapshot(self) -> FleetSnapshot:
+        """Publishes (and returns) a new snapshot of the available servers"""
+        with self.lock:
+            if self.shared_table is not None:
+                # Takes over the reservations and heartbeats received by the worker processes since the last publish
+                self.assignment_count += self.shared_table.publish(
+                    self.available_servers, self.standby_servers,
+                    self.provisioner.get_eta(), self.provisioner.launch_duration
+                )
+                self.total_available_capacity = 0
+                for s in self.available_servers:
+                    self.capacity_index.update(s)
+                    self.total_available_capacity += s.available_capacity
+            snapshot = FleetSnapshot(self.snapshot.version + 1, [s.address for s in self.available_servers])
+            self.published_at = monotonic()
+            # Readers only ever see a complete snapshot as the reference is swapped in a single assignment
+            self.snapshot = snapshot
+            return snapshot
+
+    def get_snapshot(self) -> FleetSnapshot:
+        """Returns the latest published snapshot of the available servers"""
+        return self.snapshot
+
     def get_available_servers(self) -> list:
-        """Returns the list of available server instances as maintained by the class object"""
-        return self.available_servers
+        """Returns a copy of the list of available server instances as maintained by the class object"""
+        with self.lock:
+            return list(self.available_servers)
 
-    def run(self):
-        """Main function which carries out routinely maintainance and updates in the backgorund"""
+    def get_servers_to_check(self, now: float = None) -> list:
+        """
+        Returns the list of server instances (available and standby) whose health check is due (see HealthScheduler).
+        Server instances which push heartbeats aren't polled as long as their heartbeats are fresh; polling remains the fallback for the ones which don't (or stop to).
+        """
+        now = monotonic() if now is None else now
+        with self.lock:
+            self.health_scheduler.sync(self.available_servers + self.standby_servers, now)
+            servers: list = []
+            for s in self.health_scheduler.pop_due(now):
+                if s.has_fresh_heartbeat(now):
+                    self.health_scheduler.record(s, True, s not in self.capacity_index, now)
+                    continue
+                # A server which missed its heartbeats is polled until it pushes again
+                s.last_heartbeat = None
+                servers.append(s)
+            return servers
 
-        print("Starting server management thread")
+    def get_next_check_time(self) -> float:
+        """Returns the monotonic time at which the next health check is due, or None if there is no server instance"""
+        with self.lock:
+            return self.health_scheduler.next_due()
 
-        while(True):
+    def ingest_heartbeat(self, task_arn: str, seq: int, state_json: dict) -> bool:
+        """
+        Applies a heartbeat pushed by a server instance right away, keeping the capacity index and the total available capacity up to date.
+        Returns True if the heartbeat is applied and False if it is stale (out of order or a duplicate).
+        Raises KeyError if the server instance isn't known.
+        """
+        with self.lock:
+            server: Server = self.servers_by_task_arn[task_arn]
+            previous_capacity: int = server.available_capacity
+            if not server.apply_heartbeat(seq, state_json):
+                return False
+            standby: bool = server not in self.capacity_index
+            if not standby:
+                self.capacity_index.update(server)
+                self.total_available_capacity += server.available_capacity - previous_capacity
+            # A heartbeat is as good as a health check (it also clears a suspect server)
+            self.health_scheduler.record(server, True, standby)
+            if not standby:
+                self.admission.release()
+            return True
+
+    def apply_health_states(self, health_states: dict) -> list:
+        """
+        Applies a batch of health states (as returned by HealthChecker.check), schedules the next checks of the servers and recalculates the total available capacity.
+        Servers which weren't checked keep their last known state.
+        Returns the list of servers which didn't respond to the health check.
+        """
+        unresponsive_servers: list = [] # maintain a list of servers which don't respond to health checks
+        now: float = monotonic()
+        with self.lock:
+            for s, state_json in health_states.items():
+                standby: bool = s not in self.capacity_index
+                healthy: bool = s.apply_state(state_json)
+                if not healthy:
+                    # server isn't responding to health check; it is suspect until it responds again (or is dead)
+                    unresponsive_servers.append(s)
+                    if not standby:
+                        s.reported_capacity = 0
+                if not standby:
+                    self.capacity_index.update(s)
+                self.health_scheduler.record(s, healthy, standby, now)
 
             new_total_available_capacity = 0 # reset total available capacity
-            unresponsive_servers: list = [] # maintain a list of servers which don't respond to health checks
             for s in self.available_servers:
-                if not s.update_state():
-                    # server isn't responding to health check
-                    s.available_capacity = 0
-                    unresponsive_servers.append(s)
                 new_total_available_capacity += s.available_capacity
-
             self.total_available_capacity = new_total_available_capacity
-            
-            for s in self.standby_servers:
-                if not s.update_state():
-                    unresponsive_servers.append(s)
+            # The health reports may show freed capacity
+            self.admission.release()
 
-            print("state updated")
-            print("Total Available Capacity", end=': ')
-            print(self.total_available_capacity)
+        print("state updated")
+        print("Total Available Capacity", end=': ')
+        print(self.total_available_capacity)
+        return unresponsive_servers
 
-            if self.total_available_capacity < self.upscale_margin:
-                print("Upscale")
+    def scale(self) -> None:
+        """Upscales/downscales as decided by the scaling policy; launches of new server instances happen in the background"""
+        in_flight_capacity: int = self.get_in_flight_capacity()
+        if in_flight_capacity > 0:
+            print("In-flight Capacity", end=': ')
+            print(in_flight_capacity)
 
-                if len(self.standby_servers) == 0:
-                    # If there is no server in standby, launch new server instance
-                    self.add_server()
-                else:
-                    # Move a standby server instance back as an available server
-                    s = self.standby_servers.pop(0)
-                    self.total_available_capacity += s.available_capacity
-                    self.available_servers.append(s)
-            
-            elif (self.total_available_capacity > self.downscale_margin) & (len(self.available_servers)>1) :
-                    print("Downscale")
-                    # Move a server instance to standby
-                    s = self.available_servers.pop(self.get_available_server_index())
-                    self.total_available_capacity -= s.available_capacity
-                    self.standby_servers.append(s)
-
-            # Terminate standby servers with are ready to close keep only the remaining ones
-            remaining_standby_servers: list = []
-            for s in self.standby_servers:
-                print("Removing extra servers")
+        scale: int = self.scaling_policy.decide(
+            self.total_available_capacity, in_flight_capacity, len(self.available_servers), forecast_growth=self.forecast_growth()
+        )
+        if scale > 0:
+            print("Upscale by", scale)
+            metrics.SCALE_EVENTS.labels('up').inc()
+            self.upscale(scale)
+        elif scale < 0:
+            print("Downscale by", -scale)
+            metrics.SCALE_EVENTS.labels('down').inc()
+            self.downscale(-scale)
 
-                if s.ready_to_close:
-                    self.remove_server(s)
-                else:
-                    remaining_standby_servers.append(s)
-            
-            self.standby_servers = remaining_standby_servers
-            
-            print("Ending server_update and sleeping")
-            sleep(self.thread_sleep_time) # Wait a little before the next update
-            # Unresponsive servers were given some time to recover
-            # If they don't respond to health checks even now, then remove them
+        self.update_drain_candidates()
+
+        # Refill the warm pool in the background after it was drawn from (or shrink it once scale-outs have become rare)
+        self.warm_pool.maintain()
+
+    def forecast_growth(self) -> int:
+        """
+        Records the assignments made since the last update and the fleet capacity in the demand history,
+        and returns the capacity the clients are forecast to take up within a provisioning lead time (0 without PREDICTIVE_SCALING)
+        """
+        with self.lock:
+            assignments: int = self.assignment_count
+            self.assignment_count = 0
+            fleet_capacity: int = len(self.available_servers) * settings.SERVER_CAPACITY
+        metrics.ASSIGNMENTS.inc(assignments)
+        if self.demand_forecast is None:
+            return 0
+        self.demand_forecast.record(assignments, fleet_capacity, self.total_available_capacity)
+        # The lead time is how long a launch takes, as measured by the provisioner unless it is set
+        lead_time: float = settings.FORECAST_LEAD_TIME or self.provisioner.launch_duration or settings.ADMISSION_RETRY_AFTER
+        growth: int = self.demand_forecast.predicted_growth(lead_time, fleet_capacity - self.total_available_capacity)
+        metrics.FORECAST_GROWTH.labels(self.pool.name).set(growth)
+        if growth > 0:
+            print("Forecast growth", end=': ')
+            print(growth)
+        return growth
+
+    def reap_standby_servers(self) -> list:
+        """Drops the standby servers which are ready to close and returns them; the caller must terminate them (remove_server)"""
+        with self.lock:
+            closing_servers: list = [s for s in self.standby_servers if s.ready_to_close]
+            self.standby_servers = [s for s in self.standby_servers if not s.ready_to_close]
+            for s in closing_servers:
+                self.servers_by_task_arn.pop(s.task_arn, None)
+        return closing_servers
+
+    def drop_dead_servers(self, unresponsive_servers: list) -> list:
+        """
+        Drops the given unresponsive servers which failed HEALTH_CHECK_DEAD_AFTER consecutive health checks (the others are suspect and are rechecked with backoff).
+        Returns the dropped servers; the caller must terminate them (remove_server).
+        """
+        dropped_servers: list = []
+        removed_available_server: bool = False
+        with self.lock:
             for s in unresponsive_servers:
-                if not s.update_state():
-                    if s in self.available_servers:
-                        self.available_servers.remove(s)
-                    elif s in self.standby_servers:
-                        self.standby_servers.remove(s)                    
+                if not self.health_scheduler.is_dead(s):
+                    continue
+                self.health_scheduler.remove(s)
+                if s in self.available_servers:
+                    self.remove_available_server(s)
+                    removed_available_server = True
+                elif s in self.standby_servers:
+                    self.standby_servers.remove(s)
+                self.servers_by_task_arn.pop(s.task_arn, None)
+                dropped_servers.append(s)
+        if removed_available_server:
+            self.publish_snapshot()
+        metrics.UNRESPONSIVE_SERVER_REMOVALS.inc(len(dropped_servers))
+        return dropped_servers
+
+    def save_state(self) -> None:
+        """Saves the server lists to the journal (if any)"""
+        if self.journal is None:
+            return
+        with self.lock:
+            available_servers: list = list(self.available_servers)
+            standby_servers: list = list(self.standby_servers)
+        self.journal.save(available_servers, standby_servers)
+
+    def check_servers(self) -> list:
+        """
+        Polls the servers whose health check is due concurrently, applies the results as a batch and terminates the dead servers.
+        Returns the list of servers which didn't respond to the health check.
+        """
+        health_states: dict = self.health_checker.check(self.get_servers_to_check())
+        unresponsive_servers: list = self.apply_health_states(health_states)
+        for s in self.drop_dead_servers(unresponsive_servers):
+            print("Removing unresponsive server", s.address)
+            self.remove_server(s)
+        return unresponsive_servers
+
+    def record_metrics(self) -> None:
+        """Sets the gauges of the fleet of the pool (server counts and total available capacity)"""
+        metrics.AVAILABLE_SERVERS.labels(self.pool.name).set(len(self.available_servers))
+        metrics.STANDBY_SERVERS.labels(self.pool.name).set(len(self.standby_servers))
+        metrics.PROVISIONING_SERVERS.labels(self.pool.name).set(self.provisioner.in_flight())
+        metrics.TOTAL_AVAILABLE_CAPACITY.labels(self.pool.name).set(self.total_available_capacity)
+        with self.lock:
+            metrics.SUSPECT_SERVERS.labels(self.pool.name).set(self.health_scheduler.suspect_count())
+        if self.elector is not None:
+            metrics.REPLICA_LEADER.labels(self.pool.name).set(1 if self.is_leader() else 0)
+
+    def update(self) -> list:
+        """
+        Carries out one routine update: health checks, upscaling/downscaling and termination of standby servers.
+        In REPLICA_MODE, followers only sync the server lists replicated by the leader.
+        Returns the list of servers which didn't respond to the health check.
+        """
+        start: float = perf_counter()
+        if not self.renew_lease():
+            self.sync_replica()
+            self.record_metrics()
+            metrics.TICK_DURATION.observe(perf_counter() - start)
+            return []
+
+        # Launches progress in the background; pick up the ones which completed since the last update
+        self.collect_launched_servers()
+
+        # Poll the server instances which are due concurrently and apply the results as a batch
+        with metrics.HEALTH_SWEEP_DURATION.time():
+            unresponsive_servers: list = self.check_servers()
+
+        # The lease may have expired during a slow health sweep
+        if self.is_leader():
+            with metrics.SCALING_DECISION_DURATION.time():
+                self.scale()
+
+            # Terminate standby servers which are ready to close
+            with metrics.STANDBY_REAPING_DURATION.time():
+                for s in self.reap_standby_servers():
+                    print("Removing extra servers")
                     self.remove_server(s)
+
+        self.publish_snapshot()
+        self.save_state()
+        self.publish_replica()
+        self.record_metrics()
+        metrics.TICK_DURATION.observe(perf_counter() - start)
+        return unresponsive_servers
+
+    def run(self):
+        """Main function which carries out routinely maintainance and updates in the backgorund"""
+
+        print("Starting server management thread")
+
+        while(True):
+            try:
+                self.update()
+            except Exception as e:
+                print("Server update failed due to the following exception")
+                print(e)
+            next_update: float = monotonic() + self.thread_sleep_time
+
+            print("Ending server_update and sleeping")
+            # Until the next update, only the servers whose health check falls due are polled (and launches which completed are collected, see get_next_collection_time)
+            while True:
+                wake_up: float = next_update
+                for t in self.get_wake_up_times():
+                    if t is not None:
+                        wake_up = min(wake_up, t)
+                sleep(max(wake_up - monotonic(), 0))
+                if monotonic() >= next_update:
+                    break
+                try:
+                    if self.tend_lease():
+                        break
+                    if not self.is_leader():
+                        continue
+                    self.check_launched_servers()
+                    self.check_servers()
+                    self.publish_shared_table()
+                    self.publish_replica()
+                except Exception as e:
+                    print("Health checks failed due to the following exception")
+                    print(e)
             
         return
@@ -0,0 +1,428 @@
+"""This module has the SharedServerTable class which shares the table of available servers between worker processes through shared memory (Linux/Unix only, as it uses fcntl locks)"""
+
+from collections import namedtuple
+import fcntl
+import hashlib
+import heapq
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import os
+import random
+import struct
+import tempfile
+from threading import Lock
+from time import monotonic
+from django.conf import settings
+from .admission import AdmissionQueue, get_retry_after
+from .affinity import HashRing
+from .snapshot import FleetSnapshot
+
+# Server as read from the table
+SharedServer = namedtuple('SharedServer', ['address', 'available_capacity'])
+
+# Header: version of the table, number of records, number of available records (which come first),
+# monotonic time at which the next launch in flight is expected to be running and expected duration of a launch (NO_ESTIMATE if unknown)
+HEADER = struct.Struct('<QIIdd')
+# Record: address, key (digest of the task arn), published available capacity, reservations made since the last publish, state,
+# followed by the latest heartbeat: ready to close flag, pending flag (not yet taken over by the owner), sequence number, available capacity, monotonic time received
+RECORD = struct.Struct('<48s16siiBBBxqid')
+
+STATE_EMPTY = 0
+STATE_AVAILABLE = 1
+STATE_STANDBY = 2
+
+NO_HEARTBEAT = -1
+NO_ESTIMATE = -1.0
+
+def task_key(task_arn: str) -> bytes:
+    """Returns the fixed size key identifying a server in the table"""
+    return hashlib.blake2b(task_arn.encode(), digest_size=16).digest()
+
+class SharedServerTable():
+    """
+    Array-backed table of the available (then standby) servers in a named shared memory segment, published by the owner process on every update.
+    Any process assigns clients from the table, reserving capacity under a lock of the record, and records the heartbeats it receives; the owner takes both over on publish.
+
+    Attributes:
+    * name: name of the shared memory segment
+    * slots: max number of records in the table
+    * owner: boolean flag specifying whether this process owns the table (and runs the server management)
+    * admission: AdmissionQueue of the clients of this process waiting for capacity
+    """
+
+    # Number of times selection is retried if the table changes under it
+    SELECTION_ATTEMPTS = 3
+
+    def __init__(self, name: str = None, slots: int = None):
+        self.name: str = name or settings.SHARED_TABLE_NAME
+        self.slots: int = slots or settings.SHARED_TABLE_SLOTS
+        self.size: int = HEADER.size + self.slots * RECORD.size
+        self.owner: bool = False
+
+        self._memory: SharedMemory = None
+        # fcntl locks don't exclude the threads of a process from each other, so they are paired with a thread lock
+        self._thread_lock = Lock()
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), self.name + ".lock"), 'a+b')
+        self._owner_file = None
+        self._snapshot = FleetSnapshot(0, ())
+        self._rng = random.Random()
+        self._key_version: int = None
+        self._key_indices: dict = {} # key -> record index, as of table version _key_version
+        self._ring_version: int = None
+        self._ring: HashRing = None # hash ring over the indices of the available records, as of table version _ring_version
+        self.admission = AdmissionQueue(Lock(), self.reserve_server, self.get_retry_after)
+
+    def try_become_owner(self) -> bool:
+        """
+        Attempts to become the owner of the table (at most one process can be the owner at a time) and creates the shared memory segment if so.
+        Returns True if this process is the owner and False otherwise.
+        """
+        if self.owner:
+            return True
+        owner_file = open(os.path.join(tempfile.gettempdir(), self.name + ".owner"), 'a+b')
+        try:
+            fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner_file.close()
+            return False
+        self._owner_file = owner_file # the lock is held as long as the file is open
+
+        try:
+            self._memory = SharedMemory(name=self.name, create=True, size=self.size)
+        except FileExistsError:
+            # A segment left behind by a previous owner is reused if it is big enough
+            self._memory = SharedMemory(name=self.name)
+            if self._memory.size < self.size:
+                self._memory.unlink()
+                self._memory.close()
+                self._memory = SharedMemory(name=self.name, create=True, size=self.size)
+        self._untrack()
+        self.owner = True
+        print("Owner of the shared server table", self.name)
+        return True
+
+    def attach(self) -> bool:
+        """Attaches to the shared memory segment created by the owner. Returns True if successful and False otherwise"""
+        if self._memory is not None:
+            return True
+        try:
+            self._memory = SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return False
+        self._untrack()
+        return True
+
+    def _untrack(self) -> None:
+        # The resource tracker unlinks the segment when the process exits, even if it didn't create it; the segment must outlive the workers
+        resource_tracker.unregister(self._memory._name, 'shared_memory')
+
+    def _lock(self, lock_type: int, index: int = None) -> None:
+        """Locks a record (or the whole table if index is None) in the lock file"""
+        if index is None:
+            fcntl.lockf(self._lock_file, lock_type)
+        else:
+            fcntl.lockf(self._lock_file, lock_type, 1, HEADER.size + index * RECORD.size)
+
+    def _unlock(self, index: int = None) -> None:
+        self._lock(fcntl.LOCK_UN, index)
+
+    def _read_header(self) -> tuple:
+        return HEADER.unpack_from(self._memory.buf, 0)
+
+    def _unpack_record(self, index: int) -> tuple:
+        return RECORD.unpack_from(self._memory.buf, HEADER.size + index * RECORD.size)
+
+    def _read_record(self, index: int) -> tuple:
+        """Returns the address, published available capacity, reservations and state of a record"""
+        address, key, capacity, reservations, state = self._unpack_record(index)[:5]
+        return address.rstrip(b'\0').decode(), capacity, reservations, state
+
+    def _record_capacity(self, index: int) -> int:
+        """Returns the available capacity of a record (published capacity minus reservations)"""
+        capacity, reservations = self._unpack_record(index)[2:4]
+        return capacity - reservations
+
+    def _write_record(self, index: int, fields: list) -> None:
+        RECORD.pack_into(self._memory.buf, HEADER.size + index * RECORD.size, *fields)
+
+    def _write_server(self, index: int, server, state: int) -> None:
+        """Writes a fresh record for a Server object (no reservations or pending heartbeat)"""
+        heartbeat_seq: int = server.heartbeat_seq if server.heartbeat_seq is not None else NO_HEARTBEAT
+        self._write_record(index, [
+            server.address.encode(), task_key(server.task_arn), server.available_capacity, 0, state,
+            False, False, heartbeat_seq, 0, 0.0
+        ])
+
+    def publish(self, servers: list, standby_servers: list = (), provisioning_eta: float = None, launch_duration: float = None) -> int:
+        """
+        Publishes the given available (and standby) servers as the new table (owner only), along with the time (in seconds) until the next launch in flight is expected to be running
+        and the expected duration of a launch (None if unknown), see Provisioner.get_eta.
+        Reservations made from the table and heartbeats recorded in it since the last publish are first handed over to the matching Server objects.
+        Returns the number of reservations handed over.
+        """
+        servers = servers[:self.slots]
+        standby_servers = list(standby_servers)[:self.slots - len(servers)]
+        by_key: dict = {task_key(s.task_arn): s for s in servers + standby_servers}
+        handed_over: int = 0
+        with self._thread_lock:
+            self._lock(fcntl.LOCK_EX)
+            try:
+                version, count, available_count = self._read_header()[:3]
+                for i in range(count):
+                    (address, key, capacity, reservations, state,
+                     ready_to_close, pending, heartbeat_seq, heartbeat_capacity, received_at) = self._unpack_record(i)
+                    server = by_key.get(key)
+                    if server is None:
+                        continue
+                    if pending:
+                        server.apply_heartbeat(
+                            heartbeat_seq,
+                            {'available_capacity': heartbeat_capacity, 'ready_to_close': bool(ready_to_close)},
+                            received_at
+                        )
+                    if reservations > 0:
+                        server.reserve(reservations)
+                        handed_over += reservations
+
+                for i, s in enumerate(servers):
+                    self._write_server(i, s, STATE_AVAILABLE)
+                for i, s in enumerate(standby_servers, len(servers)):
+                    self._write_server(i, s, STATE_STANDBY)
+                total: int = len(servers) + len(standby_servers)
+                for i in range(total, count):
+                    self._write_record(i, [b"", b"", 0, 0, STATE_EMPTY, False, False, NO_HEARTBEAT, 0, 0.0])
+                HEADER.pack_into(
+                    self._memory.buf, 0, version + 1, total, len(servers),
+                    monotonic() + provisioning_eta if provisioning_eta is not None else NO_ESTIMATE,
+                    launch_duration if launch_duration is not None else NO_ESTIMATE
+                )
+            finally:
+                self._unlock()
+        return handed_over
+
+    def ingest_heartbeat(self, task_arn: str, seq: int, state_json: dict) -> bool:
+        """
+        Records a heartbeat pushed by a server in its record; the owner applies it on the next publish.
+        Returns True if the heartbeat is recorded and False if it is stale (out of order or a duplicate).
+        Raises KeyError if the server isn't in the table.
+        """
+        available_capacity: int = int(state_json['available_capacity'])
+        ready_to_close: bool = bool(state_json['ready_to_close'])
+        if not self.attach():
+            raise KeyError(task_arn)
+        key: bytes = task_key(task_arn)
+
+        for _ in range(self.SELECTION_ATTEMPTS):
+            index: int = self._find_record(key)
+            with self._thread_lock:
+                self._lock(fcntl.LOCK_EX, index)
+                try:
+                    fields = list(self._unpack_record(index))
+                    if fields[1] != key or fields[4] == STATE_EMPTY:
+                        continue # the owner published a new table in the meantime
+                    if fields[7] != NO_HEARTBEAT and seq <= fields[7]:
+                        return False
+                    fields[5:10] = ready_to_close, True, seq, available_capacity, monotonic()
+                    self._write_record(index, fields)
+                    return True
+                finally:
+                    self._unlock(index)
+
+        raise KeyError(task_arn)
+
+    def _find_record(self, key: bytes) -> int:
+        """
+        Returns the index of the record with the given key (as of the latest table version).
+        The key to index mapping is only rebuilt when the owner has published a new version.
+        Raises KeyError if there is no such record.
+        """
+        version, count, available_count = self._read_header()[:3]
+        if version != self._key_version:
+            with self._thread_lock:
+                self._lock(fcntl.LOCK_SH)
+                try:
+                    version, count, available_count = self._read_header()[:3]
+                    self._key_indices = {self._unpack_record(i)[1]: i for i in range(count)}
+                    self._key_version = version
+                finally:
+                    self._unlock()
+        return self._key_indices[key]
+
+    def _get_ring(self, version: int) -> HashRing:
+        """Returns the hash ring over the indices of the available records; it is only rebuilt when the owner has published a new version"""
+        if version != self._ring_version:
+            with self._thread_lock:
+                self._lock(fcntl.LOCK_SH)
+                try:
+                    version, count, available_count = self._read_header()[:3]
+                    ring = HashRing()
+                    for i in range(available_count):
+                        ring.add(i, self._unpack_record(i)[1])
+                finally:
+                    self._unlock()
+            self._ring, self._ring_version = ring, version
+        return self._ring
+
+    def get_available_server(self, game_id: str = None, require_capacity: bool = False) -> SharedServer:
+        """
+        Reserves capacity on an available server from the table and returns it
+        If a game (or room) id is given, the server is picked with the hash ring (falling back to power of two choices if no server has capacity left)
+        With require_capacity set, no server is oversubscribed: None is returned if no available server has capacity left
+        Raises IndexError if there is no available server (unless require_capacity is set)
+        """
+        if not self.attach():
+            if require_capacity:
+                return None
+            raise IndexError("Shared server table " + self.name + " doesn't exist yet")
+
+        for _ in range(self.SELECTION_ATTEMPTS):
+            version, count, available_count = self._read_header()[:3]
+            if available_count == 0:
+                break
+
+            index: int = None
+            if game_id is not None:
+                # Records are read without locking; the choice is re-validated under the record lock
+                index = self._get_ring(version).lookup(game_id.encode(), lambda i: self._record_capacity(i) > 0)
+            if index is None:
+                # Sample two available records without locking; the choice is re-validated under the record lock
+                first: int = self._rng.randrange(available_count)
+                second: int = self._rng.randrange(available_count)
+                first_record = self._read_record(first)
+                second_record = self._read_record(second)
+                first_capacity: int = first_record[1] - first_record[2]
+                second_capacity: int = second_record[1] - second_record[2]
+                if settings.SELECTION_POLICY == 'pack' and min(first_capacity, second_capacity) > 0:
+                    # Packing: the fuller of the two, as long as it has capacity left
+                    index = first if first_capacity <= second_capacity else second
+                else:
+                    index = first if first_capacity >= second_capacity else second
+                if require_capacity and self._record_capacity(index) <= 0:
+                    index = max(range(available_count), key=self._record_capacity)
+                    if self._record_capacity(index) <= 0:
+                        return None
+
+            with self._thread_lock:
+                self._lock(fcntl.LOCK_EX, index)
+                try:
+                    fields = list(self._unpack_record(index))
+                    capacity, reservations, state = fields[2:5]
+                    if state != STATE_AVAILABLE:
+                        continue # the owner published a smaller table in the meantime
+                    if game_id is not None and self._read_header()[0] != version:
+                        continue # the ring is outdated, the record may hold another server by now
+                    if require_capacity and capacity - reservations <= 0:
+                        continue # taken by a concurrent assignment
+                    fields[3] = reservations + 1
+                    self._write_record(index, fields)
+                    address: str = fields[0].rstrip(b'\0').decode()
+                finally:
+                    self._unlock(index)
+            return SharedServer(address, capacity - reservations - 1)
+
+        if require_capacity:
+            return None
+        raise IndexError("No server available in shared server table")
+
+    def reserve_server(self, game_id: str = None) -> SharedServer:
+        """Returns an available server with capacity reserved for the client, or None if no available server has capacity left (see get_available_server)"""
+        return self.get_available_server(game_id, require_capacity=True)
+
+    def admit(self, game_id: str = None, wait: float = 0.0) -> SharedServer:
+        """
+        Returns an available server with capacity reserved for the client, waiting up to wait seconds for capacity (see ServerManagerThread.admit)
+        Raises Saturated if the client isn't admitted, and IndexError if there is no available server and no launch in flight
+        """
+        self.check_admissible()
+        return self.admission.acquire(game_id, wait)
+
+    async def admit_async(self, game_id: str = None, wait: float = 0.0) -> SharedServer:
+        """asyncio counterpart of admit"""
+        self.check_admissible()
+        return await self.admission.acquire_async(game_id, wait)
+
+    def check_admissible(self) -> None:
+        """Raises IndexError if there is no available server and no launch in flight"""
+        if not self.attach():
+            raise IndexError("Shared server table " + self.name + " doesn't exist yet")
+        version, count, available_count, launch_due = self._read_header()[:4]
+        # A table which was never published (version 0) has no estimates yet
+        if available_count == 0 and (version == 0 or launch_due == NO_ESTIMATE):
+            raise IndexError("No available server and no launch in flight")
+
+    def get_retry_after(self, queue_depth: int) -> int:
+        """Returns the time (in seconds) after which a client turned away with queue_depth clients waiting should retry, from the estimates published by the owner"""
+        launch_due, launch_duration = self._read_header()[3:]
+        eta: float = max(launch_due - monotonic(), 0.0) if launch_due != NO_ESTIMATE else None
+        return get_retry_after(eta, launch_duration if launch_duration != NO_ESTIMATE else None, queue_depth)
+
+    def reserve_groups(self, group_sizes: list) -> list:
+        """
+        Reserves capacity for a batch of groups of clients from the table (see ServerManagerThread.reserve_groups).
+        The whole table is locked for the batch, so concurrent batches (from any process) can't oversubscribe a server.
+        Returns the list of SharedServer assigned to the groups (in the given order), with None for the groups which don't fit on any server.
+        """
+        assigned: list = [None] * len(group_sizes)
+        if not self.attach():
+            return assigned
+        with self._thread_lock:
+            self._lock(fcntl.LOCK_EX)
+            try:
+                version, count, available_count = self._read_header()[:3]
+                heap: list = [(-self._record_capacity(i), i) for i in range(available_count)]
+                heapq.heapify(heap)
+                reserved: dict = {} # record index -> capacity reserved by this batch
+                for g in sorted(range(len(group_sizes)), key=lambda g: -group_sizes[g]):
+                    if not heap or -heap[0][0] < group_sizes[g]:
+                        continue # smaller groups may still fit
+                    neg_capacity, i = heapq.heappop(heap)
+                    reserved[i] = reserved.get(i, 0) + group_sizes[g]
+                    heapq.heappush(heap, (neg_capacity + group_sizes[g], i))
+                    assigned[g] = SharedServer(self._read_record(i)[0], -neg_capacity - group_sizes[g])
+                for i, amount in reserved.items():
+                    fields = list(self._unpack_record(i))
+                    fields[3] += amount
+                    self._write_record(i, fields)
+            finally:
+                self._unlock()
+        return assigned
+
+    def get_snapshot(self) -> FleetSnapshot:
+        """Returns a FleetSnapshot of the table; it is rebuilt only when the owner has published a new version"""
+        if not self.attach():
+            return self._snapshot
+        version, count, available_count = self._read_header()[:3]
+        if version != self._snapshot.version:
+            with self._thread_lock:
+                self._lock(fcntl.LOCK_SH)
+                try:
+                    version, count, available_count = self._read_header()[:3]
+                    addresses: list = [self._read_record(i)[0] for i in range(available_count)]
+                finally:
+                    self._unlock()
+            self._snapshot = FleetSnapshot(version, addresses)
+        return self._snapshot
+
+    def get_available_servers(self) -> list:
+        """Returns the list of available servers in the table"""
+        if not self.attach():
+            return []
+        with self._thread_lock:
+            self._lock(fcntl.LOCK_SH)
+            try:
+                version, count, available_count = self._read_header()[:3]
+                records: list = [self._read_record(i) for i in range(available_count)]
+            finally:
+                self._unlock()
+        return [SharedServer(address, capacity - reservations) for address, capacity, reservations, state in records]
+
+_shared_table: SharedServerTable = None
+_shared_table_lock = Lock()
+
+def get_shared_table() -> SharedServerTable:
+    """Returns the SharedServerTable of this process"""
+    global _shared_table
+    with _shared_table_lock:
+        if _shared_table is None:
+            _shared_table = SharedServerTable()
+        return _shared_table
@@ -0,0 +1,44 @@
+"""This module has the FleetSnapshot class, an immutable view of the available servers which the request handlers can read without locking"""
+
+import hashlib
+import json
+
+def encode_assignment(address: str) -> bytes:
+    """Returns the json response body for assigning the given gameserver address"""
+    return json.dumps({'available': address}).encode()
+
+class FleetSnapshot():
+    """
+    Immutable view of the available servers published by the ServerManagerThread once per update.
+    Response bodies are serialized up front, so the request handlers only copy bytes.
+
+    Attributes:
+    * version: integer incremented with every published snapshot
+    * addresses: tuple of addresses of the available servers
+    * list_body: json response body (bytes) for the list of available servers
+    * etag: quoted entity tag of list_body; unlike version, it stays the same as long as the list doesn't change
+    * assignment_bodies: dict mapping each address to the json response body (bytes) assigning it
+    """
+
+    __slots__ = ('version', 'addresses', 'list_body', 'etag', 'assignment_bodies')
+
+    def __init__(self, version: int, addresses: tuple):
+        self.version: int = version
+        self.addresses: tuple = tuple(addresses)
+        self.list_body: bytes = json.dumps({'server_list': list(self.addresses)}).encode()
+        self.etag: str = '"' + hashlib.sha1(self.list_body).hexdigest()[:16] + '"'
+        self.assignment_bodies: dict = {address: encode_assignment(address) for address in self.addresses}
+
+    def assignment_body(self, address: str) -> bytes:
+        """Returns the json response body assigning the given address (serialized on the fly if it isn't in the snapshot)"""
+        body = self.assignment_bodies.get(address)
+        if body is None:
+            body = encode_assignment(address)
+        return body
+
+def merge_snapshots(snapshots: list) -> FleetSnapshot:
+    """
+    Returns the snapshot of the available servers of several pools, in the given order.
+    Its version is the sum of theirs, so it is incremented whenever any of them is.
+    """
+    return FleetSnapshot(sum(s.version for s in snapshots), [address for s in snapshots for address in s.addresses])
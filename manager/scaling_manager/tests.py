@@ -1,3 +1,1886 @@
-from django.test import TestCase
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, redirect_stderr, redirect_stdout
+import io
+import json
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import os
+import random
+import socket
+import tempfile
+from threading import RLock
+from time import monotonic, sleep, time
 
-# Create your tests here.
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from .admission import AdmissionQueue, Saturated, get_retry_after
+from .affinity import GameAffinity, HashRing
+from .async_manager import AsyncServerManager
+from .aws_client import AWSClient, TTLCache, TokenBucket
+from .aws_utils import clear_caches, discover_servers, get_ip, place_task
+from .benchmark.fake_aws import FakeCloud
+from .benchmark.fake_gameservers import FakeGameserverPool, constant, ramp, step
+from .benchmark.scenarios import fleet
+from .benchmark.simulator import DemandTrace, simulate
+from .capacity_index import CapacityIndex
+from .forecast import DemandForecast, DemandHistory
+from .health_checks import AsyncHealthChecker, HealthChecker
+from .health_scheduler import HealthScheduler
+from .journal import StateJournal
+from .metrics import Counter, Gauge, Histogram, Registry
+from .pools import get_pools, rank_pools, reset_pools
+from .provisioning import Provisioner
+from .replication import FileLeaseBackend, LeaderElector, SQLiteLeaseBackend
+from .reservations import ReservationLedger
+from .routing import PoolRouter
+from .scaling_policy import ScalingPolicy
+from .server_classes import Server, ServerManagerThread
+from .shared_table import SharedServerTable
+from .views import admission_response, assignment_response, batch_assignment_response, heartbeat_response, list_response, metrics_view
+from .warm_pool import WarmPool
+from . import metrics, views
+
+def make_client(service: str):
+    """Returns a boto3 client which is never allowed to reach AWS (all calls must be stubbed)"""
+    return boto3.client(
+        service,
+        region_name="ap-south-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+
+class DiscoverServersTests(SimpleTestCase):
+
+    def setUp(self):
+        self.ecs_client = make_client("ecs")
+        self.ec2_client = make_client("ec2")
+        self.ecs_stubber = Stubber(self.ecs_client)
+        self.ec2_stubber = Stubber(self.ec2_client)
+        clear_caches()
+
+    def task_description(self, i: int, status: str = 'RUNNING') -> dict:
+        return {
+            'taskArn': "arn:task/%d" % i,
+            'containerInstanceArn': "arn:container-instance/%d" % (i % 3),
+            'lastStatus': status,
+            'containers': [{'networkBindings': [{'hostPort': 8000 + i}]}],
+        }
+
+    def test_discovery_is_batched(self):
+        task_arns = ["arn:task/%d" % i for i in range(150)]
+
+        # one describe_tasks call per 100 tasks
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(i) for i in range(100)], 'failures': []},
+            {'tasks': task_arns[:100]},
+        )
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(i) for i in range(100, 150)], 'failures': []},
+            {'tasks': task_arns[100:]},
+        )
+        # one describe_container_instances call for all instances
+        self.ecs_stubber.add_response(
+            'describe_container_instances',
+            {'containerInstances': [
+                {'containerInstanceArn': "arn:container-instance/%d" % i, 'ec2InstanceId': "i-%d" % i}
+                for i in range(3)
+            ]},
+        )
+        # one describe_instances call for all EC2 ids
+        self.ec2_stubber.add_response(
+            'describe_instances',
+            {'Reservations': [{'Instances': [
+                {'InstanceId': "i-%d" % i, 'PublicIpAddress': "10.0.0.%d" % i}
+                for i in range(3)
+            ]}]},
+        )
+
+        with self.ecs_stubber, self.ec2_stubber:
+            servers = discover_servers(task_arns, self.ecs_client, self.ec2_client)
+
+        self.ecs_stubber.assert_no_pending_responses()
+        self.ec2_stubber.assert_no_pending_responses()
+        self.assertEqual(len(servers), 150)
+        self.assertEqual(servers[7], {'task_arn': "arn:task/7", 'ec2_id': "i-1", 'address': "10.0.0.1:8007"})
+
+    def test_known_instances_are_not_described_again(self):
+        task_arns = ["arn:task/0", "arn:task/1"]
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(0), self.task_description(1)], 'failures': []},
+        )
+        self.ecs_stubber.add_response(
+            'describe_container_instances',
+            {'containerInstances': [
+                {'containerInstanceArn': "arn:container-instance/%d" % i, 'ec2InstanceId': "i-%d" % i}
+                for i in range(2)
+            ]},
+        )
+        self.ec2_stubber.add_response(
+            'describe_instances',
+            {'Reservations': [{'Instances': [
+                {'InstanceId': "i-%d" % i, 'PublicIpAddress': "10.0.0.%d" % i}
+                for i in range(2)
+            ]}]},
+        )
+        # second discovery only describes the tasks
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(0), self.task_description(1)], 'failures': []},
+        )
+
+        with self.ecs_stubber, self.ec2_stubber:
+            first = discover_servers(task_arns, self.ecs_client, self.ec2_client)
+            second = discover_servers(task_arns, self.ecs_client, self.ec2_client)
+
+        self.ecs_stubber.assert_no_pending_responses()
+        self.ec2_stubber.assert_no_pending_responses()
+        self.assertEqual(first, second)
+
+    def test_throttled_calls_are_retried(self):
+        ec2_client = AWSClient(self.ec2_client, rate=100, burst=10, max_retries=2, base_delay=0.001)
+        self.ec2_stubber.add_client_error('describe_instances', service_error_code='RequestLimitExceeded')
+        self.ec2_stubber.add_client_error('describe_instances', service_error_code='RequestLimitExceeded')
+        self.ec2_stubber.add_response(
+            'describe_instances',
+            {'Reservations': [{'Instances': [{'InstanceId': "i-0", 'PublicIpAddress': "10.0.0.0"}]}]},
+        )
+
+        with self.ec2_stubber:
+            self.assertEqual(get_ip("i-0", ec2_client), "10.0.0.0")
+
+        self.ec2_stubber.assert_no_pending_responses()
+
+    def test_throttled_pages_and_waits_are_retried(self):
+        ecs_client = AWSClient(self.ecs_client, rate=100, burst=10, max_retries=2, base_delay=0.001)
+        self.ecs_stubber.add_response('list_tasks', {'taskArns': ["arn:task/0"], 'nextToken': "page-2"}, {'family': "LaunchGameserver"})
+        self.ecs_stubber.add_client_error('list_tasks', service_error_code='ThrottlingException')
+        self.ecs_stubber.add_response('list_tasks', {'taskArns': ["arn:task/1"]}, {'family': "LaunchGameserver", 'nextToken': "page-2"})
+        # A throttled poll fails the waiter, which is started over
+        self.ecs_stubber.add_client_error('describe_tasks', service_error_code='ThrottlingException')
+        self.ecs_stubber.add_response('describe_tasks', {'tasks': [self.task_description(0)], 'failures': []})
+
+        with self.ecs_stubber:
+            pages = ecs_client.get_paginator('list_tasks').paginate(family="LaunchGameserver")
+            self.assertEqual([arn for page in pages for arn in page['taskArns']], ["arn:task/0", "arn:task/1"])
+            ecs_client.get_waiter('tasks_running').wait(tasks=["arn:task/0"])
+
+        self.ecs_stubber.assert_no_pending_responses()
+
+    def test_pending_tasks_are_waited_for(self):
+        task_arns = ["arn:task/0", "arn:task/1"]
+
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(0), self.task_description(1, 'PENDING')], 'failures': []},
+            {'tasks': task_arns},
+        )
+        # tasks_running waiter polls describe_tasks for the pending tasks only
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(1)], 'failures': []},
+            {'tasks': ["arn:task/1"]},
+        )
+        self.ecs_stubber.add_response(
+            'describe_tasks',
+            {'tasks': [self.task_description(1)], 'failures': []},
+            {'tasks': ["arn:task/1"]},
+        )
+        self.ecs_stubber.add_response(
+            'describe_container_instances',
+            {'containerInstances': [
+                {'containerInstanceArn': "arn:container-instance/%d" % i, 'ec2InstanceId': "i-%d" % i}
+                for i in range(2)
+            ]},
+        )
+        self.ec2_stubber.add_response(
+            'describe_instances',
+            {'Reservations': [{'Instances': [
+                {'InstanceId': "i-0", 'PublicIpAddress': "10.0.0.0"},
+                {'InstanceId': "i-1"}, # no public ip
+            ]}]},
+        )
+
+        with self.ecs_stubber, self.ec2_stubber:
+            servers = discover_servers(task_arns, self.ecs_client, self.ec2_client)
+
+        self.ecs_stubber.assert_no_pending_responses()
+        self.ec2_stubber.assert_no_pending_responses()
+        self.assertEqual([s['task_arn'] for s in servers], ["arn:task/0"])
+
+class AWSClientTests(SimpleTestCase):
+
+    def test_concurrent_reads_are_coalesced(self):
+        cloud = FakeCloud(api_latency=0.1)
+        task_arns = cloud.add_running_servers(2)
+        client = AWSClient(cloud.ecs, rate=100, burst=10)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            reads = [executor.submit(client.describe_tasks, tasks=task_arns) for _ in range(3)]
+            # Another request of the same operation, and mutations, are calls of their own
+            other = executor.submit(client.describe_tasks, tasks=task_arns[:1])
+            self.assertEqual(len({id(f.result()) for f in reads}), 1)
+            self.assertEqual(len(other.result()['tasks']), 1)
+        self.assertEqual(cloud.calls['describe_tasks'], 2)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda arn: client.stop_task(task=arn), [task_arns[0]] * 2))
+        self.assertEqual(cloud.calls['stop_task'], 2)
+
+    def test_retries_are_bounded(self):
+        ec2_client = make_client("ec2")
+        stubber = Stubber(ec2_client)
+        client = AWSClient(ec2_client, rate=100, burst=10, max_retries=1, base_delay=0.001)
+        for _ in range(2):
+            stubber.add_client_error('describe_instances', service_error_code='RequestLimitExceeded')
+        # Other errors aren't retried
+        stubber.add_client_error('describe_instances', service_error_code='InvalidInstanceID.NotFound')
+        with stubber:
+            with self.assertRaises(ClientError):
+                client.describe_instances(InstanceIds=["i-0"])
+            with self.assertRaises(ClientError) as raised:
+                client.describe_instances(InstanceIds=["i-0"])
+        self.assertEqual(raised.exception.response['Error']['Code'], 'InvalidInstanceID.NotFound')
+        stubber.assert_no_pending_responses()
+
+    def test_calls_beyond_the_burst_are_spread_out(self):
+        bucket = TokenBucket(rate=100, burst=2)
+        start = monotonic()
+        for _ in range(2):
+            bucket.acquire()
+        self.assertLess(monotonic() - start, 0.01)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(monotonic() - start, 0.045)
+
+    def test_cache_entries_expire_and_are_invalidated(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set("arn:container-instance/0", "i-0")
+        cache.set("arn:container-instance/1", "i-0")
+        cache.set("arn:container-instance/2", "i-1")
+        self.assertEqual(cache.get("arn:container-instance/0"), "i-0")
+        # A terminated instance is dropped from every entry pointing to it
+        cache.invalidate_values("i-0")
+        self.assertIsNone(cache.get("arn:container-instance/1"))
+        self.assertEqual(cache.get("arn:container-instance/2"), "i-1")
+        sleep(0.06)
+        self.assertEqual(cache.get("arn:container-instance/2", "expired"), "expired")
+
+class ProvisionerTests(SimpleTestCase):
+
+    def wait_for(self, provisioner: Provisioner) -> None:
+        while provisioner.in_flight() > 0:
+            sleep(0.01)
+
+    @override_settings(ADMISSION_RETRY_AFTER=120.0)
+    def test_launches_are_collected_once_running(self):
+        with fleet(0, launch_delay=0.05) as (cloud, gameservers, manager):
+            provisioner = manager.provisioner
+            first = provisioner.launch()
+            self.assertEqual(provisioner.in_flight(), 1)
+            # Launches are expected to take ADMISSION_RETRY_AFTER until one is timed
+            self.assertEqual(provisioner.get_eta(now=first.started_at + 20.0), 100.0)
+            self.assertEqual(provisioner.collect(), [])
+            self.wait_for(provisioner)
+            self.assertEqual(first.state, 'RUNNING')
+            self.assertEqual(provisioner.collect(), [first.server])
+            self.assertEqual(provisioner.launches, [])
+            self.assertIsNone(provisioner.get_eta())
+            first_duration = first.finished_at - first.started_at
+            self.assertEqual(provisioner.launch_duration, first_duration)
+
+            second = provisioner.launch()
+            self.assertAlmostEqual(provisioner.get_eta(now=second.started_at), first_duration)
+            self.wait_for(provisioner)
+            provisioner.collect()
+            # Exponentially weighted moving average of the launch durations
+            second_duration = second.finished_at - second.started_at
+            self.assertAlmostEqual(provisioner.launch_duration, first_duration + 0.3 * (second_duration - first_duration))
+            self.assertEqual(len(cloud.running_tasks()), 2)
+
+    def test_failed_launch_releases_its_instance(self):
+        def unreachable_server(task_arn: str, pool=None):
+            raise Exception("Gameserver " + task_arn + " unreachable")
+
+        with fleet(1, tasks_per_instance=2, PLACEMENT_MODE='binpack') as (cloud, gameservers, manager):
+            provisioner = Provisioner(manager.task_family, unreachable_server, max_workers=1, in_use=manager.is_instance_in_use)
+            try:
+                # The task is packed onto the instance of a server instance, which is left running
+                launch = provisioner.launch()
+                self.wait_for(provisioner)
+                self.assertEqual(launch.state, 'FAILED')
+                self.assertEqual(launch.ec2_id, manager.available_servers[0].ec2_id)
+                self.assertEqual(len(cloud.running_instances()), 1)
+                self.assertEqual([t['taskArn'] for t in cloud.running_tasks()], [manager.available_servers[0].task_arn])
+
+                # The instance booted for the task is terminated
+                cloud.tasks_per_instance = 1
+                launch = provisioner.launch()
+                self.wait_for(provisioner)
+                self.assertEqual(launch.state, 'FAILED')
+                self.assertNotEqual(launch.ec2_id, manager.available_servers[0].ec2_id)
+                self.assertEqual(cloud.instances[launch.ec2_id]['State'], 'terminated')
+                self.assertEqual(len(cloud.running_tasks()), 1)
+                self.assertEqual(provisioner.collect(), [])
+            finally:
+                provisioner.shutdown()
+
+    def test_binpack_fills_instances_and_keeps_shared_ones(self):
+        with fleet(1, tasks_per_instance=2, PLACEMENT_MODE='binpack') as (cloud, gameservers, manager):
+            [original] = manager.available_servers
+            launches: list = []
+            for _ in range(3):
+                launches.append(manager.provisioner.launch())
+                self.wait_for(manager.provisioner)
+            self.assertEqual([l.state for l in launches], ['RUNNING'] * 3)
+            # The instance of the running server is filled first, then a fresh one is booted and filled
+            self.assertEqual(launches[0].ec2_id, original.ec2_id)
+            self.assertNotEqual(launches[1].ec2_id, original.ec2_id)
+            self.assertEqual(launches[2].ec2_id, launches[1].ec2_id)
+            self.assertEqual(len(cloud.running_instances()), 2)
+            manager.collect_launched_servers()
+
+            def scale_in(server: Server) -> None:
+                # As the server would be once reaped from standby (see reap_standby_servers)
+                manager.remove_available_server(server)
+                manager.servers_by_task_arn.pop(server.task_arn)
+                self.assertTrue(manager.remove_server(server))
+
+            # Scaling in a server sharing its instance only stops its task
+            packed = launches[0].server
+            scale_in(packed)
+            self.assertEqual(cloud.instances[original.ec2_id]['State'], 'running')
+            self.assertNotIn(packed.task_arn, [t['taskArn'] for t in cloud.running_tasks()])
+            # The last server of an instance takes the instance with it
+            scale_in(original)
+            self.assertEqual(cloud.instances[original.ec2_id]['State'], 'terminated')
+
+@override_settings(SCALE_OUT_MAX_BURST=3, SCALE_IN_MAX_STEP=2, SCALE_OUT_COOLDOWN=30.0, SCALE_IN_COOLDOWN=60.0, SCALE_IN_STABLE_TICKS=3)
+class ScalingPolicyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.policy = ScalingPolicy(upscale_margin=50, downscale_margin=200, server_capacity=10)
+
+    def test_scale_out_covers_the_deficit_up_to_the_burst(self):
+        self.assertEqual(self.policy.decide(25, 0, 3, now=0.0), 3)
+        # Within the cooldown, even a bigger deficit waits
+        self.assertEqual(self.policy.decide(0, 0, 3, now=10.0), 0)
+        self.assertEqual(self.policy.decide(45, 0, 3, now=40.0), 1)
+        # Launches in flight count towards the capacity
+        self.assertEqual(self.policy.decide(30, 20, 3, now=100.0), 0)
+        self.assertEqual(self.policy.decide(0, 0, 3, now=100.0), 3) # a deficit of 5 servers, capped to the burst
+        # The forecast growth raises the target, but never above one server capacity below the downscale margin
+        self.assertEqual(self.policy.get_target_capacity(60), 110)
+        self.assertEqual(self.policy.get_target_capacity(500), 190)
+        self.assertEqual(self.policy.get_target_capacity(-20), 50)
+        self.assertEqual(self.policy.decide(100, 0, 10, now=200.0, forecast_growth=80), 3)
+
+    def test_scale_in_needs_stable_ticks_and_cooldowns(self):
+        # An excess of 35 is worth 3 servers, capped to the step
+        self.assertEqual([self.policy.decide(235, 0, 10, now=t) for t in (0.0, 1.0, 2.0)], [0, 0, -2])
+        # The third stable tick is within the cooldown
+        self.assertEqual([self.policy.decide(235, 0, 10, now=t) for t in (10.0, 20.0, 30.0, 62.0)], [0, 0, 0, -2])
+        # A tick within the margins (or with launches in flight) restarts the count
+        self.assertEqual([self.policy.decide(c, f, 10, now=t) for c, f, t in ((205, 0, 200.0), (150, 0, 201.0), (205, 0, 202.0), (205, 10, 203.0))], [0, 0, 0, 0])
+        self.assertEqual([self.policy.decide(205, 0, 10, now=t) for t in (204.0, 205.0, 206.0)], [0, 0, -1])
+        # The last server is never removed
+        self.assertEqual([self.policy.decide(235, 0, 1, now=t) for t in (300.0, 301.0, 302.0)], [0, 0, 0])
+        # No scale-in within the cooldown of a scale-out
+        self.assertEqual(self.policy.decide(0, 0, 10, now=400.0), 3)
+        self.assertEqual([self.policy.decide(235, 0, 10, now=t) for t in (401.0, 402.0, 403.0, 461.0)], [0, 0, 0, -2])
+
+class ReservationLedgerTests(SimpleTestCase):
+
+    def test_reservations_expire_after_the_ttl(self):
+        ledger = ReservationLedger(ttl=30.0)
+        ledger.reserve(now=0.0)
+        ledger.reserve(2, now=10.0)
+        self.assertEqual(ledger.outstanding(now=29.0), 3)
+        self.assertEqual(ledger.outstanding(now=30.0), 2)
+        self.assertEqual(ledger.outstanding(now=40.0), 0)
+        ledger.reserve(now=50.0)
+        ledger.clear()
+        self.assertEqual(ledger.outstanding(now=50.0), 0)
+
+    def test_settle_clears_the_oldest_reservations(self):
+        ledger = ReservationLedger(ttl=30.0)
+        ledger.reserve(2, now=0.0)
+        ledger.reserve(3, now=10.0)
+        ledger.settle(3)
+        self.assertEqual(ledger.outstanding(now=20.0), 2)
+        # The settled reservations don't expire a second time
+        self.assertEqual(ledger.outstanding(now=35.0), 2)
+        ledger.settle(5)
+        self.assertEqual(ledger.outstanding(now=35.0), 0)
+        ledger.reserve(now=36.0)
+        self.assertEqual(ledger.outstanding(now=36.0), 1)
+
+def get_list(manager, etag: str = None):
+    headers: dict = {'HTTP_IF_NONE_MATCH': etag} if etag is not None else {}
+    return list_response(RequestFactory().get('/available-gameserver-list/', **headers), manager)
+
+class FleetSnapshotTests(SimpleTestCase):
+
+    @override_settings(SNAPSHOT_MAX_AGE=1)
+    def test_list_is_revalidated_with_its_etag(self):
+        with fleet(2) as (cloud, gameservers, manager):
+            response = get_list(manager)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sorted(json.loads(response.content)['server_list']), sorted(s.address for s in manager.available_servers))
+            self.assertEqual(response['X-Fleet-Version'], str(manager.get_snapshot().version))
+            self.assertIn('max-age=1', response['Cache-Control'])
+            etag = response['ETag']
+
+            # A new snapshot of the same list has a new version but the same etag
+            manager.publish_snapshot()
+            response = get_list(manager, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response['X-Fleet-Version'], str(manager.get_snapshot().version))
+
+            removed = manager.available_servers[0]
+            manager.remove_available_server(removed)
+            manager.publish_snapshot()
+            response = get_list(manager, etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertNotIn(removed.address, json.loads(response.content)['server_list'])
+            # An address which left the snapshot is still serialized on demand
+            self.assertEqual(json.loads(manager.get_snapshot().assignment_body(removed.address)), {'available': removed.address})
+
+class ServerManagerThreadTests(SimpleTestCase):
+
+    def test_failures_dont_stop_the_manager_thread(self):
+        calls = {'update': 0, 'check_servers': 0}
+
+        def update():
+            calls['update'] += 1
+            if calls['update'] == 3:
+                # Not an Exception, so it ends the thread
+                raise SystemExit
+            raise ValueError("update failed")
+
+        def check_servers():
+            calls['check_servers'] += 1
+            raise ValueError("health checks failed")
+
+        with fleet(1, THREAD_SLEEP_TIME=0.05) as (cloud, gameservers, manager), redirect_stdout(io.StringIO()) as output:
+            manager.update = update
+            manager.check_servers = check_servers
+            # A health check falls due between the updates
+            manager.get_wake_up_times = lambda: [monotonic() + 0.01]
+            manager.start()
+            manager.join(timeout=5.0)
+            self.assertFalse(manager.is_alive())
+        self.assertEqual(calls['update'], 3)
+        self.assertGreater(calls['check_servers'], 0)
+        self.assertIn("update failed", output.getvalue())
+        self.assertIn("health checks failed", output.getvalue())
+
+class AsyncServerManagerTests(SimpleTestCase):
+
+    def test_update_scales_and_collects_launches(self):
+        with fleet(2, launch_delay=0.1, UPSCALE_MARGIN=25, HEALTH_CHECK_DEAD_AFTER=1) as (cloud, gameservers, manager):
+            async_manager = AsyncServerManager(manager)
+
+            async def scenario():
+                # The fleet is one server short of the margin
+                self.assertEqual(await async_manager.update(), [])
+                self.assertEqual(manager.provisioner.in_flight(), 1)
+                while manager.provisioner.in_flight() > 0:
+                    await asyncio.sleep(0.01)
+                await async_manager.update()
+                self.assertEqual(len(manager.available_servers), 3)
+                self.assertEqual(manager.total_available_capacity, 30)
+                self.assertEqual(len(manager.get_snapshot().addresses), 3)
+
+                # A server which stops responding is dropped once it is dead
+                gameservers.stop_server(int(manager.available_servers[0].address.split(':')[1]))
+                self.assertEqual(len(await async_manager.check_servers()), 1)
+                self.assertEqual(len(manager.available_servers), 2)
+
+            asyncio.run(scenario())
+
+    def test_async_views(self):
+        with fleet(2) as (cloud, gameservers, manager):
+            asyncio.run(AsyncServerManager(manager).update())
+            addresses = {s.address for s in manager.available_servers}
+            request = RequestFactory().post('/available-gameserver-batch/', json.dumps({'groups': [9, 9, 9]}), content_type='application/json')
+            response = asyncio.run(views.available_gameserver_batch_async(request))
+            self.assertEqual([a['available'] in addresses for a in json.loads(response.content)['assignments']], [True, True, False])
+
+            request = RequestFactory().get('/available-gameserver/', {'game_id': "game-0"})
+            response = asyncio.run(views.available_gameserver_async(request))
+            self.assertIn(json.loads(response.content)['available'], addresses)
+            with override_settings(ADMISSION_CONTROL=True):
+                response = asyncio.run(views.available_gameserver_async(RequestFactory().get('/available-gameserver/', {'wait': "0"})))
+                self.assertIn(json.loads(response.content)['available'], addresses)
+                # No capacity is left
+                response = asyncio.run(views.available_gameserver_async(RequestFactory().get('/available-gameserver/', {'wait': "0"})))
+                self.assertEqual(response.status_code, 429)
+            self.assertEqual(sum(s.available_capacity for s in manager.available_servers), 0)
+
+            response = asyncio.run(views.available_gameserver_list_async(RequestFactory().get('/available-gameserver-list/')))
+            self.assertEqual(set(json.loads(response.content)['server_list']), addresses)
+
+def reserve_from_shared_table(name: str, count: int, results) -> None:
+    """Reserves capacity count times from a shared server table (in a worker process) and reports the number of reservations made"""
+    table = SharedServerTable(name, slots=8)
+    results.put(sum(table.reserve_server() is not None for _ in range(count)))
+
+def own_shared_table(name: str, servers: list, published, done) -> None:
+    """Owns a shared server table (in a worker process), publishes the given servers (the last one standby) and holds on to it until done is set"""
+    table = SharedServerTable(name, slots=8)
+    published.put(table.try_become_owner())
+    table.publish(servers[:-1], servers[-1:])
+    published.put(True)
+    done.wait()
+
+class SharedServerTableTests(SimpleTestCase):
+
+    def setUp(self):
+        self.name = "test_servers_" + str(os.getpid()) + "_" + self._testMethodName
+        self.servers = []
+        for i in range(3):
+            server = Server("arn:task/" + str(i), "i-" + str(i), "10.0.0." + str(i) + ":8000")
+            server.reported_capacity = 50
+            self.servers.append(server)
+        self.processes = multiprocessing.get_context('fork')
+
+    def tearDown(self):
+        try:
+            SharedMemory(name=self.name).unlink()
+        except FileNotFoundError:
+            pass
+        for suffix in (".lock", ".owner"):
+            os.remove(os.path.join(tempfile.gettempdir(), self.name + suffix))
+
+    def test_worker_processes_never_oversubscribe(self):
+        owner = SharedServerTable(self.name, slots=8)
+        self.assertTrue(owner.try_become_owner())
+        owner.publish(self.servers[:2], self.servers[2:])
+        results = self.processes.Queue()
+        workers = [self.processes.Process(target=reserve_from_shared_table, args=(self.name, 80, results)) for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # Each reservation was revalidated under the record lock, so exactly the published capacity was reserved
+        self.assertEqual(results.get() + results.get(), 100)
+        self.assertIsNone(owner.reserve_server())
+        # The reservations are handed over to the servers on the next publish
+        self.assertEqual(owner.publish(self.servers[:2], self.servers[2:]), 100)
+        self.assertEqual([s.available_capacity for s in self.servers], [0, 0, 50])
+        self.assertEqual(owner.get_snapshot().addresses, ("10.0.0.0:8000", "10.0.0.1:8000"))
+
+    def test_health_checks_reach_the_workers_between_updates(self):
+        with fleet(2, HEALTH_CHECK_MIN_INTERVAL=5.0, HEALTH_CHECK_MAX_INTERVAL=5.0) as (cloud, gameservers, manager):
+            manager.shared_table = SharedServerTable(self.name, slots=8)
+            self.assertTrue(manager.shared_table.try_become_owner())
+            manager.publish_snapshot()
+            self.assertEqual(manager.get_next_publish_time(), manager.published_at + 5.0)
+            worker = SharedServerTable(self.name, slots=8)
+            self.assertEqual([s.available_capacity for s in worker.get_available_servers()], [0, 0])
+            manager.check_servers()
+            manager.publish_shared_table()
+            self.assertEqual([s.available_capacity for s in worker.get_available_servers()], [10, 10])
+
+    def test_ownership_and_heartbeats_are_handed_over(self):
+        published, done = self.processes.Queue(), self.processes.Event()
+        owner = self.processes.Process(target=own_shared_table, args=(self.name, self.servers, published, done))
+        owner.start()
+        try:
+            self.assertTrue(published.get(timeout=10))
+            self.assertTrue(published.get(timeout=10))
+            table = SharedServerTable(self.name, slots=8)
+            self.assertFalse(table.try_become_owner())
+            self.assertEqual(len(table.get_available_servers()), 2)
+            # Heartbeats of standby servers are recorded too
+            self.assertTrue(table.ingest_heartbeat("arn:task/2", 1, {'available_capacity': 7, 'ready_to_close': True}))
+            self.assertFalse(table.ingest_heartbeat("arn:task/2", 1, {'available_capacity': 9, 'ready_to_close': False}))
+            with self.assertRaises(KeyError):
+                table.ingest_heartbeat("arn:task/3", 1, {'available_capacity': 9, 'ready_to_close': False})
+        finally:
+            done.set()
+            owner.join()
+
+        # Once the owner exits, another process takes over the table and applies the pending heartbeats
+        self.assertTrue(table.try_become_owner())
+        table.publish(self.servers[:2], self.servers[2:])
+        self.assertTrue(self.servers[2].ready_to_close)
+        self.assertEqual(self.servers[2].reported_capacity, 7)
+
+class BenchmarkHarnessTests(SimpleTestCase):
+
+    def test_fake_cloud_places_tasks_like_ecs(self):
+        cloud = FakeCloud(tasks_per_instance=2)
+        task_arns = cloud.add_running_servers(2)
+        ec2_ids = sorted(cloud.instances)
+        run_task = lambda **kwargs: cloud.ecs.run_task(taskDefinition='LaunchGameserver', **kwargs)['tasks']
+        # distinctInstance only takes empty instances; binpack takes the fullest instance with room
+        self.assertEqual(run_task(placementConstraints=[{'type': 'distinctInstance'}]), [])
+        self.assertEqual(cloud.tasks[run_task(placementStrategy=[{'type': 'binpack', 'field': 'memory'}])[0]['taskArn']]['ec2_id'], ec2_ids[0])
+        placed = run_task(placementConstraints=[{'type': 'memberOf', 'expression': "ec2InstanceId == " + ec2_ids[1]}])
+        self.assertEqual(cloud.tasks[placed[0]['taskArn']]['ec2_id'], ec2_ids[1])
+        self.assertEqual(run_task(), [])
+        # Terminating an instance stops its tasks
+        cloud.ec2.terminate_instances(InstanceIds=[ec2_ids[0]])
+        self.assertEqual(len(cloud.running_tasks()), 2)
+        self.assertNotIn(task_arns[0], {t['taskArn'] for t in cloud.running_tasks()})
+        self.assertEqual(cloud.calls['run_task'], 4)
+
+    def test_fake_gameservers_serve_their_capacity_curves(self):
+        gameservers = FakeGameserverPool()
+        try:
+            port = gameservers.start_server(constant(7))
+            server = Server("arn:task/0", "i-0", "127.0.0.1:" + str(port))
+            self.assertEqual(server.fetch_state(), {'available_capacity': 7, 'ready_to_close': False})
+            gameservers.set_curve(ramp(0, 10, 0.0))
+            self.assertEqual(server.fetch_state()['available_capacity'], 10)
+            self.assertEqual([step(5, 1, 2.0)(t) for t in (1.0, 2.0)], [5, 1])
+            self.assertEqual(gameservers.gameservers[port].requests, 2)
+            gameservers.stop_server(port)
+            # The gameserver is closed on the loop of the pool
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), gameservers.loop).result()
+            self.assertIsNone(server.fetch_state(timeout=1.0))
+        finally:
+            gameservers.close()
+
+    def test_benchmark_command(self):
+        output = io.StringIO()
+        with redirect_stderr(io.StringIO()):
+            call_command('benchmark', sizes=[2], api_latency=0.0, launch_delay=0.05, duration=0.05, stdout=output)
+        results = json.loads(output.getvalue())['results']['2']
+        self.assertEqual(results['bootstrap']['servers_discovered'], 2)
+        self.assertEqual(results['warm_restart']['servers_restored'], 2)
+        self.assertEqual(results['tick_duration']['total_available_capacity'], 20)
+        for scenario in ('scale_out_reaction', 'scale_out_reaction_warm_pool', 'scale_out_reaction_binpack'):
+            self.assertTrue(results[scenario]['recovered'], scenario)
+        self.assertEqual(results['admission_burst']['admitted'], 50)
+        self.assertEqual(results['admission_burst_disabled']['oversubscribed'], 50)
+        self.assertEqual(set(results['selection_latency']), set(CapacityIndex.POLICIES) | {'affinity'})
+
+class MetricsTests(SimpleTestCase):
+
+    def test_histogram_exposition(self):
+        registry = Registry()
+        histogram = Histogram('test_latency_seconds', "Test latency", ['operation'], buckets=(0.1, 1.0), registry=registry)
+        histogram.labels('describe_tasks').observe(0.05)
+        histogram.labels('describe_tasks').observe(0.5)
+        histogram.labels('describe_tasks').observe(5)
+
+        lines = registry.expose().splitlines()
+        self.assertIn('# TYPE test_latency_seconds histogram', lines)
+        # buckets are cumulative
+        self.assertIn('test_latency_seconds_bucket{operation="describe_tasks",le="0.1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{operation="describe_tasks",le="1.0"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{operation="describe_tasks",le="+Inf"} 3', lines)
+        self.assertIn('test_latency_seconds_count{operation="describe_tasks"} 3', lines)
+
+    def test_counter_exposition(self):
+        registry = Registry()
+        counter = Counter('test_scale_events', "Test scale events", ['direction'], registry=registry)
+        counter.labels('up').inc()
+        counter.labels('up').inc(2)
+
+        lines = registry.expose().splitlines()
+        self.assertIn('# HELP test_scale_events_total Test scale events', lines)
+        self.assertIn('# TYPE test_scale_events_total counter', lines)
+        self.assertIn('test_scale_events_total{direction="up"} 3', lines)
+        self.assertNotIn('test_scale_events_total{direction="down"} 0', lines)
+
+    def test_labels_are_checked_and_escaped(self):
+        registry = Registry()
+        gauge = Gauge('test_servers', "Test servers", ['pool'], registry=registry)
+        with self.assertRaises(ValueError):
+            gauge.labels('default', 'extra')
+        gauge.labels('a "quoted"\\pool\n').set(2)
+        self.assertIs(gauge.labels('default'), gauge.labels('default'))
+        lines = registry.expose().splitlines()
+        self.assertIn('# TYPE test_servers gauge', lines)
+        self.assertIn('test_servers{pool="a \\"quoted\\"\\\\pool\\n"} 2', lines)
+        self.assertIn('test_servers{pool="default"} 0', lines)
+
+    def test_bucket_bounds_are_inclusive(self):
+        registry = Registry()
+        histogram = Histogram('test_rtt_seconds', "Test rtt", buckets=(1.0, 0.1), registry=registry)
+        histogram.observe(0.1)
+        with histogram.time():
+            pass
+        lines = registry.expose().splitlines()
+        self.assertIn('test_rtt_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_rtt_seconds_count 2', lines)
+
+    def test_update_and_views_are_instrumented(self):
+        def count(histogram) -> int:
+            return sum(histogram.counts)
+
+        with fleet(2) as (cloud, gameservers, manager):
+            ticks, sweeps, selections = count(metrics.TICK_DURATION), count(metrics.HEALTH_SWEEP_DURATION), count(metrics.SELECTION_LATENCY)
+            manager.update()
+            self.assertEqual(count(metrics.TICK_DURATION), ticks + 1)
+            self.assertEqual(count(metrics.HEALTH_SWEEP_DURATION), sweeps + 1)
+            self.assertEqual(metrics.AVAILABLE_SERVERS.labels(manager.pool.name).value, 2)
+            self.assertEqual(metrics.TOTAL_AVAILABLE_CAPACITY.labels(manager.pool.name).value, manager.total_available_capacity)
+
+            response = assignment_response(RequestFactory().get('/available-gameserver/'), manager)
+            self.assertIn(json.loads(response.content)['available'], [s.address for s in manager.available_servers])
+            self.assertEqual(count(metrics.SELECTION_LATENCY), selections + 1)
+
+            # No server to select: the client is sent to the backup gameserver, and no selection is timed
+            fallbacks = metrics.BACKUP_GAMESERVER_FALLBACKS.value
+            for server in list(manager.available_servers):
+                manager.remove_available_server(server)
+            assignment_response(RequestFactory().get('/available-gameserver/'), manager)
+            self.assertEqual(metrics.BACKUP_GAMESERVER_FALLBACKS.value, fallbacks + 1)
+            self.assertEqual(count(metrics.SELECTION_LATENCY), selections + 1)
+
+            response = metrics_view(RequestFactory().get('/metrics/'))
+            self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+            self.assertIn('manager_available_servers{pool="' + manager.pool.name + '"} 2', response.content.decode().splitlines())
+
+class CapacityIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        # Servers are plain names whose capacity is read from a dict
+        self.capacities = {'a': 5, 'b': 1, 'c': 3}
+        self.index = CapacityIndex(capacity_of=self.capacities.__getitem__, rng=random.Random(0))
+        for server in self.capacities:
+            self.index.add(server)
+
+    def set_capacity(self, server: str, capacity: int) -> None:
+        self.capacities[server] = capacity
+        self.index.update(server)
+
+    def test_selection_follows_adds_updates_and_removes(self):
+        self.assertEqual(self.index.select('max_available'), 'a')
+        self.assertEqual(self.index.select('pack'), 'b')
+        self.assertEqual({self.index.select('weighted_random') for _ in range(100)}, {'a', 'b', 'c'})
+
+        self.set_capacity('b', 8)
+        self.assertEqual(self.index.select('max_available'), 'b')
+        self.assertEqual(self.index.select('pack'), 'c')
+
+        self.index.remove('b')
+        self.assertNotIn('b', self.index)
+        self.assertEqual(self.index.select('max_available'), 'a')
+        self.assertEqual({self.index.select('weighted_random') for _ in range(100)}, {'a', 'c'})
+        self.assertEqual({self.index.select('power_of_two') for _ in range(100)} - {'a', 'c'}, set())
+
+        # Servers without capacity left carry no weight and aren't packed
+        self.set_capacity('c', 0)
+        self.assertEqual({self.index.select('weighted_random') for _ in range(100)}, {'a'})
+        self.assertEqual(self.index.select('pack'), 'a')
+
+        self.index.remove('a')
+        for policy in CapacityIndex.POLICIES:
+            self.assertEqual(self.index.select(policy), 'c')
+        self.index.add('b')
+        self.assertEqual(self.index.select('power_of_two'), 'b')
+        self.index.remove('b')
+        self.index.remove('c')
+        for policy in CapacityIndex.POLICIES:
+            self.assertRaises(IndexError, self.index.select, policy)
+        self.assertRaises(ValueError, self.index.select, 'round_robin')
+
+    def test_stale_heap_entries_are_skipped(self):
+        self.index.select('pack') # builds the min-heap
+        # The entries pushed for the old capacities stay in the heaps until they surface
+        self.set_capacity('a', 2)
+        self.assertEqual(self.index.select('max_available'), 'c')
+        self.set_capacity('b', 4)
+        self.assertEqual(self.index.select('pack'), 'a')
+        self.index.remove('b')
+        self.assertEqual(self.index.select('max_available'), 'c')
+        # A capacity which changed without an update is re-keyed when its entry surfaces
+        self.capacities['c'] = 0
+        self.assertEqual(self.index.select('max_available'), 'a')
+        self.assertEqual(self.index.select('pack'), 'a')
+        # Stale entries are compacted away
+        for capacity in range(1000):
+            self.set_capacity('a', capacity)
+        self.assertLessEqual(len(self.index._heap), 2 * len(self.index) + 64)
+        self.assertEqual(self.index.select('max_available'), 'a')
+
+class HeartbeatTests(SimpleTestCase):
+
+    def setUp(self):
+        # ec2 id and address are given, so no AWS calls are made
+        self.server = Server("arn:task/0", "i-0", "10.0.0.0:8000")
+
+    def test_out_of_order_heartbeats_are_ignored(self):
+        self.assertTrue(self.server.apply_heartbeat(2, {'available_capacity': 5, 'ready_to_close': False}, received_at=10.0))
+        self.assertFalse(self.server.apply_heartbeat(1, {'available_capacity': 9, 'ready_to_close': True}, received_at=11.0))
+        self.assertFalse(self.server.apply_heartbeat(2, {'available_capacity': 9, 'ready_to_close': True}, received_at=11.0))
+        self.assertEqual(self.server.reported_capacity, 5)
+        self.assertFalse(self.server.ready_to_close)
+        self.assertEqual(self.server.last_heartbeat, 10.0)
+
+    def test_malformed_health_states_are_rejected(self):
+        self.server.apply_state({'available_capacity': 5, 'ready_to_close': False})
+        with redirect_stdout(io.StringIO()):
+            for state_json in ({'available_capacity': None, 'ready_to_close': False}, {'available_capacity': "3", 'ready_to_close': False},
+                               {'available_capacity': True, 'ready_to_close': False}, {'available_capacity': 3, 'ready_to_close': 0}, [], {}):
+                self.assertFalse(self.server.apply_state(state_json), state_json)
+        self.assertEqual(self.server.reported_capacity, 5)
+        self.assertFalse(self.server.ready_to_close)
+
+    def test_malformed_health_states_dont_stop_the_manager(self):
+        with fleet(2) as (cloud, gameservers, manager), redirect_stdout(io.StringIO()):
+            manager.update()
+            port = next(iter(gameservers.gameservers))
+            gameservers.set_curve(lambda t: None, [port])
+            manager.update()
+            manager.check_servers()
+            self.assertEqual(manager.total_available_capacity, 10)
+
+    @override_settings(HEARTBEAT_TIMEOUT=15.0)
+    def test_missed_heartbeats(self):
+        self.assertFalse(self.server.pushes_heartbeats())
+        self.server.apply_heartbeat(1, {'available_capacity': 5, 'ready_to_close': False}, received_at=100.0)
+        self.assertTrue(self.server.pushes_heartbeats())
+        self.assertTrue(self.server.has_fresh_heartbeat(now=110.0))
+        self.assertFalse(self.server.has_fresh_heartbeat(now=116.0))
+
+    def post_heartbeat(self, manager, heartbeat: dict, token: str = None):
+        headers: dict = {'HTTP_AUTHORIZATION': "Bearer " + token} if token is not None else {}
+        request = RequestFactory().post('/heartbeat/', json.dumps(heartbeat), content_type='application/json', **headers)
+        return heartbeat_response(request, manager).status_code
+
+    def test_heartbeat_api(self):
+        with fleet(1) as (cloud, gameservers, manager):
+            server = manager.available_servers[0]
+            heartbeat = {'task_arn': server.task_arn, 'seq': 1, 'available_capacity': 4, 'ready_to_close': False}
+            # Heartbeats are refused until a token is set
+            with override_settings(HEARTBEAT_TOKEN=''):
+                self.assertEqual(self.post_heartbeat(manager, heartbeat, ''), 403)
+            with override_settings(HEARTBEAT_TOKEN='secret'):
+                self.assertEqual(self.post_heartbeat(manager, heartbeat), 401)
+                self.assertEqual(self.post_heartbeat(manager, heartbeat, 'guess'), 401)
+                self.assertEqual(self.post_heartbeat(manager, dict(heartbeat, seq=True), 'secret'), 400)
+                self.assertEqual(self.post_heartbeat(manager, dict(heartbeat, available_capacity=False), 'secret'), 400)
+                self.assertEqual(server.heartbeat_seq, None)
+                self.assertEqual(self.post_heartbeat(manager, heartbeat, 'secret'), 204)
+                self.assertEqual(self.post_heartbeat(manager, heartbeat, 'secret'), 409)
+                self.assertEqual(self.post_heartbeat(manager, dict(heartbeat, task_arn="arn:task/unknown"), 'secret'), 404)
+            self.assertEqual(server.reported_capacity, 4)
+            self.assertEqual(manager.total_available_capacity, 4)
+
+    def test_pushing_servers_are_not_polled(self):
+        with fleet(2, HEARTBEAT_TIMEOUT=60.0) as (cloud, gameservers, manager):
+            manager.update()
+            pushing, polled = sorted(manager.available_servers, key=lambda s: s.task_arn)
+            self.assertTrue(manager.ingest_heartbeat(pushing.task_arn, 1, {'available_capacity': 3, 'ready_to_close': False}))
+            self.assertEqual(manager.get_servers_to_check(now=monotonic() + 1.0), [polled])
+            # Once its heartbeats are missed, the server is polled again
+            self.assertIn(pushing, manager.get_servers_to_check(now=monotonic() + 61.0))
+            self.assertIsNone(pushing.last_heartbeat)
+
+    def test_standby_server_closing_is_reaped(self):
+        with fleet(2, HEARTBEAT_TIMEOUT=60.0) as (cloud, gameservers, manager):
+            manager.update()
+            manager.downscale(1)
+            [standby] = manager.standby_servers
+            self.assertTrue(manager.ingest_heartbeat(standby.task_arn, 1, {'available_capacity': 0, 'ready_to_close': True}))
+            # Standby capacity isn't offered to clients
+            self.assertEqual(manager.total_available_capacity, manager.available_servers[0].available_capacity)
+            # The heartbeat is fresh, so the fake gameserver (which never closes) isn't polled over it
+            manager.update()
+            self.assertEqual(manager.standby_servers, [])
+            self.assertNotIn(standby.task_arn, manager.servers_by_task_arn)
+            self.assertNotIn(standby.task_arn, [t['taskArn'] for t in cloud.running_tasks()])
+
+class HealthCheckerTests(SimpleTestCase):
+    """The hung gameservers accept connections (the kernel completes the handshake) but never respond"""
+
+    @contextmanager
+    def gameservers(self, fast: int, hung: int):
+        pool = FakeGameserverPool()
+        listeners = [socket.create_server(('127.0.0.1', 0)) for _ in range(hung)]
+        try:
+            hung_servers = [
+                Server("arn:task/hung-" + str(i), "i-hung", "127.0.0.1:" + str(listener.getsockname()[1]))
+                for i, listener in enumerate(listeners)
+            ]
+            fast_servers = [
+                Server("arn:task/" + str(i), "i-" + str(i), "127.0.0.1:" + str(pool.start_server(constant(i))))
+                for i in range(fast)
+            ]
+            with redirect_stdout(io.StringIO()):
+                yield pool, hung_servers, fast_servers
+        finally:
+            for listener in listeners:
+                listener.close()
+            pool.close()
+
+    def assert_sweep(self, hung_servers: list, fast_servers: list, results: dict, elapsed: float):
+        self.assertEqual(results, {**{s: None for s in hung_servers}, **{s: {'available_capacity': i, 'ready_to_close': False} for i, s in enumerate(fast_servers)}})
+        # The hung servers are given up on after the request timeout (0.3s) all at once, rather than one after another (1.5s)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.9)
+
+    def assert_connections_reused(self, pool: FakeGameserverPool):
+        for gameserver in pool.gameservers.values():
+            self.assertEqual(gameserver.requests, 2)
+            self.assertEqual(len(gameserver.connections), 1)
+
+    def test_sweep_is_concurrent_and_reuses_connections(self):
+        with self.gameservers(fast=20, hung=5) as (pool, hung_servers, fast_servers):
+            checker = HealthChecker(max_workers=64, request_timeout=0.3, tick_deadline=2.0)
+            try:
+                start = monotonic()
+                results = checker.check(hung_servers + fast_servers)
+                self.assert_sweep(hung_servers, fast_servers, results, monotonic() - start)
+                # A sweep over responsive servers costs about one round trip, not one per server
+                start = monotonic()
+                results = checker.check(fast_servers)
+                self.assertLess(monotonic() - start, 0.3)
+                self.assertEqual(len(results), 20)
+                self.assert_connections_reused(pool)
+            finally:
+                checker.executor.shutdown()
+
+    def test_async_sweep_is_concurrent_and_reuses_connections(self):
+        async def sweep(checker, hung_servers, fast_servers):
+            start = monotonic()
+            results = await checker.check(hung_servers + fast_servers)
+            self.assert_sweep(hung_servers, fast_servers, results, monotonic() - start)
+            start = monotonic()
+            results = await checker.check(fast_servers)
+            self.assertLess(monotonic() - start, 0.3)
+            self.assertEqual(len(results), 20)
+            self.assertEqual(set(checker._connections), {s.address for s in fast_servers})
+            self.assert_connections_reused(pool)
+            checker.close()
+
+        with self.gameservers(fast=20, hung=5) as (pool, hung_servers, fast_servers):
+            asyncio.run(sweep(AsyncHealthChecker(request_timeout=0.3, tick_deadline=2.0), hung_servers, fast_servers))
+
+    def test_servers_missing_the_deadline_are_cancelled(self):
+        with self.gameservers(fast=3, hung=1) as (pool, hung_servers, fast_servers):
+            # A single worker is stuck on the hung server until the deadline, so the requests queued behind it are dropped
+            checker = HealthChecker(max_workers=1, request_timeout=0.5, tick_deadline=0.2)
+            try:
+                start = monotonic()
+                results = checker.check(hung_servers + fast_servers)
+                self.assertLess(monotonic() - start, 0.4)
+                self.assertEqual(list(results.values()), [None] * 4)
+                # The worker is freed by the request timeout, and doesn't go on to the cancelled requests
+                sleep(0.6)
+                self.assertEqual([g.requests for g in pool.gameservers.values()], [0] * 3)
+            finally:
+                checker.executor.shutdown()
+
+    def test_async_servers_missing_the_deadline_are_cancelled(self):
+        async def sweep(checker, servers):
+            start = monotonic()
+            results = await checker.check(servers)
+            self.assertLess(monotonic() - start, 0.4)
+            self.assertEqual(list(results.values()), [None] * 4)
+            await asyncio.sleep(0.6)
+
+        with self.gameservers(fast=3, hung=1) as (pool, hung_servers, fast_servers):
+            asyncio.run(sweep(AsyncHealthChecker(max_concurrency=1, request_timeout=0.5, tick_deadline=0.2), hung_servers + fast_servers))
+            self.assertEqual([g.requests for g in pool.gameservers.values()], [0] * 3)
+
+class HealthSchedulerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = HealthScheduler(min_interval=5.0, max_interval=60.0, dead_after=3, server_capacity=100)
+        self.idle = Server("arn:task/0", "i-0", "10.0.0.0:8000")
+        self.idle.reported_capacity = 100
+        self.full = Server("arn:task/1", "i-1", "10.0.0.1:8000")
+        self.full.reported_capacity = 0
+        self.scheduler.sync([self.idle, self.full], now=0.0)
+
+    def test_hot_servers_are_checked_more_often(self):
+        self.assertEqual(self.scheduler.pop_due(now=0.0), [self.idle, self.full])
+        self.scheduler.record(self.idle, True, now=0.0)
+        self.scheduler.record(self.full, True, now=0.0)
+        self.assertEqual(self.scheduler.next_due(), 5.0)
+        self.assertEqual(self.scheduler.pop_due(now=30.0), [self.full])
+        self.scheduler.record(self.full, True, now=30.0)
+        self.assertEqual(self.scheduler.pop_due(now=60.0), [self.full, self.idle])
+        # A standby server is hot once drained
+        self.assertEqual(self.scheduler.interval(self.idle, standby=True), 5.0)
+        self.idle.reserve()
+        self.assertEqual(self.scheduler.interval(self.idle), 5.0)
+
+    def test_failures_back_off_until_dead(self):
+        self.scheduler.pop_due(now=0.0)
+        self.assertEqual(self.scheduler.record(self.idle, False, now=0.0), 1)
+        self.assertEqual(self.scheduler.next_due(), 5.0)
+        self.scheduler.pop_due(now=5.0)
+        self.assertEqual(self.scheduler.record(self.idle, False, now=5.0), 2)
+        self.assertFalse(self.scheduler.is_dead(self.idle))
+        self.assertEqual(self.scheduler.pop_due(now=14.9), [])
+        self.assertEqual(self.scheduler.pop_due(now=15.0), [self.idle])
+        self.assertEqual(self.scheduler.record(self.idle, False, now=15.0), 3)
+        self.assertTrue(self.scheduler.is_dead(self.idle))
+        self.scheduler.record(self.idle, True, now=16.0)
+        self.assertEqual(self.scheduler.failures(self.idle), 0)
+
+    def test_backoff_is_capped_and_checks_are_never_postponed(self):
+        self.assertEqual(self.scheduler.interval(self.idle, failures=10), 60.0)
+        self.scheduler.pop_due(now=0.0)
+        self.scheduler.record(self.full, True, now=0.0)
+        # Expediting only brings a check forward
+        self.scheduler.expedite(self.full, now=3.0)
+        self.assertEqual(self.scheduler.next_due(), 5.0)
+        # A server which left the fleet is forgotten, and a recorded result for it is ignored
+        self.scheduler.sync([self.idle], now=4.0)
+        self.assertEqual(self.scheduler.record(self.full, False, now=4.0), 0)
+        self.assertNotIn(self.full, self.scheduler)
+        self.assertEqual(self.scheduler.pop_due(now=100.0), [])
+
+    def test_manager_polls_due_servers_only(self):
+        with fleet(3, HEALTH_CHECK_MIN_INTERVAL=5.0, HEALTH_CHECK_MAX_INTERVAL=60.0) as (cloud, gameservers, manager):
+            manager.update()
+            now = monotonic()
+            self.assertEqual(manager.get_servers_to_check(now), [])
+            # Idle servers wait for max_interval, a server just sent a client is checked within min_interval
+            assigned = manager.get_available_server()
+            self.assertEqual(manager.get_servers_to_check(now + 5.1), [assigned])
+            self.assertEqual(len(manager.get_servers_to_check(now + 60.1)), 2)
+
+class AffinityTests(SimpleTestCase):
+
+    def test_adding_a_node_moves_about_1_over_n_keys(self):
+        ring = HashRing(vnodes=64)
+        for i in range(10):
+            ring.add(i, b"node-" + str(i).encode())
+        keys = [b"game-" + str(k).encode() for k in range(2000)]
+        before = [ring.lookup(k) for k in keys]
+        ring.add(10, b"node-10")
+        after = [ring.lookup(k) for k in keys]
+        moved = [b for b, a in zip(before, after) if a != b]
+        # Keys only move to the new node, about 1/11 of them
+        self.assertEqual(set(after[i] for i, (b, a) in enumerate(zip(before, after)) if a != b), {10})
+        self.assertLess(abs(len(moved) / len(keys) - 1 / 11), 0.04)
+        ring.remove(b"node-10")
+        self.assertEqual([ring.lookup(k) for k in keys], before)
+
+    def test_games_stick_to_their_server_within_bounded_loads(self):
+        affinity = GameAffinity(load_factor=1.0, ttl=60.0, vnodes=64)
+        servers = [Server("arn:task/" + str(i), "i-" + str(i), "10.0.0." + str(i) + ":8000") for i in range(4)]
+        for s in servers:
+            s.reported_capacity = 100
+            affinity.add_server(s, s.task_arn.encode())
+
+        for g in range(40):
+            server, hosting = affinity.lookup("game-" + str(g), now=0.0)
+            self.assertFalse(hosting)
+            affinity.assign("game-" + str(g), server, now=0.0)
+        self.assertEqual(sorted(affinity.loads.values()), [10, 10, 10, 10])
+
+        host = affinity.games["game-0"][0]
+        self.assertEqual(affinity.lookup("game-0", now=1.0), (host, True))
+        # A game whose server is gone is routed anew
+        affinity.remove_server(host, host.task_arn.encode())
+        server, hosting = affinity.lookup("game-0", now=1.0)
+        self.assertFalse(hosting)
+        self.assertIsNot(server, host)
+        # Games expire ttl seconds after their last request
+        affinity.lookup("game-1", now=61.0)
+        self.assertEqual(len(affinity.games), 0)
+
+    def test_games_stick_through_the_manager(self):
+        with fleet(3) as (cloud, gameservers, manager):
+            manager.update()
+
+            def assign(game_id: str):
+                return assignment_response(RequestFactory().get('/available-gameserver/', {'game_id': game_id}), manager)
+
+            host_address = json.loads(assign("game-0").content)['available']
+            self.assertEqual([json.loads(assign("game-0").content)['available'] for _ in range(3)], [host_address] * 3)
+            self.assertEqual(assign("g" * (views.GAME_ID_MAX_LENGTH + 1)).status_code, 400)
+
+            # A full host keeps its game, even without oversubscribing, while new games go elsewhere
+            host = next(s for s in manager.available_servers if s.address == host_address)
+            host.reported_capacity = 0
+            manager.capacity_index.update(host)
+            self.assertIs(manager.reserve_server("game-0"), host)
+            self.assertIsNot(manager.reserve_server("game-1"), host)
+            # A game whose host went to standby is routed anew
+            manager.remove_available_server(host)
+            manager.standby_servers.append(host)
+            self.assertIn(manager.get_available_server("game-0"), manager.available_servers)
+
+class BatchAssignmentTests(SimpleTestCase):
+
+    def setUp(self):
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        cloud, gameservers, self.manager = stack.enter_context(fleet(2))
+        # The servers report capacities 10 and 6
+        self.large, self.small = sorted(self.manager.available_servers, key=lambda s: s.address)
+        gameservers.set_curve(constant(6), [int(self.small.address.split(':')[1])])
+        self.manager.update()
+
+    def test_groups_are_placed_whole_without_oversubscribing(self):
+        # Largest first: 11 fits nowhere, 7 -> large (3 left), 4 -> small (2 left), 3 -> large, 2 -> small, and no capacity is left for 1
+        servers = self.manager.reserve_groups([2, 7, 4, 11, 3, 1])
+        self.assertEqual(servers, [self.small, self.large, self.small, None, self.large, None])
+        self.assertEqual([self.large.available_capacity, self.small.available_capacity], [0, 0])
+        self.assertEqual(self.manager.assignment_count, 16)
+        # The health api doesn't reflect the clients yet, while the reservations still hold the capacity
+        self.manager.check_servers()
+        self.assertEqual(self.manager.reserve_groups([1]), [None])
+
+    def test_concurrent_batches_never_oversubscribe(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            batches = list(executor.map(self.manager.reserve_groups, [[1] * 6] * 4))
+        assigned = [s for batch in batches for s in batch if s is not None]
+        self.assertEqual(len(assigned), 16)
+        self.assertEqual(assigned.count(self.large), 10)
+        self.assertEqual(self.large.available_capacity + self.small.available_capacity, 0)
+
+    @override_settings(BACKUP_GAMESERVER="127.0.0.1:8888")
+    def test_batch_api(self):
+        factory = RequestFactory()
+        response = batch_assignment_response(
+            factory.post('/available-gameserver-batch/', json.dumps({'groups': [2, 20]}), content_type='application/json'), self.manager
+        )
+        self.assertEqual(json.loads(response.content), {'assignments': [
+            {'available': self.large.address, 'size': 2}, {'available': "127.0.0.1:8888", 'size': 20}
+        ]})
+        self.assertIn('no-store', response['Cache-Control'])
+        response = batch_assignment_response(
+            factory.post('/available-gameserver-batch/', json.dumps({'count': 2}), content_type='application/json'), self.manager
+        )
+        self.assertEqual([a['size'] for a in json.loads(response.content)['assignments']], [1, 1])
+        for body in ({'count': 0}, {'count': True}, {'groups': [1, -1]}, {'groups': [1.5]}, {'groups': []}, {'groups': 3}, {}):
+            request = factory.post('/available-gameserver-batch/', json.dumps(body), content_type='application/json')
+            self.assertEqual(batch_assignment_response(request, self.manager).status_code, 400)
+        self.assertEqual(batch_assignment_response(factory.get('/available-gameserver-batch/'), self.manager).status_code, 405)
+
+class AdmissionTests(SimpleTestCase):
+
+    def test_waiting_clients_are_admitted_in_order(self):
+        free: list = [] # servers with capacity left
+        queue = AdmissionQueue(RLock(), lambda game_id: free.pop(0) if free else None, lambda depth: depth + 1, max_size=3, poll_interval=0.01)
+
+        async def scenario():
+            waiting = [asyncio.ensure_future(queue.acquire_async(str(i), wait)) for i, wait in enumerate((5.0, 5.0, 0.05))]
+            await asyncio.sleep(0)
+            self.assertEqual(len(queue), 3)
+            with self.assertRaises(Saturated): # the queue is full
+                await queue.acquire_async("3", 5.0)
+            free.extend(["s0", "s1"])
+            self.assertEqual(queue.release(), 2)
+            self.assertEqual([await waiting[0], await waiting[1]], ["s0", "s1"])
+            with self.assertRaises(Saturated) as timed_out:
+                await waiting[2]
+            self.assertEqual((timed_out.exception.retry_after, len(queue)), (1, 0))
+
+        asyncio.run(scenario())
+        free.append("s2")
+        self.assertEqual(queue.acquire("4", 0.0), "s2")
+        with self.assertRaises(Saturated):
+            queue.acquire("5", 0.0)
+
+    @override_settings(BACKUP_GAMESERVER="127.0.0.1:8888", ADMISSION_MAX_WAIT=30.0)
+    def test_admission_api(self):
+        with override_settings(SERVER_CAPACITY=1000):
+            self.assertEqual(get_retry_after(10.0, 60.0, 2500), 130) # the third wave of clients is due two launches after the next one
+            self.assertEqual(get_retry_after(0.0, 60.0, 0), 1)
+
+        def get(manager, params: dict = {}):
+            return admission_response(RequestFactory().get('/available-gameserver/', params), manager)
+
+        with fleet(1, capacity_curve=constant(1), launch_delay=0.05) as (cloud, gameservers, manager):
+            manager.update()
+            [server] = manager.available_servers
+            self.assertEqual(json.loads(get(manager, {'wait': '0'}).content), {'available': server.address})
+            # The fleet is full and the client doesn't wait
+            response = get(manager, {'wait': '0'})
+            self.assertEqual(response.status_code, 429)
+            self.assertGreaterEqual(int(response['Retry-After']), 1)
+            for wait in ('soon', 'nan'):
+                self.assertEqual(get(manager, {'wait': wait}).status_code, 400)
+
+            # A waiting client is admitted once a launched server comes online (and reports its capacity)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                waiting = executor.submit(get, manager, {'wait': '600'})
+                while len(manager.admission) == 0:
+                    sleep(0.01)
+                self.assertTrue(manager.add_server())
+                while manager.provisioner.in_flight() > 0:
+                    sleep(0.01)
+                manager.update()
+                admitted = json.loads(waiting.result(timeout=5.0).content)['available']
+            self.assertNotEqual(admitted, server.address)
+            self.assertIn(admitted, [s.address for s in manager.available_servers])
+
+        # Nothing to wait for: the backup gameserver is assigned right away
+        with fleet(0) as (cloud, gameservers, manager):
+            self.assertEqual(json.loads(get(manager).content), {'available': "127.0.0.1:8888"})
+
+class StateJournalTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = StateJournal(os.path.join(self.directory.name, "state.json"), max_age=60.0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        available = Server("arn:task/0", "i-0", "10.0.0.0:8000")
+        available.apply_heartbeat(7, {'available_capacity': 5, 'ready_to_close': False}, received_at=10.0)
+        standby = Server("arn:task/1", "i-1", "10.0.0.1:8000")
+        standby.ready_to_close = True
+        self.assertTrue(self.journal.save([available], [standby]))
+
+        records = self.journal.load()
+        self.assertEqual([r['standby'] for r in records], [False, True])
+        restored = StateJournal.from_record(records[0], Server)
+        self.assertEqual((restored.task_arn, restored.ec2_id, restored.address), ("arn:task/0", "i-0", "10.0.0.0:8000"))
+        self.assertEqual(restored.reported_capacity, 5)
+        self.assertEqual(restored.heartbeat_seq, 7)
+        self.assertTrue(StateJournal.from_record(records[1], Server).ready_to_close)
+
+    def test_missing_or_old_journal_is_ignored(self):
+        self.assertIsNone(self.journal.load())
+        self.journal.save([], [])
+        self.assertEqual(self.journal.load(), [])
+        self.journal.max_age = -1
+        self.assertIsNone(self.journal.load())
+
+    def test_malformed_journal_is_ignored(self):
+        with redirect_stdout(io.StringIO()):
+            for text in ("{", "[]", "1", '{"version": 1}', '{"version": 1, "saved_at": "0", "servers": []}', '{"version": 1, "saved_at": %f, "servers": 2}' % time()):
+                self.assertIsNone(StateJournal.loads(text, max_age=60.0), text)
+            self.assertIsNone(StateJournal.loads('{"version": 2, "saved_at": %f, "servers": []}' % time(), max_age=60.0))
+
+    def test_restart_serves_the_journal_and_reconciles_it(self):
+        with fleet(2, STATE_JOURNAL=True, STATE_JOURNAL_PATH=self.journal.path) as (cloud, gameservers, manager):
+            manager.update()
+            gone, kept = sorted(manager.available_servers, key=lambda s: s.task_arn)
+            # While the manager app is down, a task stops and another one starts
+            cloud.stop_task(gone.task_arn)
+            [started] = cloud.add_running_servers(1)
+            cloud.api_latency = 0.05
+
+            ServerManagerThread.reset_instance()
+            restarted = ServerManagerThread.get_instance()
+            # Served from the journal before AWS is queried
+            self.assertEqual(sorted(s.task_arn for s in restarted.available_servers), [gone.task_arn, kept.task_arn])
+            restarted.reconciliation.join()
+            self.assertEqual(sorted(s.task_arn for s in restarted.available_servers), sorted([kept.task_arn, started]))
+            self.assertEqual(set(restarted.get_snapshot().addresses), {s.address for s in restarted.available_servers})
+
+            # An unreadable journal is ignored and the servers are discovered
+            for text in ("{", "[]"):
+                with open(self.journal.path, 'w') as f:
+                    f.write(text)
+                ServerManagerThread.reset_instance()
+                rediscovered = ServerManagerThread.get_instance()
+                self.assertIsNone(rediscovered.reconciliation)
+                self.assertEqual(sorted(s.task_arn for s in rediscovered.available_servers), sorted([kept.task_arn, started]))
+
+    def test_journal_is_opt_in_and_short_lived(self):
+        # Restarts rediscover the fleet unless the journal is turned on, and only a journal of the last few updates is trusted
+        self.assertFalse(settings.STATE_JOURNAL)
+        self.assertLessEqual(StateJournal(self.journal.path).max_age, 3 * settings.THREAD_SLEEP_TIME)
+
+class DemandForecastTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "demand_history.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_history_round_trip(self):
+        history = DemandHistory(self.path, bucket_width=3600, days=2)
+        history.add(5, 120.0, 50.0, 20.0)
+        history.add(53, 60.0, 40.0, 30.0) # overwrites the sample of bucket 5
+        history.add(6, 90.0, 40.0, 25.0)
+        self.assertTrue(history.save())
+
+        restored = DemandHistory(self.path, bucket_width=3600, days=2)
+        self.assertTrue(restored.load())
+        self.assertEqual(restored.samples(), [(6, 90.0, 40.0, 25.0), (53, 60.0, 40.0, 30.0)])
+        self.assertFalse(DemandHistory(self.path, bucket_width=1800, days=2).load())
+
+    def test_growth_ahead_of_the_daily_peak(self):
+        # One client per second, five per second from 19:00 to 23:00, each holding capacity for 10 minutes
+        forecast = DemandForecast(DemandHistory(self.path, bucket_width=3600, days=2))
+        rate = lambda hour: 5 if 19 <= hour % 24 < 23 else 1
+        def replay(start, end):
+            for hour in range(start, end):
+                forecast.record(3600 * rate(hour), 10000, 10000 - 600 * rate(hour), now=3600.0 * hour)
+        replay(0, 3 * 24 + 10)
+        self.assertLess(abs(forecast.predicted_growth(3600, 600, now=3600.0 * (3 * 24 + 10))), 100)
+        replay(3 * 24 + 10, 3 * 24 + 18)
+        growth = forecast.predicted_growth(3600, 600, now=3600.0 * (3 * 24 + 18))
+        self.assertGreater(growth, 1000)
+        # The margins remain the floor and ceiling of the target capacity
+        policy = ScalingPolicy(upscale_margin=20, downscale_margin=100, server_capacity=10)
+        self.assertEqual(policy.get_target_capacity(-50), 20)
+        self.assertEqual(policy.get_target_capacity(growth), 90)
+        self.assertEqual(policy.decide(20, 0, 2, now=0.0, forecast_growth=30), 3)
+
+    def test_model_is_rebuilt_from_the_history(self):
+        forecast = DemandForecast(DemandHistory(self.path, bucket_width=3600, days=2))
+        for hour in list(range(0, 20)) + list(range(26, 30)): # the manager app was down for 6 hours
+            forecast.record(3600 + 100 * hour, 1000, 900, now=3600.0 * hour)
+        forecast.record(0, 1000, 900, now=3600.0 * 30) # closes the last bucket
+        restarted = DemandForecast(DemandHistory(self.path, bucket_width=3600, days=2))
+        self.assertEqual((restarted.level, restarted.trend, restarted.session_duration), (forecast.level, forecast.trend, forecast.session_duration))
+        self.assertEqual(restarted.predicted_growth(3600, 100, now=3600.0 * 30), forecast.predicted_growth(3600, 100, now=3600.0 * 30))
+        self.assertGreater(forecast.trend, 0)
+
+        # A truncated history file is ignored, and nothing is forecast without history
+        with open(self.path, 'r+b') as f:
+            f.truncate(100)
+        self.assertFalse(DemandHistory(self.path, bucket_width=3600, days=2).load())
+        self.assertEqual(DemandForecast(DemandHistory(self.path, bucket_width=3600, days=2)).predicted_growth(3600, 100), 0)
+
+    def test_manager_launches_ahead_of_the_forecast(self):
+        # Clients kept arriving at 0.01 per second over the last hours, each holding capacity for 1000 seconds
+        history = DemandHistory(self.path, bucket_width=3600)
+        bucket = int(time() // 3600)
+        for b in range(bucket - 5, bucket):
+            history.add(b, 36.0, 100.0, 90.0)
+        history.save()
+        forecast_settings = {'FORECAST_PATH': self.path, 'FORECAST_BUCKET': 3600, 'FORECAST_LEAD_TIME': 3600.0}
+
+        for predictive, launches in ((False, 0), (True, 2)):
+            with self.subTest(predictive=predictive), fleet(2, PREDICTIVE_SCALING=predictive, **forecast_settings) as (cloud, gameservers, manager):
+                manager.update()
+                # The margins are met, but 36 more clients are expected within the lead time
+                self.assertEqual(manager.total_available_capacity, 20)
+                self.assertEqual(len(manager.provisioner.launches), launches)
+
+class SimulatorTests(SimpleTestCase):
+
+    def test_traces(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.csv")
+            with open(path, 'w') as f:
+                f.write("# seconds,rate\n0,1.0\n60,2.0\n120,0.0\n")
+            trace = DemandTrace.load(path)
+            self.assertEqual((trace.rate(30), trace.rate(61), trace.rate(150), trace.rate(190)), (1.0, 2.0, 0.0, 1.0)) # repeats
+            self.assertEqual(trace.next_change(61), 120)
+
+            # A recorded demand history starts at the time of day of its first bucket; missed buckets carry the previous rate over
+            history = DemandHistory(os.path.join(directory, "demand_history.bin"), bucket_width=300, days=1)
+            history.add(1000, 300.0, 0.0, 0.0)
+            history.add(1003, 600.0, 0.0, 0.0)
+            history.save()
+            trace = DemandTrace.load(history.path)
+            self.assertEqual((trace.rates, trace.start), ([1.0, 1.0, 1.0, 2.0], 1000 * 300 % 86400))
+
+    def test_policies_see_the_same_demand(self):
+        trace = DemandTrace([0.05] * 60 + [0.5] * 60, bucket_width=60) # demand rises tenfold after an hour
+        policies = [{'UPSCALE_MARGIN': 5, 'DOWNSCALE_MARGIN': 20}, {'UPSCALE_MARGIN': 60, 'DOWNSCALE_MARGIN': 80}]
+        with redirect_stdout(io.StringIO()), override_settings(SERVER_CAPACITY=10, THREAD_SLEEP_TIME=30, SCALE_OUT_MAX_BURST=10):
+            tight, generous = [simulate(trace, 7200, session_duration=300, launch_delay=120, seed=1, **p) for p in policies]
+        self.assertEqual(tight['clients'], generous['clients'])
+        self.assertGreater(tight['scale_out_events'], 0)
+        self.assertGreater(tight['below_capacity_s'], generous['below_capacity_s'])
+        self.assertGreater(tight['turned_away'] + tight['backup_fallbacks'], generous['turned_away'] + generous['backup_fallbacks'])
+        self.assertLess(tight['server_hours'], generous['server_hours'])
+
+    @override_settings(SERVER_CAPACITY=10, THREAD_SLEEP_TIME=30)
+    def test_simulate_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            trace = os.path.join(directory, "trace.csv")
+            with open(trace, 'w') as f:
+                f.write("0,0.05\n600,0.2\n")
+            outputs: list = []
+            for run in range(2):
+                outputs.append(os.path.join(directory, "results-" + str(run) + ".json"))
+                call_command('simulate', policy=['UPSCALE_MARGIN=5,DOWNSCALE_MARGIN=30'], trace=trace, days=0.05, seed=3, output=outputs[-1])
+            with open(outputs[0]) as first, open(outputs[1]) as second:
+                results = json.load(first)
+                # The same seed replays the same arrivals, sessions and launches
+                self.assertEqual(results, json.load(second))
+            self.assertEqual(list(results['results']), ['UPSCALE_MARGIN=5,DOWNSCALE_MARGIN=30'])
+            self.assertGreater(results['results']['UPSCALE_MARGIN=5,DOWNSCALE_MARGIN=30']['clients'], 0)
+
+            with open(trace, 'w') as f:
+                f.write("0,0.05\n")
+            for options in ({'trace': trace}, {'trace': os.path.join(directory, "missing.bin")}, {'policy': ['NO_SUCH_SETTING=1']}):
+                with self.assertRaises(CommandError):
+                    call_command('simulate', days=0.01, **options)
+
+class PackingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.servers = []
+        for i, capacity in enumerate([5, 1, 0, 3]):
+            server = Server("arn:task/" + str(i), "i-" + str(i), "10.0.0." + str(i) + ":8000")
+            server.reported_capacity = capacity
+            self.servers.append(server)
+
+    def test_fullest_server_with_room_is_selected(self):
+        index = CapacityIndex()
+        for server in self.servers:
+            index.add(server)
+        self.assertIs(index.select('pack'), self.servers[1])
+        self.servers[1].reserve()
+        index.update(self.servers[1])
+        self.assertIs(index.select('pack'), self.servers[3])
+        index.draining = {self.servers[3]}
+        self.assertIs(index.select('pack'), self.servers[0])
+        # Draining servers (and then the server with the most room) are only picked once no other server has room
+        self.servers[0].reported_capacity = 0
+        index.update(self.servers[0])
+        self.assertIs(index.select('pack'), self.servers[3])
+
+    def test_scale_in_takes_the_servers_expected_to_drain_first(self):
+        with fleet(4, SELECTION_POLICY='pack', UPSCALE_MARGIN=2, DOWNSCALE_MARGIN=13, SCALE_IN_STABLE_TICKS=2, SCALE_IN_COOLDOWN=0) as (cloud, gameservers, manager):
+            servers = sorted(manager.available_servers, key=lambda s: s.address)
+            for server, capacity in zip(servers, [10, 2, 0, 10]):
+                gameservers.set_curve(constant(capacity), [int(server.address.split(':')[1])])
+            # servers[3] is as empty as servers[0], but was sent a client longer ago
+            servers[3].last_assigned_at, servers[0].last_assigned_at = 10.0, 20.0
+            manager.update()
+            self.assertEqual(manager.standby_servers, []) # a single tick above the downscale margin
+            self.assertEqual(manager.capacity_index.draining, {servers[3]}) # the excess of 9 is worth one server
+
+            # New clients are packed onto the fullest server with room, and new games are kept off the drain candidate
+            self.assertIs(manager.get_available_server(), servers[1])
+            self.assertIsNot(manager.get_available_server("game-0"), servers[3])
+            manager.update()
+            self.assertEqual(manager.standby_servers, [servers[3]])
+            self.assertEqual(manager.capacity_index.draining, set())
+
+class PoolTests(SimpleTestCase):
+
+    POOLS = {
+        'mumbai': {'region': 'ap-south-1', 'aliases': ['IN'], 'spillover': ['singapore']},
+        'frankfurt': {'region': 'eu-central-1', 'cluster': 'gameservers', 'aliases': ['DE', 'FR']},
+        'singapore': {'region': 'ap-southeast-1', 'launch_template': 'singaporeECS'},
+    }
+
+    def tearDown(self):
+        reset_pools()
+
+    @contextmanager
+    def pool_fleets(self, sizes: dict, capacities: dict = {}, **settings_overrides):
+        """Yields the ServerManagerThreads (not started) of pools with fleets of the given sizes (and server capacities), nearest first, each on a FakeCloud of its own and updated once"""
+        with ExitStack() as stack:
+            managers: list = []
+            for name, size in sizes.items():
+                capacity_curve = constant(capacities[name]) if name in capacities else None
+                cloud, gameservers, manager = stack.enter_context(fleet(size, capacity_curve=capacity_curve, POOLS={name: {}}, **settings_overrides))
+                # Updated while its own clients are set; the router makes no AWS calls
+                manager.update()
+                managers.append(manager)
+            yield managers
+
+    @override_settings(POOLS=POOLS, UPSCALE_MARGIN=10, DOWNSCALE_MARGIN=100, SERVER_CAPACITY=50, ECS_CLUSTER='')
+    def test_pools_are_ranked_by_locality(self):
+        reset_pools()
+        pools = get_pools()
+        self.assertEqual(pools['frankfurt'].cluster, 'gameservers')
+        self.assertIsNone(pools['mumbai'].cluster)
+        self.assertEqual(pools['singapore'].launch_template, 'singaporeECS')
+        self.assertEqual(pools['singapore'].get_path('/tmp/server_state.json'), '/tmp/server_state.singapore.json')
+        # No hint: declared order; a region hint: the pools serving it, then the pools they spill over to
+        self.assertEqual(rank_pools(), ['mumbai', 'frankfurt', 'singapore'])
+        self.assertEqual(rank_pools('in'), ['mumbai', 'singapore', 'frankfurt'])
+        self.assertEqual(rank_pools('eu-central-1'), ['frankfurt', 'mumbai', 'singapore'])
+        self.assertEqual(rank_pools('BR'), ['mumbai', 'frankfurt', 'singapore'])
+        # Probed round trip times take precedence over the region hint; unknown pools are ignored and pools not probed come last
+        self.assertEqual(rank_pools('IN', {'singapore': 40.0, 'frankfurt': 150.0, 'tokyo': 10.0}), ['singapore', 'frankfurt', 'mumbai'])
+
+    def test_saturated_pool_spills_over(self):
+        with self.pool_fleets({'mumbai': 1, 'singapore': 2}, {'mumbai': 1, 'singapore': 2}) as (nearest, next_nearest):
+            [mumbai] = nearest.available_servers
+            router = PoolRouter([nearest, next_nearest])
+            self.assertIs(router.get_available_server(), mumbai)
+            # The nearest pool is full
+            spilled = router.get_available_server("game-0")
+            self.assertIn(spilled, next_nearest.available_servers)
+            [other] = [s for s in next_nearest.available_servers if s is not spilled]
+            # A game stays in the pool hosting it, even once the nearest pool has capacity again
+            mumbai.reported_capacity = 5
+            nearest.capacity_index.update(mumbai)
+            self.assertIs(router.get_available_server("game-0"), spilled)
+            self.assertEqual(spilled.available_capacity, 0)
+            # Once every pool is full, only admission (or a batch) is turned away, while a single client oversubscribes the nearest pool
+            self.assertEqual([router.reserve_server() for _ in range(6)], [mumbai] * 4 + [other] * 2)
+            self.assertIsNone(router.reserve_server())
+            self.assertEqual(router.reserve_groups([1, 2]), [None, None])
+            with self.assertRaises(Saturated):
+                router.admit("game-1")
+            self.assertIs(router.get_available_server(), mumbai)
+            # Heartbeats are applied by the pool which knows the sender (the task arns of the fake clouds repeat, so one unknown to the nearest pool is used)
+            self.assertNotIn(other.task_arn, nearest.servers_by_task_arn)
+            self.assertTrue(router.ingest_heartbeat(other.task_arn, 1, {'available_capacity': 3, 'ready_to_close': False}))
+            self.assertFalse(router.ingest_heartbeat(other.task_arn, 1, {'available_capacity': 3, 'ready_to_close': False}))
+            self.assertIs(router.reserve_server(), other)
+            with self.assertRaises(KeyError):
+                router.ingest_heartbeat("arn:aws:ecs:fake:task/tokyo", 1, {'available_capacity': 3, 'ready_to_close': False})
+
+    def test_batches_and_admission_spill_over(self):
+        # Without an upscale margin, the empty pool launches no server
+        with self.pool_fleets({'mumbai': 1, 'singapore': 1, 'frankfurt': 0}, {'mumbai': 3}, UPSCALE_MARGIN=0) as (nearest, next_nearest, empty):
+            [mumbai], [singapore] = nearest.available_servers, next_nearest.available_servers
+            # The groups which don't fit in the nearest pool are placed in the next nearest one, in the order of the batch
+            self.assertEqual(PoolRouter([nearest, next_nearest]).reserve_groups([2, 4, 1]), [mumbai, singapore, mumbai])
+            self.assertEqual(mumbai.available_capacity, 0)
+            self.assertEqual(singapore.available_capacity, 6)
+            # Admission skips the full nearest pool, and a pool without servers or launches in flight
+            self.assertIs(PoolRouter([empty, nearest, next_nearest]).admit("game-0"), singapore)
+            self.assertIs(PoolRouter([nearest, next_nearest]).admit("game-0"), singapore)
+            with self.assertRaises(IndexError):
+                PoolRouter([empty]).admit()
+            with self.assertRaises(IndexError):
+                PoolRouter([empty]).get_available_server()
+            self.assertIsNone(PoolRouter([empty]).get_available_server(require_capacity=True))
+
+    def test_list_merges_the_pools(self):
+        with self.pool_fleets({'mumbai': 2, 'singapore': 1}) as (nearest, next_nearest):
+            snapshot = PoolRouter([nearest, next_nearest]).get_snapshot()
+            addresses = [s.address for s in nearest.available_servers + next_nearest.available_servers]
+            self.assertEqual(list(snapshot.addresses), addresses)
+            # Every request has a router of its own, while the merged snapshot is shared until a pool publishes a new one
+            self.assertIs(PoolRouter([nearest, next_nearest]).get_snapshot(), snapshot)
+            self.assertEqual(list(PoolRouter([next_nearest, nearest]).get_snapshot().addresses), addresses[2:] + addresses[:2])
+
+            response = get_list(PoolRouter([nearest, next_nearest]))
+            self.assertEqual(json.loads(response.content)['server_list'], addresses)
+            self.assertEqual(response['X-Fleet-Version'], str(nearest.get_snapshot().version + next_nearest.get_snapshot().version))
+            etag = response['ETag']
+
+            # A new snapshot of any pool is a new version; the etag only changes with the list
+            next_nearest.publish_snapshot()
+            response = get_list(PoolRouter([nearest, next_nearest]), etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['X-Fleet-Version'], str(snapshot.version + 1))
+            next_nearest.remove_available_server(next_nearest.available_servers[0])
+            next_nearest.publish_snapshot()
+            response = get_list(PoolRouter([nearest, next_nearest]), etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content)['server_list'], addresses[:2])
+
+class ReplicationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lease_is_taken_over_once_expired(self):
+        for backend_class in (SQLiteLeaseBackend, FileLeaseBackend):
+            with self.subTest(backend_class.__name__):
+                backend = backend_class(os.path.join(self.directory.name, backend_class.__name__))
+                first, second = LeaderElector(backend, 'pool', 'first', 30.0), LeaderElector(backend, 'pool', 'second', 30.0)
+                self.assertTrue(first.tick(now=0.0))
+                self.assertFalse(second.tick(now=0.0))
+                self.assertEqual(backend.get_holder('pool'), 'first')
+                # The leader stops acting as such before its lease expires, even without renewing it
+                self.assertTrue(first.is_leader(now=26.0))
+                self.assertFalse(first.is_leader(now=27.0))
+                # Renewals aren't due before a third of the lease period
+                self.assertEqual(first.next_renewal, 10.0)
+                # Once the lease expires (ttl 0 writes an expired lease), another replica takes over
+                self.assertTrue(backend.acquire('pool', 'first', 0.0))
+                self.assertTrue(second.tick(now=10.0))
+                self.assertFalse(first.tick(now=10.0))
+                # A released lease is taken over right away
+                second.release()
+                self.assertIsNone(backend.get_holder('pool'))
+                self.assertTrue(first.tick(now=20.0))
+                backend.publish('pool', "table")
+                self.assertEqual(backend.fetch('pool'), "table")
+                first.release()
+
+    def test_leader_acts_through_a_failed_renewal(self):
+        path = os.path.join(self.directory.name, "lease.sqlite3")
+        backend = SQLiteLeaseBackend(path)
+        elector = LeaderElector(backend, 'pool', 'first', 30.0)
+        self.assertTrue(elector.tick(now=0.0))
+        # The database can't be opened at a directory, so the renewal fails
+        backend.path = self.directory.name
+        self.assertTrue(elector.tick(now=10.0))
+        self.assertEqual(elector.next_renewal, 20.0)
+        self.assertFalse(elector.tick(now=27.0))
+        backend.path = path
+        self.assertTrue(elector.tick(now=37.0))
+        elector.release()
+        self.assertIsNone(backend.get_holder('pool'))
+
+    @contextmanager
+    def leader_fleet(self, size: int):
+        """Yields fleet(size) in REPLICA_MODE, with its manager updated once as the leader (replica 'first')"""
+        path = os.path.join(self.directory.name, "lease.sqlite3")
+        with fleet(size, REPLICA_MODE=True, REPLICA_LEASE_PATH=path, REPLICA_LEASE_TTL=30.0, REPLICA_ID='first') as (cloud, gameservers, leader):
+            leader.update()
+            leader.reconciliation.join()
+            try:
+                yield cloud, gameservers, leader
+            finally:
+                # Released before the lease database is removed
+                leader.elector.release()
+
+    @contextmanager
+    def replica(self, replica_id: str):
+        """Yields a second ServerManagerThread (not started) for the pool of a fleet, as another replica named replica_id would run it"""
+        ServerManagerThread.reset_instance()
+        with override_settings(REPLICA_ID=replica_id):
+            manager = ServerManagerThread.get_instance()
+        try:
+            yield manager
+        finally:
+            if manager.elector is not None:
+                manager.elector.release()
+            manager.provisioner.shutdown()
+            manager.warm_pool.shutdown()
+
+    def test_followers_serve_the_table_of_the_leader(self):
+        with self.leader_fleet(3) as (cloud, gameservers, leader):
+            self.assertTrue(leader.is_leader())
+
+            # A second replica starts from the replicated table without any api call and doesn't scale
+            calls = sum(cloud.calls.values())
+            with self.replica('second') as follower:
+                self.assertEqual(follower.update(), [])
+                self.assertFalse(follower.is_leader())
+                self.assertEqual(sorted(s.address for s in follower.get_available_servers()), sorted(s.address for s in leader.available_servers))
+                self.assertIsNotNone(follower.get_available_server())
+                self.assertFalse(follower.remove_server(follower.available_servers[0]))
+                self.assertEqual(sum(cloud.calls.values()), calls)
+
+                # The follower takes over once the leader gives up its lease, and the former leader steps down
+                leader.elector.release()
+                follower.elector.next_renewal = 0.0
+                follower.update()
+                follower.reconciliation.join()
+                self.assertTrue(follower.is_leader())
+                self.assertEqual(len(follower.available_servers), 3)
+                leader.elector.next_renewal = 0.0
+                leader.update()
+                self.assertFalse(leader.is_leader())
+
+    def test_followers_sync_the_changes_of_the_leader(self):
+        with self.leader_fleet(3) as (cloud, gameservers, leader):
+            with self.replica('second') as follower:
+                follower.update()
+                reserved = follower.reserve_server("game-0")
+                standby, other = [s for s in leader.available_servers if s.task_arn != reserved.task_arn]
+
+                # The leader moves a server to standby and learns of a drop in capacity through a heartbeat
+                leader.remove_available_server(standby)
+                leader.standby_servers.append(standby)
+                self.assertTrue(leader.ingest_heartbeat(other.task_arn, 5, {'available_capacity': 4, 'ready_to_close': False}))
+                leader.publish_replica()
+                follower.update()
+                self.assertEqual([s.address for s in follower.standby_servers], [standby.address])
+                self.assertEqual(sorted(s.address for s in follower.available_servers), sorted(s.address for s in leader.available_servers))
+                self.assertEqual(follower.total_available_capacity, 4 + 9)
+
+                # The reservation of the follower is kept until the capacity replicated by the leader reflects the client
+                self.assertIn(reserved, follower.available_servers)
+                self.assertEqual(reserved.available_capacity, 9)
+                self.assertTrue(leader.ingest_heartbeat(reserved.task_arn, 1, {'available_capacity': 9, 'ready_to_close': False}))
+                leader.publish_replica()
+                self.assertTrue(follower.sync_replica())
+                self.assertEqual(reserved.reservations.outstanding(), 0)
+                self.assertEqual(reserved.available_capacity, 9)
+
+                # Heartbeats the leader applied are stale on the follower
+                state_json = {'available_capacity': 2, 'ready_to_close': False}
+                self.assertFalse(follower.ingest_heartbeat(other.task_arn, 5, state_json))
+                self.assertTrue(follower.ingest_heartbeat(other.task_arn, 6, state_json))
+                self.assertEqual(follower.total_available_capacity, 2 + 9)
+
+    def test_stale_replica_is_ignored(self):
+        with self.leader_fleet(2) as (cloud, gameservers, leader):
+            calls = sum(cloud.calls.values())
+            # A replicated table older than STATE_JOURNAL_MAX_AGE is ignored, so the follower discovers the servers, and keeps them for want of a fresh table
+            with override_settings(STATE_JOURNAL_MAX_AGE=-1.0), self.replica('second') as follower:
+                self.assertGreater(sum(cloud.calls.values()), calls)
+                self.assertEqual(len(follower.available_servers), 2)
+                self.assertFalse(follower.sync_replica())
+                self.assertEqual(follower.update(), [])
+                self.assertFalse(follower.is_leader())
+                self.assertEqual(len(follower.available_servers), 2)
+
+    def test_expired_lease_is_taken_over_with_the_servers_it_missed(self):
+        with self.leader_fleet(2) as (cloud, gameservers, leader):
+            with self.replica('second') as follower:
+                follower.update()
+                # The leader launched a server it didn't replicate, then stopped renewing its lease (ttl 0 writes an expired lease)
+                cloud.add_running_servers(1)
+                self.assertTrue(leader.elector.backend.acquire(leader.pool.name, 'first', 0.0))
+                follower.elector.next_renewal = 0.0
+                follower.update()
+                follower.reconciliation.join()
+                self.assertTrue(follower.is_leader())
+                self.assertEqual(len(follower.available_servers), 3)
+                self.assertEqual(leader.elector.backend.get_holder(leader.pool.name), 'second')
+
+                # The former leader acts as such until its own view of the lease runs out, then steps down without any api call
+                self.assertTrue(leader.is_leader())
+                leader.elector.next_renewal = 0.0
+                calls = sum(cloud.calls.values())
+                self.assertEqual(leader.update(), [])
+                self.assertFalse(leader.is_leader())
+                self.assertFalse(leader.remove_server(leader.available_servers[0]))
+                self.assertEqual(sum(cloud.calls.values()), calls)
+                self.assertEqual(len(leader.available_servers), 3)
+
+class WarmPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pool = WarmPool(min_size=1, max_size=3, mode='stopped', window=60.0, max_workers=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_target_size_follows_recent_launches(self):
+        self.assertEqual(self.pool.target_size(now=0.0), 1)
+        for t in (10.0, 11.0, 12.0, 13.0):
+            self.pool.record_launch(now=t)
+        self.assertEqual(self.pool.target_size(now=20.0), 3) # capped at max_size
+        self.assertEqual(self.pool.target_size(now=71.5), 2) # launches older than the window are forgotten
+        self.assertEqual(self.pool.target_size(now=100.0), 1)
+
+    def test_take_prefers_running_instances(self):
+        self.pool.instances = {"i-0": 'stopped', "i-1": 'running'}
+        self.assertEqual(self.pool.take(), ("i-1", 'running'))
+        self.assertEqual(self.pool.take(), ("i-0", 'stopped'))
+        self.assertIsNone(self.pool.take())
+
+    def wait_for_refills(self, warm_pool: WarmPool) -> None:
+        while warm_pool.refilling > 0:
+            sleep(0.01)
+
+    def test_stopped_instances_are_started_for_a_launch(self):
+        with fleet(0, WARM_POOL_MIN_SIZE=2, WARM_POOL_MAX_SIZE=2, WARM_POOL_MODE='stopped') as (cloud, gameservers, manager):
+            warm_pool = manager.warm_pool
+            warm_pool.maintain()
+            self.wait_for_refills(warm_pool)
+            self.assertEqual(sorted(warm_pool.instances.values()), ['stopped', 'stopped'])
+            self.assertEqual({cloud.instances[i]['State'] for i in warm_pool.instances}, {'stopped'})
+            self.assertEqual(warm_pool.pending, set())
+
+            launch = manager.provisioner.launch()
+            while manager.provisioner.in_flight() > 0:
+                sleep(0.01)
+            self.assertEqual(launch.state, 'RUNNING')
+            self.assertTrue(launch.warm)
+            self.assertEqual(cloud.instances[launch.ec2_id]['State'], 'running')
+            self.assertNotIn(launch.ec2_id, warm_pool.instances)
+            # Refilled on the next update
+            warm_pool.maintain()
+            self.wait_for_refills(warm_pool)
+            self.assertEqual(len(warm_pool.instances), 2)
+
+            # Instances above the target size are terminated
+            warm_pool.max_size = 1
+            pooled = set(warm_pool.instances)
+            warm_pool.maintain()
+            self.assertEqual(len(warm_pool.instances), 1)
+            [excess] = pooled - set(warm_pool.instances)
+            while warm_pool.pending:
+                sleep(0.01)
+            self.assertEqual(cloud.instances[excess]['State'], 'terminated')
+
+    def test_pool_is_rediscovered(self):
+        with fleet(1, WARM_POOL_MIN_SIZE=1, WARM_POOL_MAX_SIZE=1, WARM_POOL_MODE='running') as (cloud, gameservers, manager):
+            manager.warm_pool.maintain()
+            self.wait_for_refills(manager.warm_pool)
+            [pooled] = manager.warm_pool.instances
+            restarted = WarmPool(max_workers=1)
+            try:
+                # A tagged instance which came to run a server instance (before the restart) isn't taken back
+                restarted.discover([pooled])
+                self.assertEqual(restarted.instances, {})
+                restarted.discover([manager.available_servers[0].ec2_id])
+                self.assertEqual(restarted.instances, {pooled: 'running'})
+            finally:
+                restarted.shutdown()
+
+    def test_binpack_leaves_idle_instances_in_the_pool(self):
+        with fleet(1, tasks_per_instance=2, PLACEMENT_MODE='binpack', WARM_POOL_MIN_SIZE=1, WARM_POOL_MAX_SIZE=1, WARM_POOL_MODE='running') as (cloud, gameservers, manager):
+            warm_pool = manager.warm_pool
+            warm_pool.maintain()
+            while not warm_pool.instances:
+                sleep(0.01)
+            [warm_ec2_id] = warm_pool.instances
+            self.assertEqual(warm_pool.get_ec2_ids(), {warm_ec2_id})
+
+            # Packed onto the instance of the server instance, which has room for another task
+            packed = manager.provisioner.launch()
+            while manager.provisioner.in_flight() > 0:
+                sleep(0.01)
+            self.assertEqual(packed.state, 'RUNNING')
+            self.assertEqual(packed.ec2_id, manager.available_servers[0].ec2_id)
+            self.assertFalse(packed.warm)
+
+            # No registered instance is left but the idle one of the pool, which is taken whole
+            warm = manager.provisioner.launch()
+            while manager.provisioner.in_flight() > 0:
+                sleep(0.01)
+            self.assertEqual(warm.state, 'RUNNING')
+            self.assertEqual(warm.ec2_id, warm_ec2_id)
+            self.assertTrue(warm.warm)
+            self.assertEqual(warm_pool.instances, {})
+            self.assertEqual(len(cloud.instances[warm_ec2_id]['task_arns']), 1)
+
+    def test_task_placed_on_a_pooled_instance_leaves_the_pool(self):
+        self.pool.instances = {"i-0": 'running'}
+        self.pool.pending = {"i-1"}
+        self.assertEqual(self.pool.get_ec2_ids(), {"i-0", "i-1"})
+        self.assertTrue(self.pool.discard("i-0"))
+        self.assertFalse(self.pool.discard("i-0"))
+        self.assertEqual(self.pool.instances, {})
+
+class PlaceTaskTests(SimpleTestCase):
+
+    def setUp(self):
+        self.ecs_client = make_client("ecs")
+        self.ecs_stubber = Stubber(self.ecs_client)
+
+    def test_no_room_on_registered_instances(self):
+        self.ecs_stubber.add_response('run_task', {'tasks': [], 'failures': [{'reason': 'RESOURCE:MEMORY'}]})
+        with self.ecs_stubber, override_settings(ECS_CLIENT=self.ecs_client):
+            self.assertIsNone(place_task('LaunchGameserver'))
+
+    def test_task_is_packed(self):
+        self.ecs_stubber.add_response(
+            'run_task',
+            {'tasks': [{'taskArn': "arn:task/0", 'containerInstanceArn': "arn:container-instance/0"}], 'failures': []},
+            {
+                'taskDefinition': 'LaunchGameserver',
+                'launchType': 'EC2',
+                'placementStrategy': [{'type': 'binpack', 'field': 'memory'}, {'type': 'binpack', 'field': 'cpu'}],
+                'count': 1,
+            },
+        )
+        with self.ecs_stubber, override_settings(ECS_CLIENT=self.ecs_client):
+            self.assertEqual(place_task('LaunchGameserver')['taskArn'], "arn:task/0")
+
+    def test_excluded_instances_are_left_out(self):
+        self.ecs_stubber.add_response(
+            'run_task',
+            {'tasks': [{'taskArn': "arn:task/0", 'containerInstanceArn': "arn:container-instance/0"}], 'failures': []},
+            {
+                'taskDefinition': 'LaunchGameserver',
+                'launchType': 'EC2',
+                'placementStrategy': [{'type': 'binpack', 'field': 'memory'}, {'type': 'binpack', 'field': 'cpu'}],
+                'placementConstraints': [{'type': 'memberOf', 'expression': "ec2InstanceId not_in ['i-0', 'i-1']"}],
+                'count': 1,
+            },
+        )
+        with self.ecs_stubber, override_settings(ECS_CLIENT=self.ecs_client):
+            self.assertEqual(place_task('LaunchGameserver', exclude_ec2_ids={"i-1", "i-0"})['taskArn'], "arn:task/0")
+            # Too many instances for a constraint expression; nothing is placed
+            self.assertIsNone(place_task('LaunchGameserver', exclude_ec2_ids={"i-%017x" % i for i in range(200)}))
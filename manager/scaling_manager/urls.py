@@ -13,11 +13,24 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
-urlpatterns = [
-    path('available-gameserver/', views.available_gameserver, name='available_gameserver'),
-    path('available-gameserver-list/', views.available_gameserver_list, name='available_gameserver_list'),
-]
+if settings.ASYNC_VIEWS:
+    urlpatterns = [
+        path('available-gameserver/', views.available_gameserver_async, name='available_gameserver'),
+        path('available-gameserver-list/', views.available_gameserver_list_async, name='available_gameserver_list'),
+        path('available-gameserver-batch/', views.available_gameserver_batch_async, name='available_gameserver_batch'),
+        path('heartbeat/', views.heartbeat_async, name='heartbeat'),
+        path('metrics/', views.metrics_view, name='metrics'),
+    ]
+else:
+    urlpatterns = [
+        path('available-gameserver/', views.available_gameserver, name='available_gameserver'),
+        path('available-gameserver-list/', views.available_gameserver_list, name='available_gameserver_list'),
+        path('available-gameserver-batch/', views.available_gameserver_batch, name='available_gameserver_batch'),
+        path('heartbeat/', views.heartbeat, name='heartbeat'),
+        path('metrics/', views.metrics_view, name='metrics'),
+    ]
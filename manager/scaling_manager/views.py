@@ -1,23 +1,299 @@
-from django.http import JsonResponse
+import hmac
+import json
+import math
+from time import perf_counter
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
 from django.core.cache import cache
 from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from .admission import Saturated
+from .pools import parse_rtts
+from .routing import get_pool_router
 from .server_classes import ServerManagerThread
+from .shared_table import get_shared_table
+from .snapshot import encode_assignment
+from . import metrics
 
-def available_gameserver(request):
-    gameserver_manager = ServerManagerThread.get_instance()
+BACKUP_GAMESERVER_BODY: bytes = encode_assignment(settings.BACKUP_GAMESERVER)
+GAME_ID_MAX_LENGTH = 128
+REGION_MAX_LENGTH = 64
+RTT_MAX_LENGTH = 1024
+BATCH_MAX_GROUPS = 1000
+
+def json_response(body: bytes) -> HttpResponse:
+    """Returns a response with the given pre-serialized json body"""
+    return HttpResponse(body, content_type='application/json')
+
+def get_gameserver_manager(request=None):
+    """
+    Returns the object assigning gameservers in this process:
+    the shared server table if the manager app runs as several worker processes (SHARED_TABLE),
+    the PoolRouter over the pools ranked by the locality of the client making the request if there are several pools (POOLS), and the ServerManagerThread otherwise
+    """
+    if settings.SHARED_TABLE:
+        return get_shared_table()
+    if settings.POOLS:
+        return get_pool_router(*get_locality(request))
+    return ServerManagerThread.get_instance()
+
+def get_locality(request) -> tuple:
+    """
+    Returns a tuple (region hint, round trip times) of the client making the request: the region query parameter (e.g. an AWS region or a country code)
+    and the rtt query parameter (the milliseconds the client measured to each pool as 'pool:rtt,pool:rtt,...'), each None if not given.
+    A malformed hint is ignored rather than failing the request, as the client can still be served from the default pool.
+    """
+    if request is None:
+        return None, None
+    region: str = request.GET.get('region')
+    if region is not None and len(region) > REGION_MAX_LENGTH:
+        region = None
+    rtts: dict = None
+    rtt: str = request.GET.get('rtt')
+    if rtt is not None and len(rtt) <= RTT_MAX_LENGTH:
+        try:
+            rtts = parse_rtts(rtt)
+        except ValueError as e:
+            print(e)
+    return region, rtts
+
+def get_game_id(request) -> str:
+    """
+    Returns the game (or room) id the client asks a gameserver for, or None if it doesn't.
+    Raises ValueError if the id is too long.
+    """
+    game_id: str = request.GET.get('game_id') or request.GET.get('room_id')
+    if game_id is not None and len(game_id) > GAME_ID_MAX_LENGTH:
+        raise ValueError("game_id is longer than " + str(GAME_ID_MAX_LENGTH) + " characters")
+    return game_id
+
+def get_wait(request) -> float:
+    """
+    Returns the time (in seconds) the client is willing to wait for a gameserver with capacity: the wait query parameter (ADMISSION_DEFAULT_WAIT if not given), capped at ADMISSION_MAX_WAIT.
+    Raises ValueError if it isn't a number.
+    """
+    wait: str = request.GET.get('wait')
+    seconds: float = float(wait) if wait is not None else settings.ADMISSION_DEFAULT_WAIT
+    if math.isnan(seconds):
+        raise ValueError("wait must be a number of seconds")
+    return min(max(seconds, 0.0), settings.ADMISSION_MAX_WAIT)
+
+def assigned_response(gameserver_manager, gs_address: str) -> HttpResponse:
+    """Returns the response assigning the given gameserver address to the client, or the backup gameserver if it is None"""
+    if gs_address is None:
+        metrics.BACKUP_GAMESERVER_FALLBACKS.inc()
+        body = BACKUP_GAMESERVER_BODY
+    else:
+        body = gameserver_manager.get_snapshot().assignment_body(gs_address)
+    response = json_response(body)
+    # Every call reserves capacity, so the response must never be served from a cache
+    patch_cache_control(response, no_store=True)
+    return response
+
+def saturated_response(e: Saturated) -> HttpResponse:
+    """Returns the response (429 Too Many Requests) to a client which wasn't admitted, telling it when to retry"""
+    response = HttpResponse(str(e), status=429, content_type='text/plain')
+    response['Retry-After'] = str(e.retry_after)
+    patch_cache_control(response, no_store=True)
+    return response
+
+def assignment_response(request, gameserver_manager) -> HttpResponse:
+    """
+    Returns the response assigning an available gameserver (or the backup gameserver) to the client
+    Clients passing the same game_id (or room_id) query parameter are sent to the same gameserver, see GameAffinity
+    With POOLS, the gameserver is taken from the pool nearest to the client (region or rtt query parameter) which has capacity left, see PoolRouter
+    With ADMISSION_CONTROL, the client waits for capacity instead, see admission_response
+    """
+    if settings.ADMISSION_CONTROL:
+        return admission_response(request, gameserver_manager)
+    try:
+        game_id: str = get_game_id(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    start: float = perf_counter()
+    try:
+        gs_address = gameserver_manager.get_available_server(game_id).address
+        metrics.SELECTION_LATENCY.observe(perf_counter() - start)
+    except Exception as e:
+        print(e)
+        gs_address = None
+    return assigned_response(gameserver_manager, gs_address)
+
+def admission_response(request, gameserver_manager) -> HttpResponse:
+    """
+    Returns the response assigning a gameserver with capacity left to the client, holding the request (long-poll) for up to the wait query parameter (seconds) while no gameserver has any.
+    Waiting clients are admitted first come, first served as capacity frees up or new gameservers come online; responds 429 with Retry-After if the wait queue is full or the wait is over.
+    The backup gameserver is only assigned if there is no gameserver and none is being launched.
+    """
+    try:
+        game_id: str = get_game_id(request)
+        wait: float = get_wait(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    try:
+        gs_address = gameserver_manager.admit(game_id, wait).address
+    except Saturated as e:
+        return saturated_response(e)
+    except Exception as e:
+        print(e)
+        gs_address = None
+    return assigned_response(gameserver_manager, gs_address)
+
+async def admission_response_async(request, gameserver_manager) -> HttpResponse:
+    """asyncio counterpart of admission_response; waiting clients don't block the event loop"""
+    try:
+        game_id: str = get_game_id(request)
+        wait: float = get_wait(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
     try:
-        gs_address = gameserver_manager.get_available_server().address
+        gs_address = (await gameserver_manager.admit_async(game_id, wait)).address
+    except Saturated as e:
+        return saturated_response(e)
     except Exception as e:
         print(e)
-        gs_address = settings.BACKUP_GAMESERVER
-    return JsonResponse({
-        'available': gs_address
-    })
+        gs_address = None
+    return assigned_response(gameserver_manager, gs_address)
+
+def get_group_sizes(request) -> list:
+    """
+    Returns the group sizes of a batch assignment request, whose json body has either 'count' (that many single clients) or 'groups' (list of group sizes).
+    Raises ValueError if the body is invalid.
+    """
+    batch: dict = json.loads(request.body)
+    if 'groups' in batch:
+        group_sizes = batch['groups']
+    elif 'count' in batch:
+        if not isinstance(batch['count'], int) or isinstance(batch['count'], bool) or not 0 < batch['count'] <= BATCH_MAX_GROUPS:
+            raise ValueError("count must be an integer between 1 and " + str(BATCH_MAX_GROUPS))
+        group_sizes = [1] * batch['count']
+    else:
+        raise ValueError("Body must have 'count' or 'groups'")
+    if not isinstance(group_sizes, list) or not 0 < len(group_sizes) <= BATCH_MAX_GROUPS:
+        raise ValueError("A batch must have between 1 and " + str(BATCH_MAX_GROUPS) + " groups")
+    if not all(isinstance(size, int) and not isinstance(size, bool) and size > 0 for size in group_sizes):
+        raise ValueError("Group sizes must be positive integers")
+    return group_sizes
+
+def batch_assignment_response(request, gameserver_manager) -> HttpResponse:
+    """
+    Returns the response assigning gameservers to a batch of groups of clients (e.g. from a matchmaker), with capacity reserved for the whole batch at once.
+    The clients of a group are assigned the same gameserver; groups which don't fit on any gameserver are assigned the backup gameserver.
+    The response has the assignments in the order of the groups, e.g. {"assignments": [{"available": "<address>", "size": 2}, ...]}
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        group_sizes: list = get_group_sizes(request)
+    except Exception as e:
+        return HttpResponseBadRequest(str(e))
+
+    try:
+        servers: list = gameserver_manager.reserve_groups(group_sizes)
+    except Exception as e:
+        print(e)
+        servers = [None] * len(group_sizes)
+    assignments: list = []
+    for server, size in zip(servers, group_sizes):
+        address: str = server.address if server is not None else settings.BACKUP_GAMESERVER
+        assignments.append({'available': address, 'size': size})
+    fallbacks: int = servers.count(None)
+    if fallbacks > 0:
+        metrics.BACKUP_GAMESERVER_FALLBACKS.inc(fallbacks)
+    response = json_response(json.dumps({'assignments': assignments}).encode())
+    patch_cache_control(response, no_store=True)
+    return response
+
+def list_response(request, gameserver_manager) -> HttpResponse:
+    """Returns the response with the list of available gameservers from the latest snapshot"""
+    snapshot = gameserver_manager.get_snapshot()
+    # 304 Not Modified if the client already has this list
+    response = get_conditional_response(request, etag=snapshot.etag)
+    if response is None:
+        response = json_response(snapshot.list_body)
+    response['ETag'] = snapshot.etag
+    response['X-Fleet-Version'] = str(snapshot.version)
+    patch_cache_control(response, public=True, max_age=settings.SNAPSHOT_MAX_AGE)
+    return response
+
+def heartbeat_response(request, gameserver_manager) -> HttpResponse:
+    """
+    Returns the response to a heartbeat pushed by a gameserver, which is applied right away (or recorded in the shared server table).
+    The body is json with keys 'task_arn', 'seq', 'available_capacity' and 'ready_to_close'.
+    Responds 204 if the heartbeat is applied, 409 if it is stale, 404 if the gameserver isn't known (yet) and 400 if the body is invalid.
+    A heartbeat can close a standby gameserver, so heartbeats are refused (403) unless HEARTBEAT_TOKEN is set, and must carry it (401).
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not settings.HEARTBEAT_TOKEN:
+        return HttpResponseForbidden("Heartbeats are disabled as HEARTBEAT_TOKEN isn't set")
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), ("Bearer " + settings.HEARTBEAT_TOKEN).encode()):
+        return HttpResponse(status=401)
+
+    try:
+        heartbeat: dict = json.loads(request.body)
+        task_arn: str = heartbeat['task_arn']
+        seq: int = heartbeat['seq']
+        state_json: dict = {
+            'available_capacity': heartbeat['available_capacity'],
+            'ready_to_close': heartbeat['ready_to_close'],
+        }
+        if not (isinstance(task_arn, str) and isinstance(seq, int) and not isinstance(seq, bool)
+                and isinstance(state_json['available_capacity'], int) and not isinstance(state_json['available_capacity'], bool)
+                and isinstance(state_json['ready_to_close'], bool)):
+            raise ValueError("Invalid heartbeat " + str(heartbeat))
+    except Exception as e:
+        print(e)
+        metrics.HEARTBEATS.labels('invalid').inc()
+        return HttpResponse(status=400)
+
+    try:
+        applied: bool = gameserver_manager.ingest_heartbeat(task_arn, seq, state_json)
+    except KeyError:
+        metrics.HEARTBEATS.labels('unknown').inc()
+        return HttpResponse(status=404)
+    if not applied:
+        metrics.HEARTBEATS.labels('stale').inc()
+        return HttpResponse(status=409)
+    metrics.HEARTBEATS.labels('applied').inc()
+    return HttpResponse(status=204)
+
+def available_gameserver(request):
+    return assignment_response(request, get_gameserver_manager(request))
 
 def available_gameserver_list(request):
-    gameserver_manager = ServerManagerThread.get_instance()
-    server_list = gameserver_manager.get_available_servers()
-    ret_list = [s.address for s in server_list]
-    return JsonResponse({
-        'server_list': ret_list
-    })
+    return list_response(request, get_gameserver_manager(request))
+
+@csrf_exempt
+def available_gameserver_batch(request):
+    return batch_assignment_response(request, get_gameserver_manager(request))
+
+@csrf_exempt
+def heartbeat(request):
+    return heartbeat_response(request, get_gameserver_manager())
+
+# Async views, used when the manager app is served over ASGI (see manager/asgi.py).
+# The selection only holds the manager's lock for a few microseconds, so it runs on the event loop directly.
+# The manager is created on startup by ServerManagerLifespan, so get_instance doesn't block here.
+
+async def available_gameserver_async(request):
+    if settings.ADMISSION_CONTROL:
+        return await admission_response_async(request, get_gameserver_manager(request))
+    return assignment_response(request, get_gameserver_manager(request))
+
+async def available_gameserver_list_async(request):
+    return list_response(request, get_gameserver_manager(request))
+
+async def available_gameserver_batch_async(request):
+    return batch_assignment_response(request, get_gameserver_manager(request))
+
+async def heartbeat_async(request):
+    return heartbeat_response(request, get_gameserver_manager())
+
+# csrf_exempt (Django 3.2) wraps the view in a sync function, so the flag it sets is set directly
+heartbeat_async.csrf_exempt = True
+available_gameserver_batch_async.csrf_exempt = True
+
+def metrics_view(request):
+    """Exposes the metrics of this process in the Prometheus text format"""
+    return HttpResponse(metrics.REGISTRY.expose(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,165 @@
+"""This module has the WarmPool class which keeps EC2 instances registered to the cluster ahead of scale-outs, so that launching a server instance doesn't have to boot a fresh EC2 instance"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from django.conf import settings
+from .aws_utils import *
+from . import metrics
+
+class WarmPool():
+    """
+    Pool of EC2 instances registered to the cluster which don't run a gameserver task yet, kept stopped or running idle, and sized to the launches requested over the last window seconds.
+    Pooled instances are tagged with TAG_KEY (the name of their Pool), so the pool is rediscovered when the manager app restarts.
+
+    Attributes:
+    * mode: 'stopped' or 'running'; state in which instances are kept in the pool
+    * min_size: min number of instances kept in the pool
+    * max_size: max number of instances kept in the pool (0 disables the pool)
+    * window: time (in seconds) over which scale-out launches are counted to size the pool
+    * instances: dict mapping ec2 id to the state ('running' or 'stopped') of every instance ready in the pool
+    * refilling: number of instances being launched (or stopped) for the pool
+    * pending: set of ec2 ids of the instances being launched (or stopped) for the pool, or terminated out of it
+    * pool: Pool of gameservers (region and launch template) the instances are launched for
+    """
+
+    TAG_KEY = 'playlivechess-warm-pool'
+    MODES = ('stopped', 'running')
+
+    def __init__(self, min_size: int = None, max_size: int = None, mode: str = None, window: float = 900.0, max_workers: int = None, pool: Pool = None):
+        self.min_size: int = min_size if min_size is not None else settings.WARM_POOL_MIN_SIZE
+        self.max_size: int = max_size if max_size is not None else settings.WARM_POOL_MAX_SIZE
+        self.mode: str = mode or settings.WARM_POOL_MODE
+        self.window: float = window
+        assert self.mode in self.MODES
+        self.pool: Pool = pool or get_default_pool()
+
+        self.instances: dict = {}
+        self.refilling: int = 0
+        self.pending: set = set()
+        self._launches = deque() # monotonic times of the scale-out launches within the window
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.PROVISIONING_WORKERS,
+            thread_name_prefix='warm-pool'
+        )
+
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def discover(self, busy_ec2_ids: list) -> None:
+        """Adds the tagged instances left by a previous run of the manager app, except the ones running a server instance, to the pool"""
+        if not self.enabled():
+            return
+        try:
+            # Instances tagged before there were several pools have the value 'true', so the value is only matched with POOLS
+            instances: dict = get_tagged_instances(self.TAG_KEY, self.pool.name if settings.POOLS else None, self.pool)
+        except Exception as e:
+            print("Unable to discover the warm pool due to the following exception")
+            print(e)
+            return
+        busy: set = set(busy_ec2_ids)
+        with self._lock:
+            for ec2_id, state in instances.items():
+                if ec2_id not in busy:
+                    self.instances[ec2_id] = state
+        print("Warm pool discovered with", len(self.instances), "instances")
+
+    def record_launch(self, now: float = None) -> None:
+        """Records a scale-out launch, which counts towards the target size for the next window seconds"""
+        with self._lock:
+            self._launches.append(now if now is not None else monotonic())
+
+    def target_size(self, now: float = None) -> int:
+        """Returns the number of instances the pool should hold"""
+        now = now if now is not None else monotonic()
+        with self._lock:
+            while self._launches and self._launches[0] <= now - self.window:
+                self._launches.popleft()
+            recent_launches: int = len(self._launches)
+        return min(self.max_size, max(self.min_size, recent_launches))
+
+    def take(self) -> tuple:
+        """
+        Takes an instance out of the pool, preferring a running one.
+        Returns a tuple (ec2 id, state) or None if the pool is empty.
+        """
+        with self._lock:
+            if not self.instances:
+                metrics.WARM_POOL_TAKES.labels('miss').inc()
+                return None
+            running: list = [i for i, state in self.instances.items() if state == 'running']
+            ec2_id: str = running[0] if running else next(iter(self.instances))
+            state: str = self.instances.pop(ec2_id)
+        metrics.WARM_POOL_TAKES.labels('hit').inc()
+        return ec2_id, state
+
+    def get_ec2_ids(self) -> set:
+        """Returns the ec2 ids of the instances in the pool, or being launched for it or terminated out of it; no task may be placed on them"""
+        with self._lock:
+            return set(self.instances) | self.pending
+
+    def discard(self, ec2_id: str) -> bool:
+        """Takes the given instance out of the pool (e.g. a task was placed on it). Returns True if it was in the pool and False otherwise"""
+        with self._lock:
+            return self.instances.pop(ec2_id, None) is not None
+
+    def maintain(self) -> None:
+        """Refills the pool up to the target size (launches run in the background) and terminates the instances above it"""
+        if not self.enabled():
+            return
+        target: int = self.target_size()
+        excess: list = []
+        with self._lock:
+            deficit: int = target - len(self.instances) - self.refilling
+            if deficit > 0:
+                self.refilling += deficit
+            elif len(self.instances) > target and self.refilling == 0:
+                # Shed stopped instances first, they are the slowest to bring into service
+                by_state: list = sorted(self.instances, key=lambda i: self.instances[i] == 'running')
+                excess = by_state[:len(self.instances) - target]
+                for ec2_id in excess:
+                    del self.instances[ec2_id]
+                    self.pending.add(ec2_id)
+        for _ in range(max(deficit, 0)):
+            self._executor.submit(self._refill)
+        for ec2_id in excess:
+            self._executor.submit(self._terminate, ec2_id)
+        metrics.WARM_POOL_SIZE.labels(self.pool.name).set(len(self.instances))
+
+    def _refill(self) -> None:
+        """Launches an instance for the pool (on a worker thread)"""
+        ec2_id: str = None
+        try:
+            ec2_id = run_ecs_instance(tags={self.TAG_KEY: self.pool.name}, pool=self.pool)
+            with self._lock:
+                self.pending.add(ec2_id)
+            wait_for_instance(ec2_id, self.pool)
+            if self.mode == 'stopped':
+                stop_ec2(ec2_id, self.pool)
+            with self._lock:
+                self.instances[ec2_id] = self.mode
+                self.pending.discard(ec2_id)
+            print("Warm pool instance", ec2_id, "ready")
+        except Exception as e:
+            print("Warm pool refill failed due to the following exception")
+            print(e)
+            if ec2_id is not None:
+                self._terminate(ec2_id)
+        finally:
+            with self._lock:
+                self.refilling -= 1
+
+    def _terminate(self, ec2_id: str) -> None:
+        try:
+            terminate_ec2(ec2_id, self.pool)
+        except Exception as e:
+            print(e)
+        finally:
+            with self._lock:
+                self.pending.discard(ec2_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Cancels the refills which haven't started yet; with wait set, blocks until the ones already started are done"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)